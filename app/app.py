@@ -23,8 +23,12 @@ HEADER_IMAGE_PATH = "images/logo.jpg"
 import config
 # Import project services (must exist)
 from services.transcribe import transcribe_audio
+from services.transcript_cache import get_transcript_cache
+from services.audio import audio_stats
 from services.vectorstore import KBManager
-from services.rag import answer_query
+from services.rag import answer_query_stream, answer_stats
+from services.answer_cache import get_answer_cache
+from services.embeddings import get_local_embedder, warm_local_embeddings, embedding_cache_stats
 
 # mic recorder optional
 try:
@@ -53,6 +57,11 @@ def safe_rerun():
     except Exception:
         st.rerun()
 
+def dedup_note(added):
+    """' (skipped N duplicate chunks)' for an add_transcript result, or ''."""
+    skipped = (added or {}).get("chunks", 0) - (added or {}).get("added", 0)
+    return f" (skipped {skipped} duplicate chunks)" if skipped else ""
+
 def get_img_as_base64(file_path):
     try:
         with open(file_path, "rb") as f:
@@ -228,6 +237,11 @@ if st.button("Try Demo", key="hero_try_demo"):
 # Ensure data dir
 kb_manager = KBManager(root_dir=str(config.DATA_DIR))
 
+# Without an API key every embedding goes through the local model; load it once
+# in the background so the first query doesn't pay for it.
+if not os.environ.get("OPENAI_API_KEY") and not get_local_embedder().loaded:
+    warm_local_embeddings(background=True)
+
 # Show persistent one-time message (if any) EARLY
 show_one_time_message()
 
@@ -309,6 +323,19 @@ with col_sidebar:
     st.write("---")
     st.markdown("<div class='small-muted'>KB Diagnostics</div>", unsafe_allow_html=True)
     st.write({"existing_kbs": kb_manager.list_kbs()})
+    st.write({"local_embeddings": get_local_embedder().stats()})
+    st.write({"embedding_cache": embedding_cache_stats()})
+    st.write({"transcript_cache": get_transcript_cache().stats()})
+    st.write({"audio_preprocessing": audio_stats()})
+    st.write({"kb_cache": kb_manager.cache_stats()})
+    st.write({"answers": answer_stats()})
+    st.write({"answer_cache": get_answer_cache().stats()})
+    if kb_choice and kb_choice != "<no KBs>":
+        st.write({"dedup": kb_manager.get_kb(kb_choice).dedup_stats})
+        reindex_status = kb_manager.get_kb(kb_choice).reindex_status()
+        if reindex_status and reindex_status["running"]:
+            st.info(f"Re-embedding '{kb_choice}' with {reindex_status['target_model']}: "
+                    f"{reindex_status['done']}/{reindex_status['total']} chunks (old index still serving).")
     st.markdown("</div>", unsafe_allow_html=True)
 
 # ---------------- Main center: Recorder / Uploader / Transcript ----------------
@@ -319,8 +346,33 @@ with col_main:
     # In-browser recorder (optional)
     if MIC_AVAILABLE:
         st.markdown("**Record in your browser**")
+        live_mode = st.checkbox("Live session (index each clip as soon as it is recorded)", key="live_mode")
         mic_bytes = mic_recorder(start_prompt="🎤 Start recording", stop_prompt="🤐 Stop recording", key="mic_recorder_1")
-        if mic_bytes:
+        live = st.session_state.get("_live_session")
+        if live_mode:
+            if kb_choice in (None, "<no KBs>"):
+                st.warning("Select or create a KB in the sidebar before starting a live session.")
+            else:
+                if mic_bytes and mic_bytes.get("id") != st.session_state.get("_live_clip_id"):
+                    st.session_state["_live_clip_id"] = mic_bytes.get("id")
+                    try:
+                        if live is None:
+                            live = kb_manager.start_live_session(kb_choice, f"live-{uuid.uuid4().hex[:6]}")
+                            st.session_state["_live_session"] = live
+                        live.feed(mic_bytes["bytes"])
+                    except Exception as e:
+                        st.error(f"Live transcription failed: {e}")
+                if live is not None:
+                    st.caption(f"Live: {live.title} → {live.kb.name} · {live.status()}")
+                    if st.button("Finish live session"):
+                        with st.spinner("Transcribing the rest of the session..."):
+                            stats = live.finish()
+                        del st.session_state["_live_session"]
+                        st.session_state["_last_transcript_preview"] = live.transcript
+                        st.session_state["_one_time_msg"] = (f"Live session '{live.title}' added to KB "
+                                                             f"'{live.kb.name}' ({stats['chunks']} chunks).")
+                        safe_rerun()
+        elif mic_bytes:
             st.audio(mic_bytes["bytes"], format="audio/wav")
             if st.button("Transcribe & Add (recording)"):
                 if kb_choice in (None, "<no KBs>"):
@@ -335,8 +387,9 @@ with col_main:
                         st.session_state["_one_time_msg"] = "Transcription complete."
                         st.session_state["_last_transcript_preview"] = transcript
                         try:
-                            kb_manager.add_transcript(kb_choice, f"recording-{uuid.uuid4().hex[:6]}", transcript)
-                            st.session_state["_one_time_msg"] = f"Added to KB '{kb_choice}'"
+                            added = kb_manager.add_transcript(kb_choice, f"recording-{uuid.uuid4().hex[:6]}", transcript,
+                                                          source="microphone")
+                            st.session_state["_one_time_msg"] = f"Added to KB '{kb_choice}'" + dedup_note(added)
                         except Exception as e:
                             st.session_state["_one_time_msg"] = f"Failed to add to KB: {e}"
                         safe_rerun()
@@ -364,8 +417,9 @@ with col_main:
                 else:
                     st.session_state["_last_transcript_preview"] = transcript
                     try:
-                        kb_manager.add_transcript(kb_choice, getattr(uploaded, "name", f"upload-{uuid.uuid4().hex[:6]}"), transcript)
-                        st.session_state["_one_time_msg"] = f"Added '{getattr(uploaded, 'name', 'upload')}' to KB '{kb_choice}'"
+                        added = kb_manager.add_transcript(kb_choice, getattr(uploaded, "name", f"upload-{uuid.uuid4().hex[:6]}"), transcript,
+                                                  source="upload")
+                        st.session_state["_one_time_msg"] = f"Added '{getattr(uploaded, 'name', 'upload')}' to KB '{kb_choice}'" + dedup_note(added)
                     except Exception as e:
                         st.session_state["_one_time_msg"] = f"Failed to add to KB: {e}"
                     safe_rerun()
@@ -388,6 +442,22 @@ with col_right:
     model_choice = st.selectbox("Model", options=[config.DEFAULT_CHAT_MODEL], index=0, key="model_select")
     top_k = st.slider("Top K", min_value=1, max_value=10, value=config.DEFAULT_RAG_TOP_K, key="topk_slider")
 
+    # optional pre-filters: only the chosen recordings / sources are searched
+    filters = {}
+    if kb_choice not in (None, "<no KBs>"):
+        with st.expander("Filters", expanded=False):
+            try:
+                filter_kb = kb_manager.get_kb(kb_choice)
+                titles = st.multiselect("Recordings", options=filter_kb.documents(), key="filter_titles")
+                sources = st.multiselect("Sources", options=filter_kb.sources(), key="filter_sources")
+            except Exception as e:
+                titles, sources = [], []
+                st.caption(f"Filters unavailable: {e}")
+        if titles:
+            filters["title"] = titles
+        if sources:
+            filters["source"] = sources
+
     answer_placeholder = st.empty()
     sources_placeholder = st.empty()
     
@@ -411,22 +481,27 @@ with col_right:
         elif not query_text or not query_text.strip():
             st.warning("Type a question to query the KB.")
         else:
-            # skeleton loader
+            # skeleton loader until the first tokens arrive
             answer_placeholder.markdown('<div class="skeleton" style="width:100%"></div>', unsafe_allow_html=True)
             sources_placeholder.markdown('<div class="skeleton" style="width:70%"></div>', unsafe_allow_html=True)
-            
-            with st.spinner("Retrieving and generating answer..."):
-                kb = kb_manager.get_kb(kb_choice)
-                try:
-                    answer, sources = answer_query(query_text, kb, top_k=top_k)
-                    # Persist in session state
-                    st.session_state["last_answer"] = answer
-                    st.session_state["last_sources"] = sources
-                    # Clear any old audio if new question
-                    st.session_state.pop("last_audio", None) 
-                except Exception as e:
-                    st.session_state["last_answer"] = f"[Error while answering: {e}]"
-                    st.session_state["last_sources"] = []
+
+            kb = kb_manager.get_kb(kb_choice)
+            try:
+                stream = answer_query_stream(query_text, kb, top_k=top_k, filters=filters)
+                sources_placeholder.empty()
+                for _ in stream:
+                    answer_placeholder.markdown(f"<div class='card' style='padding:12px'>{stream.text}▌</div>",
+                                                unsafe_allow_html=True)
+                # Persist in session state
+                st.session_state["last_answer"] = stream.text
+                st.session_state["last_sources"] = stream.sources
+                st.session_state["last_metrics"] = stream.metrics
+                # Clear any old audio if new question
+                st.session_state.pop("last_audio", None)
+            except Exception as e:
+                st.session_state["last_answer"] = f"[Error while answering: {e}]"
+                st.session_state["last_sources"] = []
+                st.session_state.pop("last_metrics", None)
 
             safe_rerun()
 
@@ -440,6 +515,15 @@ with col_right:
 
         st.markdown("### Answer")
         st.markdown(f"<div class='card' style='padding:12px'>{answer}</div>", unsafe_allow_html=True)
+        metrics = st.session_state.get("last_metrics")
+        if metrics and metrics.get("total_s") is not None:
+            if metrics.get("cached"):
+                st.caption(f"Cached answer · {metrics['total_s']:.3f}s")
+            else:
+                packed = metrics.get("context") or {}
+                st.caption(f"Retrieval {metrics['retrieval_s']:.2f}s · first token {metrics['ttft_s']:.2f}s · "
+                           f"total {metrics['total_s']:.2f}s · context {packed.get('context_tokens', 0)} tokens "
+                           f"({packed.get('saved_tokens', 0)} saved)")
         
         # TTS Logic
         if st.session_state["tts_enabled"]:
@@ -0,0 +1,105 @@
+"""
+Recall vs latency of the KB index kinds against the exact flat baseline.
+
+    python benchmarks/index_recall.py --n 100000 --dim 384
+    python benchmarks/index_recall.py --kb data/kbs/my-kb
+
+Uses synthetic clustered vectors unless --kb points at an existing KB, in which
+case that KB's vectors are used (queries are perturbed copies of stored rows).
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import faiss  # noqa: E402
+
+from services import indexes  # noqa: E402
+
+
+def synthetic(n, dim, n_queries, seed=0):
+    """Gaussian clusters, roughly the shape of sentence-embedding neighbourhoods."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(16, n // 200), dim)).astype('float32')
+    assign = rng.integers(0, len(centers), size=n + n_queries)
+    data = centers[assign] + 0.35 * rng.standard_normal((n + n_queries, dim)).astype('float32')
+    return data[:n], data[n:]
+
+
+def from_kb(path, n_queries, seed=0):
+    from services.vectorstore import KB
+    kb = KB(os.path.basename(os.path.normpath(path)), path)
+    vecs = indexes.all_vectors(kb.index)
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(vecs), size=min(n_queries, len(vecs)), replace=False)
+    queries = vecs[rows] + 0.01 * rng.standard_normal((len(rows), vecs.shape[1])).astype('float32')
+    return vecs, queries
+
+
+def recall_at_k(found, truth):
+    hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def timed_search(index, queries, k, params=None):
+    """Search one query at a time, like KB.query does; returns (I, ms per query)."""
+    out = np.empty((len(queries), k), dtype='int64')
+    t0 = time.perf_counter()
+    for i in range(len(queries)):
+        _, I = index.search(queries[i:i + 1], k, params=params)
+        out[i] = I[0]
+    return out, (time.perf_counter() - t0) * 1000 / len(queries)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--n", type=int, default=100000)
+    ap.add_argument("--dim", type=int, default=384)
+    ap.add_argument("--queries", type=int, default=500)
+    ap.add_argument("--k", type=int, default=4)
+    ap.add_argument("--kb", help="benchmark an existing KB directory instead of synthetic data")
+    args = ap.parse_args()
+
+    if args.kb:
+        data, queries = from_kb(args.kb, args.queries)
+    else:
+        data, queries = synthetic(args.n, args.dim, args.queries)
+    n, dim = data.shape
+    print(f"{n} vectors, dim {dim}, {len(queries)} queries, k={args.k}")
+
+    ids = np.arange(n, dtype='int64')
+    flat = indexes.build_index("flat", dim)
+    flat.add_with_ids(data, ids)
+    truth, flat_ms = timed_search(flat, queries, args.k)
+
+    rows = [("flat", "-", 0.0, 1.0, flat_ms, len(faiss.serialize_index(flat)))]
+    sweeps = {"hnsw": ("efSearch", [16, 32, 64, 128]),
+              "ivf": ("nprobe", [1, 4, 16, 64]),
+              "ivfpq": ("nprobe", [1, 4, 16, 64])}
+    for kind, (knob, values) in sweeps.items():
+        t0 = time.perf_counter()
+        index = indexes.build_index(kind, dim, data)
+        index.add_with_ids(data, ids)
+        build_s = time.perf_counter() - t0
+        if indexes.index_kind(index) != kind:
+            print(f"skipping {kind}: too few vectors to train")
+            continue
+        size = len(faiss.serialize_index(index))
+        for v in values:
+            params = indexes.search_params(index, **({"ef_search": v} if kind == "hnsw" else {"nprobe": v}))
+            found, ms = timed_search(index, queries, args.k, params)
+            rows.append((kind, f"{knob}={v}", build_s, recall_at_k(found, truth), ms, size))
+
+    print(f"{'index':<7} {'param':<13} {'build s':>8} {'recall@k':>9} {'ms/query':>9} {'speedup':>8} {'MB':>8}")
+    for kind, param, build_s, recall, ms, size in rows:
+        print(f"{kind:<7} {param:<13} {build_s:>8.2f} {recall:>9.3f} {ms:>9.3f} {flat_ms / ms:>7.1f}x {size / 2**20:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
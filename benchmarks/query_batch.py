@@ -0,0 +1,96 @@
+"""
+Queries per second of KB.query_batch against looping over KB.query.
+
+    python benchmarks/query_batch.py --n 50000 --dim 384
+    python benchmarks/query_batch.py --kind hnsw --batch 1 8 64 256
+    python benchmarks/query_batch.py --kb data/kbs/my-kb
+
+Builds a throwaway KB from synthetic clustered vectors (or opens --kb) and
+searches it with precomputed query vectors in vector mode, so the numbers are
+retrieval only; embedding the queries costs one request per batch either way
+with query_batch, one per query with query.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+# index_recall also puts the repo root on sys.path
+from index_recall import from_kb, synthetic
+
+import config  # noqa: E402
+from services.vectorstore import KB  # noqa: E402
+
+
+def synthetic_kb(directory, data, kind, storage):
+    """A KB at `directory` holding `data`, one chunk per row."""
+    kb = KB("bench", directory)
+    kb.metadata.update(index_kind=kind, vector_storage=storage, embedding_model="bench")
+    step = 1000
+    for start in range(0, len(data), step):
+        rows = data[start:start + step]
+        docs = [{'title': f"doc{(start + i) // 50}", 'text': f"chunk {start + i}"} for i in range(len(rows))]
+        kb._append(docs, rows, "bench")
+    # let any background compaction finish so it doesn't contend with the timed searches
+    running = kb.compact()
+    if running is not None:
+        running.join()
+        kb.compact()
+    return kb
+
+
+def qps_loop(kb, queries, k):
+    t0 = time.perf_counter()
+    results = [kb.query("", top_k=k, query_vector=queries[i:i + 1], mode="vector") for i in range(len(queries))]
+    return results, len(queries) / (time.perf_counter() - t0)
+
+
+def qps_batch(kb, queries, k, batch):
+    t0 = time.perf_counter()
+    results = []
+    for start in range(0, len(queries), batch):
+        rows = queries[start:start + batch]
+        results += kb.query_batch([""] * len(rows), top_k=k, query_vectors=rows, mode="vector")
+    return results, len(queries) / (time.perf_counter() - t0)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--n", type=int, default=50000)
+    ap.add_argument("--dim", type=int, default=384)
+    ap.add_argument("--queries", type=int, default=1000)
+    ap.add_argument("--k", type=int, default=4)
+    ap.add_argument("--kind", default="flat", choices=["auto", "flat", "hnsw", "ivf", "ivfpq"])
+    ap.add_argument("--storage", default=config.DEFAULT_KB_VECTOR_STORAGE)
+    ap.add_argument("--batch", type=int, nargs="+", default=[1, 16, 64, 256])
+    ap.add_argument("--kb", help="benchmark an existing KB directory instead of synthetic data")
+    args = ap.parse_args()
+
+    tmp = None
+    if args.kb:
+        _, queries = from_kb(args.kb, args.queries)
+        kb = KB(os.path.basename(os.path.normpath(args.kb)), args.kb)
+    else:
+        data, queries = synthetic(args.n, args.dim, args.queries)
+        tmp = tempfile.mkdtemp(prefix="kb-bench-")
+        print(f"building a {args.kind} / {args.storage} KB of {args.n} vectors, dim {args.dim} ...")
+        kb = synthetic_kb(tmp, data, args.kind, args.storage)
+    try:
+        print(f"{len(kb.chunks)} chunks, index {kb.index_kind} / {kb.vector_storage}, "
+              f"{len(queries)} queries, k={args.k}")
+        kb.query_batch([""] * 8, top_k=args.k, query_vectors=queries[:8], mode="vector")  # warm up
+        expected, loop_qps = qps_loop(kb, queries, args.k)
+        print(f"{'method':<16} {'QPS':>10} {'speedup':>8} {'same hits':>10}")
+        print(f"{'query() loop':<16} {loop_qps:>10.0f} {1.0:>7.1f}x {'-':>10}")
+        for batch in args.batch:
+            found, qps = qps_batch(kb, queries, args.k, batch)
+            same = all([h['id'] for h in a] == [h['id'] for h in b] for a, b in zip(found, expected))
+            print(f"{f'batch of {batch}':<16} {qps:>10.0f} {qps / loop_qps:>7.1f}x {str(same):>10}")
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Memory, recall and latency of the KB vector storage modes against float32.
+
+    python benchmarks/vector_storage.py --n 100000 --dim 1536
+    python benchmarks/vector_storage.py --kind hnsw --kb data/kbs/my-kb
+
+Every storage mode is measured with and without the exact re-rank KB.query
+does for lossy storage (KB_RERANK_FACTOR x candidates re-scored against the
+float32 vectors, which live on disk and are not counted in MB).
+"""
+import argparse
+import time
+
+import numpy as np
+import faiss
+
+# index_recall also puts the repo root on sys.path
+from index_recall import from_kb, recall_at_k, synthetic, timed_search
+
+import config  # noqa: E402
+from services import indexes  # noqa: E402
+
+
+def timed_rerank_search(index, data, queries, k, factor):
+    """Like timed_search, but fetch k * factor candidates and re-rank them exactly."""
+    out = np.full((len(queries), k), -1, dtype='int64')
+    t0 = time.perf_counter()
+    for i in range(len(queries)):
+        q = queries[i:i + 1]
+        _, I = index.search(q, k * factor)
+        cand = I[0][I[0] >= 0]
+        exact = ((data[cand] - q) ** 2).sum(axis=1)
+        best = cand[np.argsort(exact)[:k]]
+        out[i, :len(best)] = best
+    return out, (time.perf_counter() - t0) * 1000 / len(queries)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--n", type=int, default=50000)
+    ap.add_argument("--dim", type=int, default=1536)
+    ap.add_argument("--queries", type=int, default=300)
+    ap.add_argument("--k", type=int, default=4)
+    ap.add_argument("--kind", default="flat", choices=["flat", "hnsw", "ivf"])
+    ap.add_argument("--factor", type=int, default=config.KB_RERANK_FACTOR)
+    ap.add_argument("--kb", help="benchmark an existing KB directory instead of synthetic data")
+    args = ap.parse_args()
+
+    if args.kb:
+        data, queries = from_kb(args.kb, args.queries)
+    else:
+        data, queries = synthetic(args.n, args.dim, args.queries)
+    n, dim = data.shape
+    print(f"{n} vectors, dim {dim}, {len(queries)} queries, k={args.k}, index {args.kind}")
+
+    ids = np.arange(n, dtype='int64')
+    exact = indexes.build_index("flat", dim)
+    exact.add_with_ids(data, ids)
+    truth, _ = timed_search(exact, queries, args.k)
+
+    rows = []
+    for storage in indexes.STORAGE_KINDS:
+        t0 = time.perf_counter()
+        index = indexes.build_index(args.kind, dim, data, storage)
+        index.add_with_ids(data, ids)
+        build_s = time.perf_counter() - t0
+        if indexes.index_storage(index) != storage:
+            print(f"skipping {storage}: too few vectors to train")
+            continue
+        size = len(faiss.serialize_index(index))
+        found, ms = timed_search(index, queries, args.k)
+        rows.append((storage, "no", build_s, recall_at_k(found, truth), ms, size))
+        if indexes.is_lossy(storage):
+            found, ms = timed_rerank_search(index, data, queries, args.k, args.factor)
+            rows.append((storage, f"x{args.factor}", build_s, recall_at_k(found, truth), ms, size))
+
+    base_ms, base_size = rows[0][4], rows[0][5]
+    print(f"{'storage':<8} {'rerank':<7} {'build s':>8} {'recall@k':>9} {'ms/query':>9} {'vs f32':>7} "
+          f"{'MB':>8} {'smaller':>8}")
+    for storage, rerank, build_s, recall, ms, size in rows:
+        print(f"{storage:<8} {rerank:<7} {build_s:>8.2f} {recall:>9.3f} {ms:>9.3f} {base_ms / ms:>6.1f}x "
+              f"{size / 2**20:>8.1f} {base_size / size:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
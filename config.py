@@ -5,9 +5,97 @@ from pathlib import Path
 DATA_DIR = Path("data/kbs")
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
+# In-process cache of open KBs
+KB_CACHE_MAX_BYTES = 512 * 1024 * 1024
+KB_CACHE_CHECK_INTERVAL = 1.0  # seconds between on-disk change checks per KB
+
+# KB persistence: write-ahead log folded into a snapshot once it grows past this
+KB_COMPACT_LOG_BYTES = 8 * 1024 * 1024
+KB_COMPACT_IN_BACKGROUND = True
+# compact (dropping deleted chunks) once this fraction of a KB's chunks is deleted
+KB_TOMBSTONE_COMPACT_RATIO = 0.2
+
+# Chunking of documents added to a KB ("chars" or "tokens")
+CHUNK_UNIT = "chars"
+CHUNK_MAX_LEN = 600
+CHUNK_OVERLAP = 100
+CHUNK_INGEST_BATCH = 256  # chunks embedded and logged at a time while a document is chunked
+
+# Ingest-time duplicate detection (see services/dedup.py)
+DEDUP_ENABLED = True
+DEDUP_SIMHASH_DISTANCE = 3          # max differing SimHash bits for a near-duplicate
+DEDUP_EMBEDDING_THRESHOLD = 0.98    # cosine similarity to an indexed chunk; None disables
+
+# Background re-embedding when a KB's embedding model changes
+REINDEX_BATCH_SIZE = 256
+
+# KB index selection ("auto" picks by KB size) and ANN tunables
+DEFAULT_KB_INDEX_KIND = "auto"  # auto, flat, hnsw, ivf, ivfpq
+KB_FLAT_MAX_VECTORS = 20000     # auto: exact search below this many chunks
+KB_HNSW_MAX_VECTORS = 500000    # auto: HNSW below this, IVF-PQ above
+KB_HNSW_M = 32
+KB_HNSW_EF_CONSTRUCTION = 80
+KB_HNSW_EF_SEARCH = 64
+KB_IVF_NPROBE = 16
+KB_IVF_MAX_NLIST = 4096
+KB_PQ_M = 64
+KB_TRAIN_SAMPLE = 20000
+
+# KB vector storage: float32 (exact), float16, int8 (scalar quantizer) or pq.
+# Lossy storage keeps the float32 vectors on disk to re-rank candidates exactly.
+DEFAULT_KB_VECTOR_STORAGE = "float32"
+KB_SQ_MIN_TRAIN = 1000  # int8 codes are trained once a KB has this many chunks
+KB_RERANK = True
+KB_RERANK_FACTOR = 4    # candidates fetched per requested hit when re-ranking
+
+# Retrieval: "vector", "lexical" (BM25), "hybrid" (both, RRF-fused) or "auto"
+# (lexical-only for short keyword queries, no embedding call; hybrid otherwise)
+KB_RETRIEVAL_MODE = "auto"
+KB_HYBRID_CANDIDATES = 4   # hits fetched from each side per requested hit
+KB_RRF_K = 60
+KB_KEYWORD_MAX_TERMS = 3
+BM25_K1 = 1.2
+BM25_B = 0.75
+KB_QUERY_WORKERS = 8        # KBs searched concurrently by KBManager.query_kbs
+KB_FILTER_EXACT_MAX = 4096   # filtered searches over at most this many chunks scan them exactly
+
 # Audio Uploads
 ALLOWED_AUDIO_EXTENSIONS = ['wav', 'mp3', 'm4a']
 
+# Transcription (Whisper) and the transcript cache keyed by audio hash + model
+TRANSCRIPTION_MODEL = "whisper-1"
+TRANSCRIPT_CACHE_PATH = DATA_DIR.parent / "transcript_cache.sqlite"
+TRANSCRIPT_CACHE_MAX_ITEMS = 10000
+# Uploads are downmixed/resampled to 16 kHz mono and encoded compactly (WAV if
+# ffmpeg can't encode the chosen format)
+TRANSCRIBE_SAMPLE_RATE = 16000
+TRANSCRIBE_UPLOAD_FORMAT = "mp3"
+TRANSCRIBE_UPLOAD_BITRATE = "48k"
+# Long recordings are cut (at silence when possible) into pieces transcribed in parallel
+TRANSCRIBE_SEGMENT_SECONDS = 600.0   # 16 kHz mono WAV stays under the 25 MB limit
+TRANSCRIBE_SEGMENT_OVERLAP = 2.0     # seconds repeated when a cut has to split speech
+TRANSCRIBE_SILENCE_SEARCH = 30.0     # look this far back from a window end for a pause
+TRANSCRIBE_SILENCE_RMS = 0.01        # ~-40 dBFS
+TRANSCRIBE_OVERLAP_MAX_WORDS = 40
+TRANSCRIBE_WORKERS = 4
+# Energy-based voice activity detection: long pauses are shortened before upload
+TRANSCRIBE_VAD = True
+TRANSCRIBE_VAD_MIN_SILENCE = 1.0     # only pauses longer than this (seconds) are shortened
+TRANSCRIBE_VAD_KEEP_SILENCE = 0.3    # seconds of each shortened pause that are kept
+TRANSCRIBE_VAD_PAD = 0.2             # seconds of context kept around detected speech
+
+# Live sessions: audio is transcribed and indexed in windows while recording
+LIVE_WINDOW_SECONDS = 15.0
+LIVE_SILENCE_SEARCH = 5.0            # a window may end this much early to cut at a pause
+
+# OpenAI HTTP client (shared connection pool)
+OPENAI_MAX_CONNECTIONS = 20
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 10
+OPENAI_KEEPALIVE_EXPIRY = 30.0  # seconds
+OPENAI_TIMEOUT = 60.0
+OPENAI_CONNECT_TIMEOUT = 10.0
+OPENAI_MAX_RETRIES = 2
+
 # Models
 DEFAULT_CHAT_MODEL = "gpt-3.5-turbo"
 
@@ -18,8 +106,32 @@ DEFAULT_TTS_VOICE = "alloy"  # Options: alloy, echo, fable, onyx, nova, shimmer
 # Embedding Models
 DEFAULT_EMBEDDING_MODEL = "text-embedding-3-small"
 LOCAL_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+LOCAL_EMBEDDING_BATCH_SIZE = 32
+LOCAL_EMBEDDING_THREADS = 0  # 0 = let torch decide
+
+# Embedding cache (memory LRU + sqlite on disk)
+EMBEDDING_CACHE_PATH = DATA_DIR.parent / "embedding_cache.sqlite"
+EMBEDDING_CACHE_MEMORY_ITEMS = 10000
+EMBEDDING_CACHE_DISK_ITEMS = 200000
+
+# OpenAI embedding request batching
+EMBEDDING_BATCH_MAX_TOKENS = 100000  # per request (API limit is 300k)
+EMBEDDING_BATCH_MAX_ITEMS = 512      # per request (API limit is 2048)
+EMBEDDING_BATCH_WORKERS = 4
+EMBEDDING_MAX_RETRIES = 5
+EMBEDDING_BACKOFF_BASE = 1.0  # seconds
+EMBEDDING_BACKOFF_MAX = 30.0
 
 # RAG specific
 DEFAULT_RAG_TOP_K = 4
 DEFAULT_RAG_TEMPERATURE = 0.0
 DEFAULT_RAG_MAX_TOKENS = 512
+
+# Prompt context: over-fetch, diversify with MMR, merge neighbours, cap the tokens
+CONTEXT_OVERFETCH = 3                # candidates retrieved per top_k slot
+CONTEXT_MMR_LAMBDA = 0.7             # 1.0: relevance only; lower favours diversity
+CONTEXT_TOKEN_BUDGET = 1500
+
+# Answers cached per KB version: same question, or one embedded this close (cosine)
+ANSWER_CACHE_MAX_ITEMS = 256         # per KB; 0 disables the cache
+ANSWER_CACHE_SIMILARITY = 0.95       # None: exact matches only
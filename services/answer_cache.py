@@ -0,0 +1,141 @@
+# services/answer_cache.py
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import config
+
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Case, spacing and trailing punctuation don't change the question."""
+    return _SPACE_RE.sub(" ", (query or "").lower()).strip().rstrip("?!. ")
+
+
+class AnswerCache:
+    """
+    In-memory answers per KB, valid for one KB version (see KB.version).
+
+    Lookups try get_exact (the same question after normalize_query, asked
+    with the same top_k, chat model and `scope`, e.g. the retrieval filters),
+    which needs no embedding, and then get_similar (a cached question whose
+    query embedding has cosine similarity >= `threshold` with this one's).
+    Any change to the KB changes its version, which drops its entries on the
+    next lookup. Each KB keeps at most `max_items` answers, least recently
+    used evicted first.
+    """
+
+    def __init__(self, max_items: int = config.ANSWER_CACHE_MAX_ITEMS,
+                 threshold: Optional[float] = config.ANSWER_CACHE_SIMILARITY):
+        self.max_items = max_items
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        # kb key -> (version, OrderedDict[(question, top_k, model, scope)] -> entry)
+        self._kbs: Dict[str, Tuple[Any, "OrderedDict[tuple, dict]"]] = {}
+        self.hits = {"exact": 0, "similar": 0}
+        self.misses = 0
+        self.invalidations = 0
+
+    def _entries(self, kb_key: str, version) -> "OrderedDict[tuple, dict]":
+        held = self._kbs.get(kb_key)
+        if held is None or held[0] != version:
+            if held is not None and held[1]:
+                self.invalidations += 1
+            held = (version, OrderedDict())
+            self._kbs[kb_key] = held
+        return held[1]
+
+    def get_exact(self, kb_key: str, version, query: str, top_k: int, model: str,
+                  scope: str = "") -> Optional[dict]:
+        if self.max_items <= 0:
+            return None
+        key = (normalize_query(query), top_k, model, scope)
+        with self._lock:
+            entries = self._entries(kb_key, version)
+            entry = entries.get(key)
+            if entry is not None:
+                entries.move_to_end(key)
+                self.hits["exact"] += 1
+            return entry
+
+    def get_similar(self, kb_key: str, version, query_vector: np.ndarray, top_k: int,
+                    model: str, scope: str = "") -> Optional[dict]:
+        """Best cached answer to a question embedded within `threshold` of `query_vector`."""
+        if self.max_items <= 0 or self.threshold is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        q = np.asarray(query_vector, dtype='float32').reshape(-1)
+        q = q / max(float(np.linalg.norm(q)), 1e-12)
+        with self._lock:
+            entries = self._entries(kb_key, version)
+            keys = [k for k, e in entries.items()
+                    if k[1:] == (top_k, model, scope) and e['unit'] is not None and e['unit'].shape == q.shape]
+            if keys:
+                sims = np.stack([entries[k]['unit'] for k in keys]) @ q
+                best = int(np.argmax(sims))
+                if sims[best] >= self.threshold:
+                    entries.move_to_end(keys[best])
+                    self.hits["similar"] += 1
+                    return entries[keys[best]]
+            self.misses += 1
+            return None
+
+    def put(self, kb_key: str, version, query: str, top_k: int, model: str,
+            query_vector: Optional[np.ndarray], answer: str, sources: List[dict], scope: str = ""):
+        """Cache an answer; without a `query_vector` it is found by exact match only."""
+        if self.max_items <= 0:
+            return
+        unit = None
+        if query_vector is not None:
+            q = np.asarray(query_vector, dtype='float32').reshape(-1)
+            unit = q / max(float(np.linalg.norm(q)), 1e-12)
+        entry = {
+            'query': query,
+            'answer': answer,
+            'sources': [dict(s) for s in sources],
+            'unit': unit,
+        }
+        key = (normalize_query(query), top_k, model, scope)
+        with self._lock:
+            entries = self._entries(kb_key, version)
+            entries[key] = entry
+            entries.move_to_end(key)
+            while len(entries) > self.max_items:
+                entries.popitem(last=False)
+
+    def invalidate(self, kb_key: str):
+        with self._lock:
+            if self._kbs.pop(kb_key, None) is not None:
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.hits["exact"] + self.hits["similar"]
+            lookups = hits + self.misses
+            return {
+                "items": sum(len(e) for _, e in self._kbs.values()),
+                "exact_hits": self.hits["exact"],
+                "similar_hits": self.hits["similar"],
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 4) if lookups else None,
+                "invalidations": self.invalidations,
+            }
+
+
+_cache: Optional[AnswerCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    """Return the process-wide answer cache."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = AnswerCache()
+    return _cache
@@ -0,0 +1,288 @@
+# services/audio.py
+"""
+Audio decoding and preprocessing for transcription.
+
+Speech recognition needs far less than what users upload: Whisper works at
+16 kHz mono internally, so stereo 44.1/48 kHz audio is downmixed and
+resampled before upload and, where ffmpeg is available, encoded with a compact
+codec. Everything happens in memory; the smaller of the processed and the
+original upload is sent.
+
+Long pauses are shortened first (trim_silence, an energy-threshold voice
+activity detector); the returned TimeMap converts times in the trimmed audio
+back to the original recording.
+
+Recordings longer than TRANSCRIBE_SEGMENT_SECONDS are split (see
+plan_segments) so the pieces can be transcribed in parallel and each stays
+under the upload size limit.
+"""
+import io
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+import config
+
+# formats the transcription endpoint accepts as-is
+UPLOAD_FORMATS = {"flac", "m4a", "mp3", "mp4", "mpeg", "mpga", "oga", "ogg", "wav", "webm"}
+
+# codecs ffmpeg failed to encode with (warned about once, then skipped)
+_unavailable = set()
+_stats_lock = threading.Lock()
+_totals = {"files": 0, "input_bytes": 0, "output_bytes": 0, "seconds": 0.0,
+           "audio_s": 0.0, "silence_trimmed_s": 0.0}
+
+
+def _ext(filename_hint: Optional[str]) -> Optional[str]:
+    if filename_hint and "." in filename_hint:
+        return filename_hint.rsplit(".", 1)[-1].lower()
+    return None
+
+
+def decode_audio(raw: bytes, filename_hint: Optional[str] = None):
+    """
+    Decode uploaded bytes with pydub, trying the filename's extension first and
+    then format autodetection. Raises on failure.
+    """
+    from pydub import AudioSegment
+
+    fmt = _ext(filename_hint)
+    if fmt:
+        try:
+            return AudioSegment.from_file(io.BytesIO(raw), format=fmt)
+        except Exception:
+            pass
+    return AudioSegment.from_file(io.BytesIO(raw))
+
+
+def encode_audio(segment, fmt: str = config.TRANSCRIBE_UPLOAD_FORMAT,
+                 bitrate: str = config.TRANSCRIBE_UPLOAD_BITRATE) -> Tuple[str, bytes]:
+    """
+    Encode `segment` in memory as `fmt`, falling back to WAV (which needs no
+    ffmpeg) if that codec is unavailable. Returns (format, bytes).
+    """
+    if fmt != "wav" and fmt not in _unavailable:
+        try:
+            out = io.BytesIO()
+            segment.export(out, format=fmt, bitrate=bitrate)
+            if out.tell():
+                return fmt, out.getvalue()
+        except Exception as e:
+            with _stats_lock:
+                warn = fmt not in _unavailable
+                _unavailable.add(fmt)
+            if warn:
+                print(f"[audio] {fmt} encoding unavailable, uploading WAV instead: {e}")
+    out = io.BytesIO()
+    segment.export(out, format="wav")
+    return "wav", out.getvalue()
+
+
+def downmix(segment, sample_rate: int = config.TRANSCRIBE_SAMPLE_RATE):
+    """`segment` as mono 16-bit at `sample_rate` (what speech recognition needs)."""
+    return segment.set_channels(1).set_frame_rate(sample_rate).set_sample_width(2)
+
+
+def samples_of(segment) -> np.ndarray:
+    """Samples of a mono 16-bit segment as float32 in [-1, 1]."""
+    return np.frombuffer(segment.raw_data, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+def frame_rms(samples: np.ndarray, sample_rate: int, frame_ms: int = 30) -> np.ndarray:
+    """RMS level of consecutive `frame_ms` frames (the last partial frame is dropped)."""
+    frame = max(1, int(sample_rate * frame_ms / 1000))
+    n = len(samples) // frame
+    if n == 0:
+        return np.zeros(0, dtype=np.float32)
+    frames = samples[:n * frame].reshape(n, frame)
+    return np.sqrt((frames * frames).mean(axis=1))
+
+
+class TimeMap:
+    """
+    Piecewise map from sample offsets in trimmed audio to the original
+    recording: kept span i starts at `trimmed_starts[i]` in the trimmed audio
+    and at `original_starts[i]` in the original.
+    """
+
+    def __init__(self, original_starts: np.ndarray, trimmed_starts: np.ndarray,
+                 sample_rate: int, original_length: int, trimmed_length: int):
+        self.original_starts = np.asarray(original_starts, dtype=np.int64)
+        self.trimmed_starts = np.asarray(trimmed_starts, dtype=np.int64)
+        self.sample_rate = sample_rate
+        self.original_length = original_length
+        self.trimmed_length = trimmed_length
+
+    @classmethod
+    def identity(cls, length: int, sample_rate: int) -> "TimeMap":
+        return cls(np.zeros(1), np.zeros(1), sample_rate, length, length)
+
+    @property
+    def removed_seconds(self) -> float:
+        return (self.original_length - self.trimmed_length) / self.sample_rate
+
+    def to_original(self, seconds):
+        """Seconds in the trimmed audio (scalar or array) -> seconds in the original."""
+        pos = np.asarray(seconds, dtype=np.float64) * self.sample_rate
+        span = np.clip(np.searchsorted(self.trimmed_starts, pos, side="right") - 1, 0, None)
+        out = (self.original_starts[span] + (pos - self.trimmed_starts[span])) / self.sample_rate
+        return float(out) if out.ndim == 0 else out
+
+
+def speech_frames(rms: np.ndarray, silence_rms: float = config.TRANSCRIBE_SILENCE_RMS) -> np.ndarray:
+    """
+    Boolean speech mask over frame levels. The threshold follows the noise
+    floor (twice the 10th-percentile level) but never drops below `silence_rms`
+    nor rises above half the 90th-percentile level, so steady speech with no
+    pauses is not mistaken for noise.
+    """
+    if len(rms) == 0:
+        return np.zeros(0, dtype=bool)
+    floor, loud = np.percentile(rms, [10, 90])
+    threshold = max(silence_rms, min(2 * floor, 0.5 * loud))
+    return rms > threshold
+
+
+def trim_silence(segment, min_silence: float = config.TRANSCRIBE_VAD_MIN_SILENCE,
+                 keep_silence: float = config.TRANSCRIBE_VAD_KEEP_SILENCE,
+                 pad: float = config.TRANSCRIBE_VAD_PAD,
+                 silence_rms: float = config.TRANSCRIBE_SILENCE_RMS,
+                 frame_ms: int = 30):
+    """
+    Shorten every pause longer than `min_silence` seconds in a mono 16-bit
+    segment to `keep_silence` seconds (half kept at each side). Detected
+    speech is widened by `pad` seconds so word onsets and tails survive.
+    Returns (trimmed segment, TimeMap); audio without detected speech, or
+    without long pauses, is returned unchanged.
+    """
+    samples = np.frombuffer(segment.raw_data, dtype=np.int16)
+    sr = segment.frame_rate
+    total = len(samples)
+    identity = (segment, TimeMap.identity(total, sr))
+    rms = frame_rms(samples.astype(np.float32) / 32768.0, sr, frame_ms)
+    speech = speech_frames(rms, silence_rms)
+    if not speech.any():
+        return identity
+
+    # widen speech by `pad` frames on both sides
+    widen = int(round(pad * 1000 / frame_ms))
+    if widen:
+        speech = np.convolve(speech, np.ones(2 * widen + 1), mode="same") > 0
+
+    # silent runs as [start, end) frame ranges
+    edges = np.diff(np.concatenate(([0], (~speech).astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    long = (ends - starts) * frame_ms >= min_silence * 1000
+    if not long.any():
+        return identity
+    keep = int(round(keep_silence * 1000 / frame_ms))
+    frame = int(sr * frame_ms / 1000)
+    # drop the middle of each long pause, keeping keep/2 frames at each side
+    cut_starts = (starts[long] + keep // 2) * frame
+    cut_ends = np.minimum((ends[long] - (keep - keep // 2)) * frame, total)
+    ok = cut_ends > cut_starts
+    cut_starts, cut_ends = cut_starts[ok], cut_ends[ok]
+
+    original_starts = np.concatenate(([0], cut_ends))
+    original_ends = np.concatenate((cut_starts, [total]))
+    lengths = original_ends - original_starts
+    trimmed_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    kept = np.concatenate([samples[a:b] for a, b in zip(original_starts, original_ends)])
+    tmap = TimeMap(original_starts, trimmed_starts, sr, total, len(kept))
+    return segment._spawn(kept.tobytes()), tmap
+
+
+def plan_segments(samples: np.ndarray, sample_rate: int,
+                  max_seconds: float = config.TRANSCRIBE_SEGMENT_SECONDS,
+                  overlap_seconds: float = config.TRANSCRIBE_SEGMENT_OVERLAP,
+                  search_seconds: float = config.TRANSCRIBE_SILENCE_SEARCH,
+                  silence_rms: float = config.TRANSCRIBE_SILENCE_RMS) -> List[Tuple[int, int, bool]]:
+    """
+    Split a recording into pieces of at most `max_seconds`.
+
+    Each cut goes at the quietest frame of the last `search_seconds` of the
+    window; if even that is louder than `silence_rms` (speech runs through),
+    the cut is made at the window end and the next piece starts
+    `overlap_seconds` earlier so no word is lost. Returns (start, end,
+    overlaps_previous) in samples.
+    """
+    total = len(samples)
+    window = int(max_seconds * sample_rate)
+    if total <= window:
+        return [(0, total, False)]
+    frame_ms = 30
+    frame = int(sample_rate * frame_ms / 1000)
+    rms = frame_rms(samples, sample_rate, frame_ms)
+    search = max(1, int(search_seconds * 1000 / frame_ms))
+    overlap = int(overlap_seconds * sample_rate)
+
+    pieces = []
+    start, overlapped = 0, False
+    while total - start > window:
+        end = start + window
+        last, first = end // frame, max(start // frame + 1, end // frame - search)
+        quiet = first + int(np.argmin(rms[first:last])) if last > first else last
+        if last > first and rms[quiet] <= silence_rms:
+            cut = quiet * frame + frame // 2
+            pieces.append((start, cut, overlapped))
+            start, overlapped = cut, False
+        else:
+            pieces.append((start, end, overlapped))
+            start, overlapped = max(start + 1, end - overlap), True
+    pieces.append((start, total, overlapped))
+    return pieces
+
+
+def record_trim(audio_s: float, silence_trimmed_s: float):
+    with _stats_lock:
+        _totals["audio_s"] += audio_s
+        _totals["silence_trimmed_s"] += silence_trimmed_s
+
+
+def record_upload(input_bytes: int, output_bytes: int, seconds: float):
+    with _stats_lock:
+        _totals["files"] += 1
+        _totals["input_bytes"] += input_bytes
+        _totals["output_bytes"] += output_bytes
+        _totals["seconds"] += seconds
+
+
+def preprocess_audio(segment, raw: Optional[bytes] = None, filename_hint: Optional[str] = None,
+                     sample_rate: int = config.TRANSCRIBE_SAMPLE_RATE,
+                     fmt: str = config.TRANSCRIBE_UPLOAD_FORMAT,
+                     send_original: bool = True) -> Tuple[str, bytes, dict]:
+    """
+    Downmix `segment` to mono 16-bit at `sample_rate` and encode it as `fmt`.
+    If the original upload (`raw`) is in an accepted format and no larger, it
+    is sent instead, unless `send_original` is False (e.g. `segment` was
+    edited, so the original no longer matches it). Returns (upload filename,
+    upload bytes, stats).
+    """
+    t0 = time.perf_counter()
+    out_fmt, data = encode_audio(downmix(segment, sample_rate), fmt)
+    orig_fmt = _ext(filename_hint)
+    if send_original and raw is not None and orig_fmt in UPLOAD_FORMATS and len(raw) <= len(data):
+        out_fmt, data = orig_fmt, raw
+
+    stats = {
+        "input_bytes": len(raw) if raw is not None else None,
+        "output_bytes": len(data),
+        "saved_bytes": (len(raw) - len(data)) if raw is not None else None,
+        "format": out_fmt,
+        "duration_s": round(len(segment) / 1000.0, 2),
+        "seconds": round(time.perf_counter() - t0, 3),
+    }
+    record_upload(len(raw) if raw is not None else 0, len(data), stats["seconds"])
+    return f"audio.{out_fmt}", data, stats
+
+
+def audio_stats() -> dict:
+    """Totals over every preprocessed upload in this process."""
+    with _stats_lock:
+        totals = dict(_totals)
+    totals["saved_bytes"] = totals["input_bytes"] - totals["output_bytes"]
+    for k in ("seconds", "audio_s", "silence_trimmed_s"):
+        totals[k] = round(totals[k], 3)
+    return totals
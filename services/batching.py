@@ -0,0 +1,133 @@
+# services/batching.py
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Sequence
+
+import config
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def get_encoder():
+    """tiktoken encoder if installed, else False (use the character heuristic)."""
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                try:
+                    import tiktoken
+                    _encoder = tiktoken.get_encoding("cl100k_base")
+                except Exception:
+                    _encoder = False
+    return _encoder
+
+
+def estimate_tokens(text: str) -> int:
+    """Token count for `text`; exact with tiktoken, otherwise ~4 characters per token."""
+    enc = get_encoder()
+    if enc:
+        return len(enc.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def pack_batches(texts: Sequence[str], max_tokens: int = config.EMBEDDING_BATCH_MAX_TOKENS,
+                 max_items: int = config.EMBEDDING_BATCH_MAX_ITEMS) -> List[List[int]]:
+    """
+    Greedily pack `texts` (in order) into batches of indices that stay under both
+    `max_tokens` and `max_items`. A single text larger than `max_tokens` gets a
+    batch of its own.
+    """
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    for i, t in enumerate(texts):
+        n = estimate_tokens(t)
+        if current and (current_tokens + n > max_tokens or len(current) >= max_items):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += n
+    if current:
+        batches.append(current)
+    return batches
+
+
+def is_rate_limit_error(exc: BaseException) -> bool:
+    """True for HTTP 429s, whether from the OpenAI SDK or a fake client."""
+    if getattr(exc, "status_code", None) == 429:
+        return True
+    response = getattr(exc, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return True
+    return type(exc).__name__ == "RateLimitError"
+
+
+def _retry_after(exc: BaseException) -> Optional[float]:
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def call_with_backoff(fn: Callable[[], Any], max_retries: int = config.EMBEDDING_MAX_RETRIES,
+                      base_delay: float = config.EMBEDDING_BACKOFF_BASE,
+                      max_delay: float = config.EMBEDDING_BACKOFF_MAX,
+                      sleep: Callable[[float], None] = time.sleep) -> Any:
+    """
+    Call `fn`, retrying on rate-limit errors with exponential backoff and jitter
+    (or the server's Retry-After when given). Other errors propagate immediately.
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt >= max_retries:
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = min(max_delay, base_delay * (2 ** attempt)) * (0.5 + random.random() / 2)
+            attempt += 1
+            sleep(delay)
+
+
+def run_batched(embed_batch: Callable[[List[str]], List[Any]], texts: Sequence[str],
+                max_tokens: int = config.EMBEDDING_BATCH_MAX_TOKENS,
+                max_items: int = config.EMBEDDING_BATCH_MAX_ITEMS,
+                max_workers: int = config.EMBEDDING_BATCH_WORKERS,
+                max_retries: int = config.EMBEDDING_MAX_RETRIES,
+                sleep: Callable[[float], None] = time.sleep) -> List[Any]:
+    """
+    Split `texts` into request-sized batches, run `embed_batch` on them through
+    a bounded thread pool (with 429 backoff per batch), and return one result
+    per input text, in input order.
+    """
+    texts = list(texts)
+    if not texts:
+        return []
+    batches = pack_batches(texts, max_tokens=max_tokens, max_items=max_items)
+
+    def _run(idx: List[int]) -> List[Any]:
+        part = [texts[i] for i in idx]
+        out = call_with_backoff(lambda: embed_batch(part), max_retries=max_retries, sleep=sleep)
+        if len(out) != len(part):
+            raise RuntimeError(f"Batch returned {len(out)} results for {len(part)} inputs.")
+        return out
+
+    if len(batches) == 1 or max_workers <= 1:
+        parts = [_run(b) for b in batches]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as pool:
+            parts = list(pool.map(_run, batches))
+
+    results: List[Any] = [None] * len(texts)
+    for idx, out in zip(batches, parts):
+        for i, r in zip(idx, out):
+            results[i] = r
+    return results
@@ -1,126 +1,113 @@
+from bisect import bisect_left
+from typing import Iterable, Iterator, List, Union
 
-import re
+import config
+from services.batching import get_encoder
 
-def split_text_into_chunks(text, max_len=600, overlap=100):
+# break points tried (in order) near the end of a window, so words stay whole
+_SEPARATORS = ["\n", ". ", " "]
+# how far back from the window end to look for a break point
+_BOUNDARY_FRACTION = 0.2
+
+
+def iter_chunks(pieces: Iterable[str], max_len: int = config.CHUNK_MAX_LEN,
+                overlap: int = config.CHUNK_OVERLAP, unit: str = config.CHUNK_UNIT) -> Iterator[str]:
     """
-    Split text into chunks of roughly max_len characters, with `overlap` characters
-    of context preserved between chunks.
-    
-    This is a simplified equivalent of a RecursiveCharacterTextSplitter.
-    It tries to split by paragraphs, then sentences, then spaces.
+    Lazily split a stream of text pieces into chunks of at most `max_len` units
+    (characters, or tokens with unit="tokens"), with `overlap` units of context
+    repeated between consecutive chunks.
+
+    Each window is cut at the last newline / sentence end / space in its final
+    fifth, so words are not split. Only the unchunked remainder (less than one
+    window) is held between pieces, so memory is bounded and total work is
+    linear in the length of the input, however it is split up.
+
+    Token sizing uses tiktoken when installed and otherwise assumes ~4
+    characters per token (like services.batching.estimate_tokens).
     """
-    if not text:
-        return []
+    if overlap >= max_len:
+        # a window's worth of overlap leaves no room to advance; as before, the
+        # chunks then simply don't overlap
+        overlap = 0
+    enc = None
+    if unit == "tokens":
+        enc = get_encoder()
+        if not enc:
+            enc, max_len, overlap = None, max_len * 4, overlap * 4
+    elif unit != "chars":
+        raise ValueError(f"Unknown chunk unit '{unit}'. Use 'chars' or 'tokens'.")
+
+    # pieces are joined once at least a window's worth has arrived, so many
+    # small pieces don't each pay for copying the remainder
+    window_chars = max_len * 4 if enc else max_len
+    remainder = ""
+    pending: List[str] = []
+    pending_len = 0
+    for piece in pieces:
+        if not piece:
+            continue
+        pending.append(piece)
+        pending_len += len(piece)
+        if pending_len > window_chars:
+            buf = remainder + "".join(pending)
+            pending, pending_len = [], 0
+            remainder = yield from _cut(buf, max_len, overlap, enc, final=False)
+    buf = remainder + "".join(pending)
+    if buf:
+        yield from _cut(buf, max_len, overlap, enc, final=True)
+
 
-    # naive list of separators to try in order
-    separators = ["\n\n", "\n", ". ", " ", ""]
-    
-    final_chunks = []
-    
-    # We will process a queue of text blocks
-    # Initially, it's just the whole text
-    # If a block is too big, we split it by the first separator that works
-    
-    def _split(text_block):
-        if len(text_block) <= max_len:
-            return [text_block]
-        
-        # Try finding a separator that gives us balanced splits
-        for sep in separators:
-            if sep == "":
-                # Fallback: strict character slicing
-                # We can't split by separator, so we just take the first max_len chars
-                # But we need to be careful to loop.
-                # Actually, simpler to just force slice
-                chunks = []
-                start = 0
-                while start < len(text_block):
-                    end = min(start + max_len, len(text_block))
-                    chunks.append(text_block[start:end])
-                    start = end - overlap # move back for overlap
-                    if start >= len(text_block): break # avoid infinite loop if overlap >= max_len
-                    # safeguard
-                    if start < 0: start = 0
-                return chunks
+def _cut(buf: str, max_len: int, overlap: int, enc, final: bool):
+    """
+    Yield the chunks of `buf` whose windows lie entirely inside it (all of
+    them if `final`) and return the text the next window starts at.
+    """
+    if enc:
+        toks = enc.encode(buf, disallowed_special=())
+        offsets = enc.decode_with_offsets(toks)[1]
+        n = len(toks)
+    else:
+        offsets = None
+        n = len(buf)
 
-            # Check if this separator actually exists in the block
-            if sep in text_block:
-                parts = text_block.split(sep)
-                # Now merge parts back until they fill a chunk
-                merged = []
-                current_chunk = ""
-                
-                for p in parts:
-                    prefix = sep if current_chunk else "" # add separator back if inside chunk
-                    candidate = current_chunk + prefix + p
-                    
-                    if len(candidate) <= max_len:
-                        current_chunk = candidate
-                    else:
-                        if current_chunk:
-                            merged.append(current_chunk)
-                        
-                        # Start new chunk
-                        # Ideally we want overlap.
-                        # Overlap is tricky in this simple accumulation loop.
-                        # Simple approach: keep the last 'overlap' chars of current_chunk 
-                        # and prepend to the next one? 
-                        # For simplicity in this bespoke function, let's just push current_chunk
-                        # and start new with 'p'. 
-                        # To support proper overlap, we need a sliding window over the *tokens* or *chars*.
-                        
-                        current_chunk = p
-                
-                if current_chunk:
-                    merged.append(current_chunk)
-                    
-                return merged
-        return [text_block]
+    def pos(t):  # unit index -> character offset in buf
+        if offsets is None:
+            return t
+        return offsets[t] if t < n else len(buf)
 
-    # The above recursive-ish logic is hard to perfect in one go without the class
-    # Let's use a simpler sliding window approach that is robust.
-    
-    chunks = []
     start = 0
-    text_len = len(text)
-    
-    while start < text_len:
-        end = start + max_len
-        
-        # If we are not at the end, try to find a natural break point (space or newline)
-        # to avoid cutting words in half
-        if end < text_len:
-            # Look for the last space/dot within the range [start+max_len*0.8, end]
-            # so we don't shrink chunk too much.
-            boundary_search_start = max(start, int(end - (max_len * 0.2)))
-            slice_to_search = text[boundary_search_start:end]
-            
-            # Find last newline or space
-            last_space = -1
-            for sep in ["\n", ". ", " "]:
-                idx = slice_to_search.rfind(sep)
+    while (n - start > max_len) or (final and start < n):
+        end = min(start + max_len, n)
+        if end < n:
+            lo = max(start, int(end - max_len * _BOUNDARY_FRACTION))
+            lo_char, end_char = pos(lo), pos(end)
+            for sep in _SEPARATORS:
+                idx = buf.rfind(sep, lo_char, end_char)
                 if idx != -1:
-                    last_space = boundary_search_start + idx + len(sep) # include the separator in this chunk
+                    cut = idx + len(sep)  # keep the separator in this chunk
+                    cut = cut if offsets is None else min(bisect_left(offsets, cut), end)
+                    if cut > start:
+                        end = cut
                     break
-            
-            if last_space != -1:
-                end = last_space
-        
-        chunk = text[start:end].strip()
+        chunk = buf[pos(start):pos(end)].strip()
         if chunk:
-            chunks.append(chunk)
-        
-        # Move start pointer
-        # We want the next chunk to start `difference` characters back from `end`
-        # actually: next_start = end - overlap
-        start = end - overlap
-        
-        # Safety check to ensure progress
-        if start <= (end - max_len): # deadlock check
-             start = end 
-        
-        # Initial start cannot be negative
-        if start < 0:
-            start = 0
-            
-    return chunks
+            yield chunk
+        if end >= n:
+            start = n
+            break
+        # next window starts `overlap` units back, but always moves forward
+        start = max(end - overlap, start + 1)
+    return buf[pos(start):]
+
+
+def split_text_into_chunks(text: Union[str, Iterable[str]], max_len: int = config.CHUNK_MAX_LEN,
+                           overlap: int = config.CHUNK_OVERLAP, unit: str = config.CHUNK_UNIT) -> List[str]:
+    """
+    Split text (a string or an iterable of pieces) into overlapping chunks; see
+    iter_chunks.
+    """
+    if not text:
+        return []
+    if isinstance(text, str):
+        text = [text]
+    return list(iter_chunks(text, max_len=max_len, overlap=overlap, unit=unit))
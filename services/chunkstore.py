@@ -0,0 +1,501 @@
+# services/chunkstore.py
+"""
+Columnar, memory-mapped storage for KB chunks.
+
+A snapshot holds every chunk as columns plus title and source dictionaries:
+
+    chunks.txt           UTF-8 text of all chunks, back to back
+    chunks.offsets.npy   int64[n + 1] byte offsets into chunks.txt
+    chunks.titles.npy    int32[n] index into titles.json
+    chunks.ids.npy       int64[n] stable chunk ids (ascending; FAISS labels)
+    chunks.sources.npy   int32[n] index into sources.json
+    chunks.dates.npy     int64[n] when the chunk's document was recorded
+                         (unix seconds; 0 if unknown)
+    titles.json          distinct titles
+    sources.json         distinct sources (e.g. "upload", "microphone", "live")
+    chunks.vectors.npy   float32[n, dim] exact vectors (only for KBs whose index
+                         stores lossy codes; see VectorColumn)
+
+Opening maps the files instead of reading them, so it costs the same for any
+KB size, and looking up a hit is a slice of the blob. Chunks appended since
+the snapshot (replayed from the write-ahead log) live in a small in-memory
+tail until the next compaction writes them out.
+"""
+import json
+import mmap
+import os
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+BLOB_FILE = "chunks.txt"
+OFFSETS_FILE = "chunks.offsets.npy"
+TITLE_IDS_FILE = "chunks.titles.npy"
+TITLES_FILE = "titles.json"
+IDS_FILE = "chunks.ids.npy"
+SOURCE_IDS_FILE = "chunks.sources.npy"
+SOURCES_FILE = "sources.json"
+DATES_FILE = "chunks.dates.npy"
+VECTORS_FILE = "chunks.vectors.npy"
+
+# bytes copied per write when streaming the mapped blob into a new snapshot
+_COPY_BLOCK = 16 * 1024 * 1024
+
+
+def has_chunk_store(directory: Path) -> bool:
+    # offsets are written last, so their presence marks a complete store
+    return (Path(directory) / OFFSETS_FILE).exists()
+
+
+def to_timestamp(value) -> Optional[int]:
+    """Unix seconds for a timestamp, datetime, date or ISO date string (naive = UTC); None stays None."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return int(value.timestamp())
+    if isinstance(value, date):
+        return int(datetime(value.year, value.month, value.day, tzinfo=timezone.utc).timestamp())
+    return int(value)
+
+
+def _day_of(value) -> Optional[date]:
+    """The day `value` names if it is a date or a date-only ISO string, else None."""
+    if isinstance(value, str):
+        try:
+            return date.fromisoformat(value.strip())
+        except ValueError:
+            return None
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return value
+    return None
+
+
+def _as_list(value) -> Optional[list]:
+    if value is None:
+        return None
+    return [value] if isinstance(value, str) else list(value)
+
+
+class ChunkStore:
+    """
+    Read-mostly sequence of {'id', 'title', 'text', 'source', 'date'} chunks:
+    mapped base + in-memory tail. Ids are assigned in increasing order and
+    never reused, so they stay valid across compactions that drop deleted chunks.
+    """
+
+    def __init__(self, directory: Optional[Path] = None, next_id: Optional[int] = None):
+        self._blob = None
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._title_ids = np.zeros(0, dtype=np.int32)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._titles: List[Optional[str]] = []
+        self._source_ids = None
+        self._dates = None
+        self._sources: List[Optional[str]] = [None]
+        if directory is not None and has_chunk_store(directory):
+            directory = Path(directory)
+            with open(directory / TITLES_FILE, "r", encoding="utf-8") as f:
+                self._titles = json.load(f)
+            self._offsets = np.load(directory / OFFSETS_FILE, mmap_mode="r")
+            self._title_ids = np.load(directory / TITLE_IDS_FILE, mmap_mode="r")
+            if (directory / IDS_FILE).exists():
+                self._ids = np.load(directory / IDS_FILE, mmap_mode="r")
+            else:
+                # stores written before ids existed: id == position
+                self._ids = np.arange(len(self._title_ids), dtype=np.int64)
+            if (directory / SOURCE_IDS_FILE).exists():
+                with open(directory / SOURCES_FILE, "r", encoding="utf-8") as f:
+                    self._sources = json.load(f)
+                self._source_ids = np.load(directory / SOURCE_IDS_FILE, mmap_mode="r")
+                self._dates = np.load(directory / DATES_FILE, mmap_mode="r")
+            if int(self._offsets[-1]) > 0:
+                with open(directory / BLOB_FILE, "rb") as f:
+                    self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._title_index: Dict[Optional[str], int] = {t: i for i, t in enumerate(self._titles)}
+        self._source_index: Dict[Optional[str], int] = {s: i for i, s in enumerate(self._sources)}
+        self._base_len = len(self._title_ids)
+        if self._source_ids is None:
+            # stores written before chunk attributes: no source (id 0 is None), no date
+            self._source_ids = np.zeros(self._base_len, dtype=np.int32)
+            self._dates = np.zeros(self._base_len, dtype=np.int64)
+        self._tail_texts: List[str] = []
+        self._tail_title_ids: List[int] = []
+        self._tail_ids: List[int] = []
+        self._tail_source_ids: List[int] = []
+        self._tail_dates: List[int] = []
+        last = int(self._ids[-1]) + 1 if self._base_len else 0
+        self.next_id = max(last, next_id or 0)
+
+    @classmethod
+    def from_docs(cls, docs: Iterable[dict]) -> "ChunkStore":
+        """In-memory store holding `docs` (e.g. when migrating a legacy metadata.pkl)."""
+        store = cls()
+        store.extend(docs)
+        return store
+
+    # ---- sequence protocol ----
+    def __len__(self) -> int:
+        return self._base_len + len(self._tail_texts)
+
+    def __getitem__(self, i: int) -> dict:
+        return {'id': self.id(i), 'title': self.title(i), 'text': self.text(i),
+                'source': self.source(i), 'date': self.date(i)}
+
+    def __iter__(self) -> Iterator[dict]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def _check(self, i: int) -> int:
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError(i)
+        return i
+
+    def text(self, i: int) -> str:
+        i = self._check(i)
+        if i >= self._base_len:
+            return self._tail_texts[i - self._base_len]
+        start, end = int(self._offsets[i]), int(self._offsets[i + 1])
+        return self._blob[start:end].decode("utf-8") if end > start else ""
+
+    def title(self, i: int) -> Optional[str]:
+        i = self._check(i)
+        if i >= self._base_len:
+            return self._titles[self._tail_title_ids[i - self._base_len]]
+        return self._titles[int(self._title_ids[i])]
+
+    def id(self, i: int) -> int:
+        i = self._check(i)
+        if i >= self._base_len:
+            return self._tail_ids[i - self._base_len]
+        return int(self._ids[i])
+
+    def source(self, i: int) -> Optional[str]:
+        i = self._check(i)
+        if i >= self._base_len:
+            return self._sources[self._tail_source_ids[i - self._base_len]]
+        return self._sources[int(self._source_ids[i])]
+
+    def date(self, i: int) -> Optional[int]:
+        i = self._check(i)
+        ts = self._tail_dates[i - self._base_len] if i >= self._base_len else int(self._dates[i])
+        return ts or None
+
+    def texts(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self.text(i)
+
+    def ids(self) -> np.ndarray:
+        """All chunk ids, in position order."""
+        return np.concatenate([np.asarray(self._ids[:self._base_len], dtype=np.int64),
+                               np.asarray(self._tail_ids, dtype=np.int64)])
+
+    def positions(self, ids) -> np.ndarray:
+        """Positions of `ids` (vectorized binary search); -1 for ids not in the store."""
+        ids = np.asarray(ids, dtype=np.int64)
+        out = np.full(ids.shape, -1, dtype=np.int64)
+        for col, offset in ((self._ids[:self._base_len], 0),
+                            (np.asarray(self._tail_ids, dtype=np.int64), self._base_len)):
+            if not len(col):
+                continue
+            pos = np.minimum(np.searchsorted(col, ids), len(col) - 1)
+            found = np.asarray(col[pos]) == ids
+            out[found] = pos[found] + offset
+        return out
+
+    def ids_for_title(self, title: Optional[str]) -> np.ndarray:
+        """Ids of every chunk whose title is `title`."""
+        tid = self._title_index.get(title)
+        if tid is None:
+            return np.zeros(0, dtype=np.int64)
+        base = np.asarray(self._ids[:self._base_len])[np.asarray(self._title_ids[:self._base_len]) == tid]
+        tail = [cid for cid, t in zip(self._tail_ids, self._tail_title_ids) if t == tid]
+        return np.concatenate([base.astype(np.int64), np.asarray(tail, dtype=np.int64)])
+
+    def _column(self, base, tail, dtype) -> np.ndarray:
+        return np.concatenate([np.asarray(base[:self._base_len], dtype=dtype), np.asarray(tail, dtype=dtype)])
+
+    def mask(self, title=None, source=None, since=None, until=None) -> np.ndarray:
+        """
+        Boolean mask over positions of the chunks matching every given
+        attribute: `title` / `source` (a value or a list of them), recorded
+        `since` / `until` (inclusive; see to_timestamp). Unset means any. An
+        `until` without a time of day covers the whole of that day.
+        """
+        keep = np.ones(len(self), dtype=bool)
+        for values, index, base, tail in ((title, self._title_index, self._title_ids, self._tail_title_ids),
+                                          (source, self._source_index, self._source_ids,
+                                           self._tail_source_ids)):
+            values = _as_list(values)
+            if values is not None:
+                wanted = [index[v] for v in values if v in index]
+                keep &= np.isin(self._column(base, tail, np.int32), wanted)
+        if since is not None or until is not None:
+            dates = self._column(self._dates, self._tail_dates, np.int64)
+            if since is not None:
+                keep &= dates >= to_timestamp(since)
+            if until is not None:
+                day = _day_of(until)
+                if day is not None:
+                    keep &= (dates < to_timestamp(day + timedelta(days=1))) & (dates > 0)
+                else:
+                    keep &= (dates <= to_timestamp(until)) & (dates > 0)
+        return keep
+
+    def distinct(self, attribute: str, mask: Optional[np.ndarray] = None) -> List[Optional[str]]:
+        """Distinct values of 'title' or 'source' among the chunks in `mask` (default: all)."""
+        if attribute == 'title':
+            values, ids = self._titles, self._column(self._title_ids, self._tail_title_ids, np.int32)
+        else:
+            values, ids = self._sources, self._column(self._source_ids, self._tail_source_ids, np.int32)
+        if mask is not None:
+            ids = ids[mask]
+        return [values[i] for i in np.unique(ids).tolist()]
+
+    # ---- writes ----
+    def _source_id(self, source: Optional[str]) -> int:
+        sid = self._source_index.get(source)
+        if sid is None:
+            sid = len(self._sources)
+            self._sources.append(source)
+            self._source_index[source] = sid
+        return sid
+
+    def _title_id(self, title: Optional[str]) -> int:
+        tid = self._title_index.get(title)
+        if tid is None:
+            tid = len(self._titles)
+            self._titles.append(title)
+            self._title_index[title] = tid
+        return tid
+
+    def append(self, doc: dict) -> int:
+        """Append a chunk, keeping doc['id'] if given; returns the chunk's id."""
+        cid = doc.get('id')
+        cid = self.next_id if cid is None else int(cid)
+        self.next_id = max(self.next_id, cid + 1)
+        self._tail_texts.append(doc.get('text') or '')
+        self._tail_title_ids.append(self._title_id(doc.get('title')))
+        self._tail_ids.append(cid)
+        self._tail_source_ids.append(self._source_id(doc.get('source')))
+        self._tail_dates.append(to_timestamp(doc.get('date')) or 0)
+        return cid
+
+    def extend(self, docs: Iterable[dict]) -> List[int]:
+        return [self.append(doc) for doc in docs]
+
+    def snapshot(self) -> "ChunkStore":
+        """Frozen view of the current contents that later appends don't affect."""
+        view = ChunkStore.__new__(ChunkStore)
+        view._blob = self._blob
+        view._offsets = self._offsets
+        view._title_ids = self._title_ids
+        view._ids = self._ids
+        view._tail_ids = list(self._tail_ids)
+        view.next_id = self.next_id
+        view._titles = list(self._titles)
+        view._title_index = dict(self._title_index)
+        view._base_len = self._base_len
+        view._tail_texts = list(self._tail_texts)
+        view._tail_title_ids = list(self._tail_title_ids)
+        view._source_ids = self._source_ids
+        view._dates = self._dates
+        view._sources = list(self._sources)
+        view._source_index = dict(self._source_index)
+        view._tail_source_ids = list(self._tail_source_ids)
+        view._tail_dates = list(self._tail_dates)
+        return view
+
+    def rebase(self, directory: Path, n_written: int) -> "ChunkStore":
+        """
+        Store backed by the snapshot just written to `directory` (holding our first
+        `n_written` chunks), plus whatever was appended here after that point.
+        """
+        store = ChunkStore(directory, next_id=self.next_id)
+        for i in range(n_written, len(self)):
+            store.append(self[i])
+        return store
+
+    def write(self, directory: Path, keep: Optional[np.ndarray] = None):
+        """
+        Write the chunks as a columnar snapshot in `directory` (fsynced; offsets
+        last). `keep` is an optional boolean mask over positions; chunks outside
+        it (e.g. deleted ones) are left out.
+        """
+        directory = Path(directory)
+        title_ids = np.concatenate([
+            np.asarray(self._title_ids[:self._base_len], dtype=np.int32),
+            np.asarray(self._tail_title_ids, dtype=np.int32),
+        ])
+        ids = self.ids()
+        source_ids = self._column(self._source_ids, self._tail_source_ids, np.int32)
+        dates = self._column(self._dates, self._tail_dates, np.int64)
+
+        if keep is None:
+            base_bytes = int(self._offsets[self._base_len])
+            tail_bytes = [t.encode("utf-8") for t in self._tail_texts]
+            with open(directory / BLOB_FILE, "wb") as f:
+                if self._blob is not None and base_bytes:
+                    for start in range(0, base_bytes, _COPY_BLOCK):
+                        f.write(self._blob[start:min(start + _COPY_BLOCK, base_bytes)])
+                for b in tail_bytes:
+                    f.write(b)
+                f.flush()
+                os.fsync(f.fileno())
+            tail_offsets = base_bytes + np.cumsum([len(b) for b in tail_bytes], dtype=np.int64)
+            offsets = np.concatenate([np.asarray(self._offsets[:self._base_len + 1], dtype=np.int64),
+                                      tail_offsets])
+        else:
+            keep = np.asarray(keep, dtype=bool)
+            kept = np.flatnonzero(keep)
+            lengths = np.zeros(len(kept), dtype=np.int64)
+            with open(directory / BLOB_FILE, "wb") as f:
+                for j, i in enumerate(kept):
+                    if i < self._base_len:
+                        data = self._blob[int(self._offsets[i]):int(self._offsets[i + 1])] if self._blob else b""
+                    else:
+                        data = self._tail_texts[i - self._base_len].encode("utf-8")
+                    f.write(data)
+                    lengths[j] = len(data)
+                f.flush()
+                os.fsync(f.fileno())
+            offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+            title_ids, ids = title_ids[kept], ids[kept]
+            source_ids, dates = source_ids[kept], dates[kept]
+
+        with open(directory / TITLES_FILE, "w", encoding="utf-8") as f:
+            json.dump(self._titles, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(directory / SOURCES_FILE, "w", encoding="utf-8") as f:
+            json.dump(self._sources, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        _save_npy(directory / TITLE_IDS_FILE, title_ids)
+        _save_npy(directory / IDS_FILE, ids)
+        _save_npy(directory / SOURCE_IDS_FILE, source_ids)
+        _save_npy(directory / DATES_FILE, dates)
+        _save_npy(directory / OFFSETS_FILE, offsets)
+
+    def nbytes(self) -> int:
+        """Resident size; the mapped base is page cache, so only the tail and titles count."""
+        size = sum(len(t) for t in self._tail_texts) + 32 * len(self._tail_title_ids)
+        size += sum(len(t or '') + 50 for t in self._titles + self._sources)
+        return size
+
+
+def has_vector_column(directory: Path) -> bool:
+    return (Path(directory) / VECTORS_FILE).exists()
+
+
+class VectorColumn:
+    """
+    Exact float32 vectors by chunk position: mapped base + in-memory tail, kept
+    in step with a ChunkStore. Used to re-rank hits from a quantized index, so
+    only the rows of the candidates are ever paged in.
+    """
+
+    def __init__(self, directory: Optional[Path] = None, dim: Optional[int] = None):
+        self._base = None
+        self.dim = dim
+        if directory is not None and has_vector_column(directory):
+            self._base = np.load(Path(directory) / VECTORS_FILE, mmap_mode="r")
+            self.dim = self._base.shape[1]
+        self._base_len = 0 if self._base is None else len(self._base)
+        self._tail: List[np.ndarray] = []
+        self._tail_len = 0
+        self._tail_rows = None  # concatenated tail, rebuilt after appends
+
+    @classmethod
+    def from_array(cls, vecs: np.ndarray) -> "VectorColumn":
+        """Column whose base is `vecs` (e.g. a memmap of freshly re-embedded vectors)."""
+        col = cls(dim=vecs.shape[1] if vecs.ndim == 2 else None)
+        col._base = vecs
+        col._base_len = len(vecs)
+        return col
+
+    def __len__(self) -> int:
+        return self._base_len + self._tail_len
+
+    def append(self, vecs: np.ndarray):
+        vecs = np.asarray(vecs, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vecs.shape[1]
+        if vecs.ndim != 2 or vecs.shape[1] != self.dim:
+            # e.g. vectors from another model awaiting a re-index; never re-ranked
+            vecs = np.zeros((len(vecs), self.dim), dtype=np.float32)
+        if len(vecs):
+            self._tail.append(vecs)
+            self._tail_len += len(vecs)
+            self._tail_rows = None
+
+    def _tail_array(self) -> np.ndarray:
+        if self._tail_rows is None:
+            self._tail_rows = (np.concatenate(self._tail) if self._tail
+                               else np.zeros((0, self.dim or 0), dtype=np.float32))
+            self._tail = [self._tail_rows] if self._tail_len else []
+        return self._tail_rows
+
+    def rows(self, positions) -> np.ndarray:
+        positions = np.asarray(positions, dtype=np.int64)
+        out = np.empty((len(positions), self.dim or 0), dtype=np.float32)
+        in_base = positions < self._base_len
+        if in_base.any():
+            out[in_base] = self._base[positions[in_base]]
+        if not in_base.all():
+            out[~in_base] = self._tail_array()[positions[~in_base] - self._base_len]
+        return out
+
+    def array(self) -> np.ndarray:
+        """Every row (the mapped base is copied into memory)."""
+        base = np.asarray(self._base[:self._base_len]) if self._base_len else None
+        tail = self._tail_array()
+        return tail if base is None else np.concatenate([base, tail])
+
+    def snapshot(self) -> "VectorColumn":
+        view = VectorColumn(dim=self.dim)
+        view._base, view._base_len = self._base, self._base_len
+        view._tail_rows = self._tail_array()
+        view._tail = [view._tail_rows] if self._tail_len else []
+        view._tail_len = self._tail_len
+        return view
+
+    def rebase(self, directory: Path, n_written: int) -> "VectorColumn":
+        col = VectorColumn(directory, dim=self.dim)
+        if n_written < len(self):
+            col.append(self.rows(np.arange(n_written, len(self))))
+        return col
+
+    def write(self, directory: Path, keep: Optional[np.ndarray] = None):
+        """Write the column to `directory` (fsynced), optionally only the rows in `keep`."""
+        positions = np.arange(len(self)) if keep is None else np.flatnonzero(keep)
+        if not len(positions):
+            _save_npy(Path(directory) / VECTORS_FILE, np.zeros((0, self.dim or 0), dtype=np.float32))
+            return
+        out = np.lib.format.open_memmap(Path(directory) / VECTORS_FILE, mode="w+",
+                                        dtype=np.float32, shape=(len(positions), self.dim or 0))
+        for start in range(0, len(positions), 65536):
+            block = positions[start:start + 65536]
+            out[start:start + len(block)] = self.rows(block)
+        out.flush()
+        del out
+        with open(Path(directory) / VECTORS_FILE, "rb") as f:
+            os.fsync(f.fileno())
+
+    def nbytes(self) -> int:
+        return self._tail_len * (self.dim or 0) * 4
+
+
+def _save_npy(path: Path, arr: np.ndarray):
+    with open(path, "wb") as f:
+        np.save(f, arr)
+        f.flush()
+        os.fsync(f.fileno())
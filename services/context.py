@@ -0,0 +1,137 @@
+# services/context.py
+"""
+Prompt context for answer_query.
+
+Retrieval over-fetches candidates (CONTEXT_OVERFETCH x top_k); pack_context
+then picks a relevant but non-redundant subset with maximal marginal
+relevance over the chunks' stored vectors, merges chunks that are adjacent in
+the same document (removing the text the chunker repeats between them), and
+stops at CONTEXT_TOKEN_BUDGET tokens.
+"""
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+
+import config
+from services.batching import estimate_tokens
+
+# shortest repeated text treated as chunker overlap when merging neighbours
+_MIN_OVERLAP_CHARS = 20
+
+
+def mmr_order(query_vector: np.ndarray, vectors: np.ndarray, k: int,
+              lambda_: float = config.CONTEXT_MMR_LAMBDA) -> List[int]:
+    """
+    Indices of up to `k` rows of `vectors` in maximal-marginal-relevance order:
+    each pick maximizes lambda * sim(query, v) - (1 - lambda) * max sim(v, picked),
+    with cosine similarities.
+    """
+    n = len(vectors)
+    if n == 0 or k <= 0:
+        return []
+    unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    q = np.asarray(query_vector, dtype='float32').reshape(-1)
+    relevance = unit @ (q / max(float(np.linalg.norm(q)), 1e-12))
+    pairwise = unit @ unit.T
+    redundancy = np.full(n, -np.inf, dtype='float32')
+    picked = np.zeros(n, dtype=bool)
+    order = []
+    for _ in range(min(k, n)):
+        score = lambda_ * relevance - (1.0 - lambda_) * np.maximum(redundancy, 0.0)
+        score[picked] = -np.inf
+        best = int(np.argmax(score))
+        order.append(best)
+        picked[best] = True
+        redundancy = np.maximum(redundancy, pairwise[best])
+    return order
+
+
+def merge_overlap(a: str, b: str) -> str:
+    """`a` followed by `b`, without the text `b` repeats from the end of `a`."""
+    for k in range(min(len(a), len(b)), _MIN_OVERLAP_CHARS - 1, -1):
+        if a.endswith(b[:k]):
+            return a + b[k:]
+    return a + " " + b
+
+
+def _merge_runs(docs: List[dict]) -> List[Tuple[List[dict], str]]:
+    """Group docs into runs of consecutive chunk ids of one title; (members, merged text) per run."""
+    runs: List[Tuple[List[dict], str]] = []
+    for d in sorted(docs, key=lambda d: (str(d.get('title')), d['id'])):
+        if runs:
+            members, text = runs[-1]
+            last = members[-1]
+            if last.get('title') == d.get('title') and d['id'] == last['id'] + 1:
+                runs[-1] = (members + [d], merge_overlap(text, d['text']))
+                continue
+        runs.append(([d], d['text']))
+    return runs
+
+
+def pack_context(candidates: List[dict], top_k: int, query_vector: Optional[np.ndarray] = None,
+                 vectors: Optional[np.ndarray] = None,
+                 token_budget: int = config.CONTEXT_TOKEN_BUDGET,
+                 lambda_: float = config.CONTEXT_MMR_LAMBDA) -> Tuple[str, List[dict], dict]:
+    """
+    Choose up to `top_k` of `candidates` (query results, best first) for the
+    prompt and join them within `token_budget` tokens.
+
+    With the query vector and the candidates' stored `vectors`, candidates are
+    taken in MMR order, otherwise in retrieval order; a candidate that would
+    overflow the budget is skipped in favour of later, shorter ones. Chosen
+    chunks adjacent in the same document are merged into one passage.
+
+    Returns (context text, chosen candidates, stats), where stats compares
+    the context with joining the plain top_k results.
+    """
+    naive = candidates[:top_k]
+    naive_tokens = estimate_tokens("\n\n".join(d['text'] for d in naive))
+    mergeable = all(d.get('id') is not None for d in candidates)
+    if query_vector is not None and vectors is not None and len(vectors) == len(candidates):
+        order = mmr_order(query_vector, vectors, len(candidates), lambda_)
+    else:
+        order = list(range(len(candidates)))
+
+    chosen: List[dict] = []
+    rank = {}
+    context, used = "", 0
+    for i in order:
+        if len(chosen) >= top_k:
+            break
+        trial = chosen + [candidates[i]]
+        text = _join(trial, {**rank, id(candidates[i]): len(rank)}, mergeable)
+        tokens = estimate_tokens(text)
+        if tokens > token_budget:
+            continue
+        chosen, context, used = trial, text, tokens
+        rank[id(candidates[i])] = len(rank)
+
+    stats = {
+        "candidates": len(candidates),
+        "chosen": len(chosen),
+        "passages": len(_merge_runs(chosen)) if mergeable and chosen else len(chosen),
+        "context_tokens": used,
+        "naive_tokens": naive_tokens,
+        "saved_tokens": naive_tokens - used,
+    }
+    return context, chosen, stats
+
+
+def _join(docs: List[dict], rank: dict, mergeable: bool) -> str:
+    """Passages of `docs` (merged runs when possible), most relevant first."""
+    if not mergeable:
+        return "\n\n".join(d['text'] for d in docs)
+    runs = _merge_runs(docs)
+    runs.sort(key=lambda run: min(rank[id(d)] for d in run[0]))
+    return "\n\n".join(text for _, text in runs)
+
+
+def candidate_vectors(kb: Any, candidates: List[dict]) -> Optional[np.ndarray]:
+    """Stored vectors of the candidates, or None if the KB can't provide them."""
+    if not candidates or not hasattr(kb, 'chunk_vectors') or any(d.get('id') is None for d in candidates):
+        return None
+    try:
+        return kb.chunk_vectors([d['id'] for d in candidates])
+    except Exception as e:
+        print(f"[context] stored vectors unavailable, using retrieval order: {e}")
+        return None
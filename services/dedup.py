@@ -0,0 +1,120 @@
+# services/dedup.py
+"""
+Ingest-time duplicate detection for KB chunks.
+
+Two text signatures are kept per chunk:
+
+- a content hash of the normalized text (lowercased words), catching exact
+  repeats such as the same upload sent twice;
+- a 64-bit SimHash over word shingles, catching near-duplicates (repeated
+  recordings, re-transcriptions). Two chunks are near-duplicates when their
+  SimHashes differ in at most `max_distance` bits; splitting the hash into
+  max_distance + 1 bands guarantees such a pair shares at least one band, so
+  lookups only compare against chunks in the same band buckets.
+
+KB.add_document additionally drops chunks whose embedding is almost identical
+to one already in the index (see DEDUP_EMBEDDING_THRESHOLD). Chunks are
+checked against every live chunk of the KB: a passage repeated by another
+document (e.g. a second recording of the same talk) is stored once and the
+KB records both documents as its owners, so removing one keeps it for the
+other.
+"""
+import hashlib
+import re
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import config
+
+_WORD_RE = re.compile(r"\w+")
+_MASK = (1 << 64) - 1
+_BIT_SHIFTS = np.arange(64, dtype=np.uint64)
+
+Signature = Tuple[int, int]  # (content hash, simhash)
+
+
+def _words(text: str) -> List[str]:
+    return _WORD_RE.findall((text or "").lower())
+
+
+def content_hash(text: str) -> int:
+    """64-bit hash of the text with case, punctuation and spacing normalized away."""
+    digest = hashlib.blake2b(" ".join(_words(text)).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def simhash(text: str, shingle: int = 3) -> int:
+    """64-bit SimHash of the text's distinct word `shingle`-grams."""
+    words = _words(text)
+    if not words:
+        return 0
+    # distinct shingles, so a phrase repeated throughout doesn't outvote the rest
+    grams = list({" ".join(words[i:i + shingle]) for i in range(max(1, len(words) - shingle + 1))})
+    # hash() is salted per process; signatures are never persisted, only rebuilt
+    h = np.fromiter((hash(g) & _MASK for g in grams), dtype=np.uint64, count=len(grams))
+    bits = ((h[:, None] >> _BIT_SHIFTS) & np.uint64(1)).astype(np.int32)
+    votes = bits.sum(axis=0) * 2 - len(grams)
+    return int(np.packbits((votes > 0)[::-1]).view('>u8')[0])
+
+
+def signature(text: str) -> Signature:
+    return content_hash(text), simhash(text)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class Deduper:
+    """Signatures of a set of chunks, looked up by exact hash and SimHash bands."""
+
+    def __init__(self, max_distance: int = config.DEDUP_SIMHASH_DISTANCE):
+        self.max_distance = max_distance
+        self._n_bands = max_distance + 1
+        self._band_bits = 64 // self._n_bands
+        self._exact: Dict[int, List[int]] = {}
+        self._bands: List[Dict[int, List[Tuple[int, int]]]] = [{} for _ in range(self._n_bands)]
+
+    def _band_keys(self, sh: int):
+        width = self._band_bits
+        for b in range(self._n_bands):
+            yield b, (sh >> (b * width)) & ((1 << width) - 1)
+
+    def add(self, sig: Signature, cid: int):
+        exact, sh = sig
+        self._exact.setdefault(exact, []).append(cid)
+        for b, key in self._band_keys(sh):
+            self._bands[b].setdefault(key, []).append((sh, cid))
+
+    def match(self, sig: Signature, is_live: Callable[[int], bool]) -> Optional[Tuple[str, int]]:
+        """Return ("exact" or "near", chunk id) if a live chunk duplicates `sig`, else None."""
+        exact, sh = sig
+        for cid in self._exact.get(exact, ()):
+            if is_live(cid):
+                return "exact", cid
+        for b, key in self._band_keys(sh):
+            for other, cid in self._bands[b].get(key, ()):
+                if hamming(sh, other) <= self.max_distance and is_live(cid):
+                    return "near", cid
+        return None
+
+    def find_duplicates(self, sigs: Sequence[Signature],
+                        is_live: Callable[[int], bool]) -> List[Optional[Tuple[str, Optional[int]]]]:
+        """
+        For each signature, (why, chunk id) if it duplicates a live chunk here
+        ("exact" / "near"), (why, None) if it repeats an earlier entry of
+        `sigs`, or None to keep it.
+        """
+        batch = Deduper(self.max_distance)
+        found = []
+        for i, sig in enumerate(sigs):
+            dup = self.match(sig, is_live)
+            if dup is None:
+                repeat = batch.match(sig, lambda _: True)
+                if repeat is None:
+                    batch.add(sig, i)
+                else:
+                    dup = repeat[0], None
+            found.append(dup)
+        return found
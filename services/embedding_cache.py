@@ -0,0 +1,213 @@
+# services/embedding_cache.py
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+import config
+
+
+def cache_key(model: str, text: str) -> bytes:
+    """Content address for an embedding: sha256 over (model name, text)."""
+    h = hashlib.sha256()
+    h.update(model.encode("utf-8"))
+    h.update(b"\0")
+    h.update(text.encode("utf-8"))
+    return h.digest()
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache keyed by (model name, hash of text).
+
+    - memory tier: LRU of float32 vectors, bounded by item count
+    - disk tier: sqlite table, bounded by row count, evicting least recently used
+
+    Either tier can be disabled by setting its limit to 0.
+    """
+
+    def __init__(self, path: Optional[Path] = config.EMBEDDING_CACHE_PATH,
+                 max_memory_items: int = config.EMBEDDING_CACHE_MEMORY_ITEMS,
+                 max_disk_items: int = config.EMBEDDING_CACHE_DISK_ITEMS):
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self._mem: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._db = None
+        self._disk_rows = 0
+        if path is not None and max_disk_items > 0:
+            try:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(str(path), check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    " key BLOB PRIMARY KEY, model TEXT, dim INTEGER, vec BLOB, last_used REAL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings(last_used)")
+                self._db.commit()
+                self._disk_rows = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            except Exception as e:
+                print(f"[embedding_cache] disk tier disabled: {e}")
+                self._db = None
+
+    # ---- memory tier ----
+    def _mem_get(self, key: bytes) -> Optional[np.ndarray]:
+        vec = self._mem.get(key)
+        if vec is not None:
+            self._mem.move_to_end(key)
+        return vec
+
+    def _mem_put(self, key: bytes, vec: np.ndarray):
+        if self.max_memory_items <= 0:
+            return
+        self._mem[key] = vec
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_memory_items:
+            self._mem.popitem(last=False)
+
+    # ---- disk tier ----
+    def _disk_get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        if self._db is None or not keys:
+            return {}
+        found = {}
+        # stay well under sqlite's bound-parameter limit
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            marks = ",".join("?" * len(part))
+            rows = self._db.execute(
+                f"SELECT key, vec FROM embeddings WHERE key IN ({marks})", part
+            ).fetchall()
+            for key, blob in rows:
+                found[bytes(key)] = np.frombuffer(blob, dtype=np.float32)
+        if found:
+            now = time.time()
+            self._db.executemany("UPDATE embeddings SET last_used=? WHERE key=?",
+                                 [(now, k) for k in found])
+            self._db.commit()
+        return found
+
+    def _disk_put_many(self, model: str, items: List[tuple]):
+        if self._db is None or not items:
+            return
+        now = time.time()
+        cur = self._db.executemany(
+            "INSERT OR IGNORE INTO embeddings(key, model, dim, vec, last_used) VALUES (?,?,?,?,?)",
+            [(k, model, int(v.shape[0]), v.tobytes(), now) for k, v in items],
+        )
+        self._disk_rows += max(cur.rowcount, 0)
+        overflow = self._disk_rows - self.max_disk_items
+        if overflow > 0:
+            self._db.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (overflow,)
+            )
+            self._disk_rows -= overflow
+            self.evictions += overflow
+        self._db.commit()
+
+    # ---- public API ----
+    def get_or_compute(self, model: str, texts: List[str],
+                       compute: Callable[[List[str]], List[List[float]]]) -> List[List[float]]:
+        """
+        Return embeddings for `texts`, calling `compute` only for texts not cached
+        under `model`. Duplicate texts within one call are embedded once.
+        """
+        keys = [cache_key(model, t) for t in texts]
+        out: List[Optional[np.ndarray]] = [None] * len(texts)
+
+        with self._lock:
+            pending = []
+            for i, k in enumerate(keys):
+                vec = self._mem_get(k)
+                if vec is not None:
+                    out[i] = vec
+                    self.memory_hits += 1
+                else:
+                    pending.append(i)
+            if pending:
+                try:
+                    from_disk = self._disk_get_many(list({keys[i] for i in pending}))
+                except Exception as e:
+                    print(f"[embedding_cache] disk read failed: {e}")
+                    from_disk = {}
+                still_missing = []
+                for i in pending:
+                    vec = from_disk.get(keys[i])
+                    if vec is not None:
+                        out[i] = vec
+                        self._mem_put(keys[i], vec)
+                        self.disk_hits += 1
+                    else:
+                        still_missing.append(i)
+                pending = still_missing
+
+        if pending:
+            # first occurrence of each missing key is what gets embedded
+            unique: "OrderedDict[bytes, int]" = OrderedDict()
+            for i in pending:
+                unique.setdefault(keys[i], i)
+            computed = compute([texts[i] for i in unique.values()])
+            if len(computed) != len(unique):
+                raise RuntimeError(
+                    f"Embedding backend returned {len(computed)} vectors for {len(unique)} texts."
+                )
+            fresh = {k: np.asarray(v, dtype=np.float32) for k, v in zip(unique, computed)}
+            with self._lock:
+                self.misses += len(pending)
+                for k, v in fresh.items():
+                    self._mem_put(k, v)
+                try:
+                    self._disk_put_many(model, list(fresh.items()))
+                except Exception as e:
+                    print(f"[embedding_cache] disk write failed: {e}")
+            for i in pending:
+                out[i] = fresh[keys[i]]
+
+        return [v.tolist() for v in out]
+
+    def clear(self):
+        with self._lock:
+            self._mem.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM embeddings")
+                self._db.commit()
+                self._disk_rows = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_items": len(self._mem),
+                "disk_items": self._disk_rows,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+            }
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Return the process-wide embedding cache."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache()
+    return _cache
@@ -1,62 +1,229 @@
 # services/embeddings.py
-from typing import List, Optional, Union
+import threading
+import time
+from typing import List, Optional, Tuple, Union
 from services.utils import get_openai_client
+from services.embedding_cache import get_embedding_cache
+from services.batching import run_batched
 import config
 
-def get_embeddings(texts: List[str]) -> List[List[float]]:
+
+class LocalEmbedder:
     """
-    Return list of embeddings for the provided texts.
-    Uses OpenAI embeddings when OPENAI_API_KEY is set, otherwise falls back
-    to sentence-transformers (local).
-    """
-    client = get_openai_client()
-    if client:
-        # Use OpenAI client (v1+)
-        try:
-            resp = client.embeddings.create(model=config.DEFAULT_EMBEDDING_MODEL, input=texts)
-            # The response may be object-like or dict-like. Try both.
-            data = getattr(resp, "data", None)
-            
-            # Fallback dict access
-            if data is None and hasattr(resp, "get"):
-                 data = resp.get("data", None)
-
-            embeddings = []
-            if data:
-                for item in data:
-                    # item may be an object with .embedding or a dict with ['embedding']
-                    emb = getattr(item, "embedding", None)
-                    if emb is None and isinstance(item, dict):
-                        emb = item.get("embedding")
-                    if emb is not None:
-                        embeddings.append(emb)
-            
-            # Fallback if no data shape matched
-            if not embeddings:
-                 # try raw dict-style access for safety if above failed mysteriously
-                 try:
-                    # assuming resp might be a dict
-                    if isinstance(resp, dict):
-                         embeddings = [d["embedding"] for d in resp["data"]]
-                 except Exception:
-                     # If data extraction failed entirely
-                     pass
-
-            if embeddings:
-                return embeddings
-            else:
-                 raise RuntimeError("Unexpected OpenAI embeddings response shape.")
-                 
-        except Exception as e:
-            # If the OpenAI call fails, fall back to local embedding model
-            print(f"[embeddings] OpenAI embeddings failed, falling back locally: {e}")
-    
+    Process-wide sentence-transformers model.
+
+    The model is loaded once on first use (or by `warm`) and shared by every
+    Streamlit session and thread in the process. Load and encode timings are
+    kept so they can be surfaced in diagnostics.
+    """
+
+    def __init__(self, model_name: str = config.LOCAL_EMBEDDING_MODEL,
+                 batch_size: int = config.LOCAL_EMBEDDING_BATCH_SIZE,
+                 num_threads: int = config.LOCAL_EMBEDDING_THREADS):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self._model = None
+        self._warm_thread: Optional[threading.Thread] = None
+        self._load_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.load_time: Optional[float] = None
+        self.encode_calls = 0
+        self.encoded_texts = 0
+        self.encode_time = 0.0
+        self.last_encode_time: Optional[float] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def load(self):
+        """Load the model if needed and return it. Raises ImportError if unavailable."""
+        if self._model is not None:
+            return self._model
+        with self._load_lock:
+            if self._model is None:
+                from sentence_transformers import SentenceTransformer
+                if self.num_threads:
+                    import torch
+                    torch.set_num_threads(self.num_threads)
+                t0 = time.perf_counter()
+                model = SentenceTransformer(self.model_name)
+                self.load_time = time.perf_counter() - t0
+                print(f"[embeddings] loaded {self.model_name} in {self.load_time:.2f}s")
+                self._model = model
+        return self._model
+
+    def warm(self, background: bool = False):
+        """Load the model now, optionally in a daemon thread so startup is not blocked."""
+        def _load():
+            try:
+                self.load()
+            except ImportError:
+                print("[embeddings] sentence-transformers not found. Skipping warm-up.")
+            except Exception as e:
+                print(f"[embeddings] warm-up failed: {e}")
+
+        if background:
+            if self._warm_thread is not None and self._warm_thread.is_alive():
+                return self._warm_thread
+            self._warm_thread = threading.Thread(target=_load, name="local-embedder-warmup", daemon=True)
+            self._warm_thread.start()
+            return self._warm_thread
+        _load()
+        return None
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        model = self.load()
+        t0 = time.perf_counter()
+        emb = model.encode(texts, batch_size=self.batch_size, show_progress_bar=False)
+        elapsed = time.perf_counter() - t0
+        with self._stats_lock:
+            self.encode_calls += 1
+            self.encoded_texts += len(texts)
+            self.encode_time += elapsed
+            self.last_encode_time = elapsed
+        return emb.tolist()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "model": self.model_name,
+                "loaded": self.loaded,
+                "load_time_s": self.load_time,
+                "batch_size": self.batch_size,
+                "num_threads": self.num_threads,
+                "encode_calls": self.encode_calls,
+                "encoded_texts": self.encoded_texts,
+                "encode_time_s": round(self.encode_time, 4),
+                "last_encode_time_s": self.last_encode_time,
+            }
+
+
+_local_embedder: Optional[LocalEmbedder] = None
+_local_embedder_lock = threading.Lock()
+
+
+def get_local_embedder() -> LocalEmbedder:
+    """Return the process-wide LocalEmbedder (the model itself is loaded lazily)."""
+    global _local_embedder
+    if _local_embedder is None:
+        with _local_embedder_lock:
+            if _local_embedder is None:
+                _local_embedder = LocalEmbedder()
+    return _local_embedder
+
+
+def warm_local_embeddings(background: bool = True):
+    """Load the local embedding model ahead of the first query."""
+    return get_local_embedder().warm(background=background)
+
+
+def _openai_embed_request(client, texts: List[str], model: str) -> List[List[float]]:
+    """Embed `texts` with one OpenAI embeddings request."""
+    resp = client.embeddings.create(model=model, input=texts)
+    # The response may be object-like or dict-like. Try both.
+    data = getattr(resp, "data", None)
+
+    # Fallback dict access
+    if data is None and hasattr(resp, "get"):
+         data = resp.get("data", None)
+
+    embeddings = []
+    if data:
+        for item in data:
+            # item may be an object with .embedding or a dict with ['embedding']
+            emb = getattr(item, "embedding", None)
+            if emb is None and isinstance(item, dict):
+                emb = item.get("embedding")
+            if emb is not None:
+                embeddings.append(emb)
+
+    # Fallback if no data shape matched
+    if not embeddings:
+         # try raw dict-style access for safety if above failed mysteriously
+         try:
+            # assuming resp might be a dict
+            if isinstance(resp, dict):
+                 embeddings = [d["embedding"] for d in resp["data"]]
+         except Exception:
+             # If data extraction failed entirely
+             pass
+
+    if embeddings:
+        return embeddings
+    else:
+         raise RuntimeError("Unexpected OpenAI embeddings response shape.")
+
+
+def embed_with_openai(client, texts: List[str], model: str = config.DEFAULT_EMBEDDING_MODEL,
+                      **batch_kwargs) -> List[List[float]]:
+    """
+    Embed any number of texts with `client` (anything exposing
+    `.embeddings.create`), packed into token/item-limited requests that run
+    concurrently with 429 backoff. Results come back in input order.
+    """
+    return run_batched(lambda batch: _openai_embed_request(client, batch, model), texts, **batch_kwargs)
+
+
+def active_embedding_model() -> str:
+    """Model `get_embeddings` uses by default: OpenAI when a key is set, else the local model."""
+    if get_openai_client():
+        return config.DEFAULT_EMBEDDING_MODEL
+    return get_local_embedder().model_name
+
+
+def embed_texts(texts: List[str], model: Optional[str] = None) -> Tuple[str, List[List[float]]]:
+    """
+    Like `get_embeddings`, but also returns the name of the model that produced
+    the vectors. With an explicit `model` there is no fallback: a RuntimeError is
+    raised if that model can't be used (e.g. an OpenAI model without a key).
+    """
+    if not texts:
+        return (model or active_embedding_model()), []
+    cache = get_embedding_cache()
+    embedder = get_local_embedder()
+
+    if model is not None and model != embedder.model_name:
+        client = get_openai_client()
+        if client is None:
+            raise RuntimeError(f"Embedding model '{model}' needs OPENAI_API_KEY.")
+        return model, cache.get_or_compute(model, texts,
+                                           lambda missing: embed_with_openai(client, missing, model=model))
+
+    if model is None:
+        client = get_openai_client()
+        if client:
+            # Use OpenAI client (v1+)
+            try:
+                return config.DEFAULT_EMBEDDING_MODEL, cache.get_or_compute(
+                    config.DEFAULT_EMBEDDING_MODEL, texts, lambda missing: embed_with_openai(client, missing))
+            except Exception as e:
+                # If the OpenAI call fails, fall back to local embedding model
+                print(f"[embeddings] OpenAI embeddings failed, falling back locally: {e}")
+
     # Local fallback
     try:
-        from sentence_transformers import SentenceTransformer
-        model = SentenceTransformer(config.LOCAL_EMBEDDING_MODEL)
-        emb = model.encode(texts, show_progress_bar=False)
-        return emb.tolist()
+        return embedder.model_name, cache.get_or_compute(embedder.model_name, texts, embedder.encode)
     except ImportError:
+        if model is not None:
+            raise RuntimeError(f"Embedding model '{model}' needs sentence-transformers installed.")
         print("[embeddings] sentence-transformers not found. Returning empty list.")
-        return []
+        return embedder.model_name, []
+
+
+def get_embeddings(texts: List[str], model: Optional[str] = None) -> List[List[float]]:
+    """
+    Return list of embeddings for the provided texts.
+    Uses OpenAI embeddings when OPENAI_API_KEY is set, otherwise falls back
+    to sentence-transformers (local). Pass `model` to require a specific model.
+
+    Results are served from the embedding cache where possible, so only texts
+    never seen before under the active model are sent to the backend.
+    """
+    return embed_texts(texts, model=model)[1]
+
+
+def embedding_cache_stats() -> dict:
+    """Hit/miss counters for the embedding cache."""
+    return get_embedding_cache().stats()
@@ -0,0 +1,306 @@
+# services/indexes.py
+"""
+FAISS index factory for KBs.
+
+Small KBs stay on an exact flat index; as they grow, "auto" moves them to
+HNSW and then to IVF-PQ. Approximate indexes expose their search-time knobs
+(nprobe for IVF, efSearch for HNSW) per query via `search_params`.
+
+Independently of the kind, a KB picks how vectors are stored: float32
+(exact), float16 or int8 scalar quantization, or PQ codes. Lossy storage is
+2-4x (SQ) or ~20-50x (PQ) smaller; the KB keeps the float32 vectors on disk
+to re-rank the top candidates exactly.
+
+Every KB index is wrapped in an IndexIDMap2 so FAISS labels are stable chunk
+ids rather than positions; deleted ids are excluded at search time with an
+ID selector until compaction drops them.
+"""
+import math
+from typing import Optional, Tuple
+
+import numpy as np
+import faiss
+
+import config
+
+INDEX_KINDS = ("auto", "flat", "hnsw", "ivf", "ivfpq")
+STORAGE_KINDS = ("float32", "float16", "int8", "pq")
+_SQ_TYPES = {
+    "float16": faiss.ScalarQuantizer.QT_fp16,
+    "int8": faiss.ScalarQuantizer.QT_8bit,
+}
+
+
+def choose_index_kind(n_vectors: int) -> str:
+    """Index kind that "auto" resolves to for a KB of `n_vectors` chunks."""
+    if n_vectors < config.KB_FLAT_MAX_VECTORS:
+        return "flat"
+    if n_vectors < config.KB_HNSW_MAX_VECTORS:
+        return "hnsw"
+    return "ivfpq"
+
+
+def inner(index):
+    """The index doing the actual search (unwrapped from its id map)."""
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def has_ids(index) -> bool:
+    return isinstance(index, faiss.IndexIDMap)
+
+
+def _storage_of(codes) -> str:
+    if isinstance(codes, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "float16" if codes.sq.qtype == _SQ_TYPES["float16"] else "int8"
+    if isinstance(codes, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return "pq"
+    return "float32"
+
+
+def index_storage(index) -> Optional[str]:
+    """How an existing index stores its vectors (None if there is no index)."""
+    if index is None:
+        return None
+    index = inner(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return _storage_of(faiss.downcast_index(index.storage))
+    return _storage_of(index)
+
+
+def index_kind(index) -> Optional[str]:
+    """Kind of an existing index (None if there is no index)."""
+    if index is None:
+        return None
+    index = inner(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+
+def target_kind(setting: Optional[str], n_vectors: int) -> str:
+    """Resolve a KB's configured kind ("auto" or explicit) for its current size."""
+    if not setting or setting == "auto":
+        return choose_index_kind(n_vectors)
+    if setting not in INDEX_KINDS:
+        raise ValueError(f"Unknown index kind '{setting}'. Choose from {INDEX_KINDS}.")
+    return setting
+
+
+def resolve(kind: str, storage: Optional[str]) -> Tuple[str, str]:
+    """
+    (kind, storage) actually built for a resolved kind and a storage setting.
+    IVF with PQ codes is IVF-PQ, and IVF-PQ always stores PQ codes.
+    """
+    storage = storage or "float32"
+    if storage not in STORAGE_KINDS:
+        raise ValueError(f"Unknown vector storage '{storage}'. Choose from {STORAGE_KINDS}.")
+    if kind == "ivf" and storage == "pq":
+        kind = "ivfpq"
+    if kind == "ivfpq":
+        storage = "pq"
+    return kind, storage
+
+
+def is_lossy(storage: Optional[str]) -> bool:
+    return (storage or "float32") != "float32"
+
+
+def _nlist(n_vectors: int) -> int:
+    return int(min(config.KB_IVF_MAX_NLIST, max(16, 4 * math.sqrt(max(n_vectors, 1)))))
+
+
+def _pq_m(dim: int) -> int:
+    """Largest sub-quantizer count <= KB_PQ_M that divides dim."""
+    for m in range(min(config.KB_PQ_M, dim), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def min_train_size(kind: str, n_vectors: int, storage: str = "float32") -> int:
+    size = 0
+    if kind == "ivf":
+        size = _nlist(n_vectors)
+    if kind == "ivfpq":
+        size = max(_nlist(n_vectors), 256)
+    if storage == "int8":
+        size = max(size, config.KB_SQ_MIN_TRAIN)
+    if storage == "pq":
+        size = max(size, 256)
+    return size
+
+
+def buildable(kind: str, storage: Optional[str], n_vectors: int) -> Tuple[str, str]:
+    """
+    (kind, storage) that can be built with `n_vectors` training vectors: storage
+    that needs more training data falls back to float32, and IVF kinds to flat.
+    """
+    kind, storage = resolve(kind, storage)
+    if kind != "ivfpq" and n_vectors < min_train_size(kind, n_vectors, storage):
+        storage = "float32"
+    if kind in ("ivf", "ivfpq") and n_vectors < min_train_size(kind, n_vectors):
+        kind = "flat"
+        storage = "float32"
+    return kind, storage
+
+
+def train_sample(vecs: np.ndarray, max_size: int = config.KB_TRAIN_SAMPLE, seed: int = 0) -> np.ndarray:
+    """Uniform random sample of rows used to train IVF / PQ quantizers."""
+    if len(vecs) <= max_size:
+        return vecs
+    rows = np.random.default_rng(seed).choice(len(vecs), size=max_size, replace=False)
+    return vecs[np.sort(rows)]
+
+
+def build_index(kind: str, dim: int, vecs: Optional[np.ndarray] = None, storage: str = "float32"):
+    """
+    Create an empty id-mapped index of `kind` storing vectors as `storage`,
+    trained on `vecs` if it needs training. Falls back to flat / float32 when
+    there are too few vectors to train on (see `buildable`).
+    """
+    return faiss.IndexIDMap2(_build_inner(kind, dim, vecs, storage))
+
+
+def _build_inner(kind: str, dim: int, vecs: Optional[np.ndarray] = None, storage: str = "float32"):
+    n = 0 if vecs is None else len(vecs)
+    kind, storage = buildable(kind, storage, n)
+
+    if kind == "hnsw":
+        if storage == "pq":
+            index = faiss.IndexHNSWPQ(dim, _pq_m(dim), config.KB_HNSW_M)
+        elif storage in _SQ_TYPES:
+            index = faiss.IndexHNSWSQ(dim, _SQ_TYPES[storage], config.KB_HNSW_M)
+        else:
+            index = faiss.IndexHNSWFlat(dim, config.KB_HNSW_M)
+        index.hnsw.efConstruction = config.KB_HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = config.KB_HNSW_EF_SEARCH
+    elif kind in ("ivf", "ivfpq"):
+        nlist = _nlist(n)
+        quantizer = faiss.IndexFlatL2(dim)
+        if kind == "ivfpq":
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_m(dim), 8)
+        elif storage in _SQ_TYPES:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, _SQ_TYPES[storage])
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        index.nprobe = config.KB_IVF_NPROBE
+    elif storage == "pq":
+        index = faiss.IndexPQ(dim, _pq_m(dim), 8)
+    elif storage in _SQ_TYPES:
+        index = faiss.IndexScalarQuantizer(dim, _SQ_TYPES[storage])
+    else:
+        index = faiss.IndexFlatL2(dim)
+    if not index.is_trained:
+        index.train(np.ascontiguousarray(train_sample(vecs), dtype='float32'))
+    return index
+
+
+def ids_of(index, start: int = 0) -> np.ndarray:
+    """Chunk ids of the vectors at positions [start, ntotal)."""
+    if has_ids(index):
+        return faiss.vector_to_array(index.id_map)[start:].astype('int64')
+    return np.arange(start, index.ntotal, dtype='int64')
+
+
+def vectors_of(index, start: int = 0) -> np.ndarray:
+    """
+    Vectors at positions [start, ntotal) (exact for flat/HNSW, decoded
+    approximations for PQ).
+    """
+    base = inner(index)
+    if base.ntotal <= start:
+        return np.zeros((0, base.d), dtype='float32')
+    ivf = faiss.try_extract_index_ivf(base)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return base.reconstruct_n(start, base.ntotal - start)
+
+
+def vectors_for_ids(index, ids) -> np.ndarray:
+    """Vectors stored under chunk ids `ids` (decoded approximations for lossy codes)."""
+    ids = np.asarray(ids, dtype='int64')
+    if len(ids) == 0:
+        return np.zeros((0, index.d), dtype='float32')
+    ivf = faiss.try_extract_index_ivf(inner(index))
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+    return np.stack([index.reconstruct(int(i)) for i in ids]).astype('float32')
+
+
+def all_vectors(index) -> np.ndarray:
+    if index is None:
+        return np.zeros((0, 0), dtype='float32')
+    return vectors_of(index)
+
+
+def copy_vectors(src, dst, start: int = 0, vecs: Optional[np.ndarray] = None):
+    """
+    Add src's vectors from position `start` on to `dst`, keeping their ids.
+    `vecs` optionally supplies exact vectors for those positions.
+    """
+    if vecs is None:
+        vecs = vectors_of(src, start)
+    if len(vecs):
+        dst.add_with_ids(np.ascontiguousarray(vecs, dtype='float32'), ids_of(src, start))
+
+
+def rebuild_index(index, kind: str, drop_ids: Optional[np.ndarray] = None,
+                  storage: str = "float32", vecs: Optional[np.ndarray] = None):
+    """
+    Return a new id-mapped index of `kind` / `storage` holding the same vectors
+    and ids as `index` (which may be a legacy index without ids), minus
+    `drop_ids`. `vecs` optionally supplies exact vectors in index order, for
+    indexes that only hold approximations.
+    """
+    ids = ids_of(index)
+    vecs = vectors_of(index) if vecs is None else np.asarray(vecs, dtype='float32')
+    if drop_ids is not None and len(drop_ids):
+        keep = ~np.isin(ids, drop_ids)
+        vecs, ids = vecs[keep], ids[keep]
+    new_index = build_index(kind, index.d, vecs, storage)
+    if len(vecs):
+        new_index.add_with_ids(vecs, ids)
+    return new_index
+
+
+def exclude_selector(ids: np.ndarray):
+    """ID selector matching everything except `ids` (None if there is nothing to exclude)."""
+    if ids is None or not len(ids):
+        return None
+    batch = faiss.IDSelectorBatch(np.ascontiguousarray(ids, dtype='int64'))
+    sel = faiss.IDSelectorNot(batch)
+    sel.referenced_batch = batch  # IDSelectorNot doesn't own its inner selector
+    return sel
+
+
+def include_selector(ids: np.ndarray, id_bound: int):
+    """ID selector matching only `ids` (all below `id_bound`), as a bitmap over 0..id_bound-1."""
+    bits = np.zeros(max(int(id_bound), 1), dtype=bool)
+    bits[np.asarray(ids, dtype='int64')] = True
+    bitmap = np.packbits(bits, bitorder='little')
+    sel = faiss.IDSelectorBitmap(len(bits), faiss.swig_ptr(bitmap))
+    sel.referenced_bitmap = bitmap  # the selector only points at the bitmap
+    return sel
+
+
+def search_params(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None, sel=None):
+    """
+    Per-query search parameters for `index`, or None to use the index defaults.
+    `sel` restricts the search to the ids it selects. The caller must keep
+    `sel` alive for as long as the returned parameters are used.
+    """
+    kind = index_kind(index)
+    kwargs = {"sel": sel} if sel is not None else {}
+    if kind in ("ivf", "ivfpq") and (nprobe or sel is not None):
+        return faiss.SearchParametersIVF(nprobe=int(nprobe or inner(index).nprobe), **kwargs)
+    if kind == "hnsw" and (ef_search or sel is not None):
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search or inner(index).hnsw.efSearch), **kwargs)
+    if sel is not None:
+        return faiss.SearchParameters(**kwargs)
+    return None
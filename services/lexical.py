@@ -0,0 +1,267 @@
+# services/lexical.py
+"""
+BM25 inverted index over KB chunks, stored next to the chunk store.
+
+A snapshot holds the postings in CSR form, with chunk positions as document
+numbers (the same positions as the chunk store and the KB's exact vectors):
+
+    lexical.terms.json    vocabulary; a term's id is its index
+    lexical.indptr.npy    int64[n_terms + 1] start of each term's postings
+    lexical.docs.npy      int32[nnz] chunk positions, ascending within a term
+    lexical.tfs.npy       uint16[nnz] term frequency in that chunk
+    lexical.lengths.npy   int32[n] length of each chunk in tokens
+
+Like the chunk store, the files are memory-mapped and chunks added since the
+snapshot are kept in a small in-memory tail until the next compaction.
+"""
+import json
+import math
+import os
+import re
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+import config
+
+TERMS_FILE = "lexical.terms.json"
+INDPTR_FILE = "lexical.indptr.npy"
+DOCS_FILE = "lexical.docs.npy"
+TFS_FILE = "lexical.tfs.npy"
+LENGTHS_FILE = "lexical.lengths.npy"
+
+_WORD_RE = re.compile(r"\w+")
+_TF_MAX = np.iinfo(np.uint16).max
+
+
+def tokenize(text: str) -> List[str]:
+    return _WORD_RE.findall((text or "").lower())
+
+
+def has_lexical_index(directory: Path) -> bool:
+    # indptr is written last, so its presence marks a complete index
+    return (Path(directory) / INDPTR_FILE).exists()
+
+
+class LexicalIndex:
+    """Postings by term for chunk positions 0..n-1: mapped CSR base + in-memory tail."""
+
+    def __init__(self, directory: Optional[Path] = None):
+        self._term_list: List[str] = []
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._docs = np.zeros(0, dtype=np.int32)
+        self._tfs = np.zeros(0, dtype=np.uint16)
+        self._lengths = np.zeros(0, dtype=np.int32)
+        if directory is not None and has_lexical_index(directory):
+            directory = Path(directory)
+            with open(directory / TERMS_FILE, "r", encoding="utf-8") as f:
+                self._term_list = json.load(f)
+            self._docs = np.load(directory / DOCS_FILE, mmap_mode="r")
+            self._tfs = np.load(directory / TFS_FILE, mmap_mode="r")
+            self._lengths = np.load(directory / LENGTHS_FILE, mmap_mode="r")
+            self._indptr = np.load(directory / INDPTR_FILE, mmap_mode="r")
+        self._terms: Dict[str, int] = {t: i for i, t in enumerate(self._term_list)}
+        self._base_terms = len(self._term_list)
+        self._base_len = len(self._lengths)
+        # term id -> ([positions], [tfs]) for chunks added since the snapshot
+        self._tail: Dict[int, Tuple[List[int], List[int]]] = {}
+        self._tail_lengths: List[int] = []
+        self._total_tokens = int(np.asarray(self._lengths, dtype=np.int64).sum())
+
+    @classmethod
+    def from_texts(cls, texts: Iterable[str]) -> "LexicalIndex":
+        index = cls()
+        index.extend(texts)
+        return index
+
+    def __len__(self) -> int:
+        return self._base_len + len(self._tail_lengths)
+
+    # ---- writes ----
+    def add(self, text: str) -> int:
+        """Index the next chunk position; returns it."""
+        pos = len(self)
+        tokens = tokenize(text)
+        counts: Dict[str, int] = {}
+        for t in tokens:
+            counts[t] = counts.get(t, 0) + 1
+        for term, tf in counts.items():
+            tid = self._terms.get(term)
+            if tid is None:
+                tid = len(self._term_list)
+                self._term_list.append(term)
+                self._terms[term] = tid
+            docs, tfs = self._tail.setdefault(tid, ([], []))
+            docs.append(pos)
+            tfs.append(min(tf, _TF_MAX))
+        self._tail_lengths.append(len(tokens))
+        self._total_tokens += len(tokens)
+        return pos
+
+    def extend(self, texts: Iterable[str]):
+        for text in texts:
+            self.add(text)
+
+    # ---- reads ----
+    def term_id(self, term: str) -> Optional[int]:
+        return self._terms.get(term)
+
+    def postings(self, tid: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(positions, tfs) of term `tid`, ascending by position."""
+        if tid < self._base_terms:
+            start, end = int(self._indptr[tid]), int(self._indptr[tid + 1])
+            docs, tfs = np.asarray(self._docs[start:end]), np.asarray(self._tfs[start:end])
+        else:
+            docs, tfs = np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint16)
+        tail = self._tail.get(tid)
+        if tail:
+            docs = np.concatenate([docs, np.asarray(tail[0], dtype=np.int32)])
+            tfs = np.concatenate([tfs, np.asarray(tail[1], dtype=np.uint16)])
+        return docs, tfs
+
+    def lengths(self, positions: np.ndarray) -> np.ndarray:
+        positions = np.asarray(positions, dtype=np.int64)
+        out = np.zeros(len(positions), dtype=np.float32)
+        base = positions < self._base_len
+        out[base] = np.asarray(self._lengths)[positions[base]] if self._base_len else 0
+        if len(self._tail_lengths):
+            out[~base] = np.asarray(self._tail_lengths, dtype=np.float32)[positions[~base] - self._base_len]
+        return out
+
+    def search(self, query: str, k: int, excluded: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+               k1: float = config.BM25_K1, b: float = config.BM25_B) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top `k` chunk positions by BM25 score for `query`, best first, as
+        (positions, scores). `excluded` maps an array of positions to a mask of
+        those to leave out (e.g. deleted chunks).
+        """
+        n = len(self)
+        tids = sorted({tid for tid in (self._terms.get(t) for t in tokenize(query)) if tid is not None})
+        if n == 0 or not tids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        avgdl = max(self._total_tokens / n, 1e-9)
+        all_docs, all_scores = [], []
+        for tid in tids:
+            docs, tfs = self.postings(tid)
+            if not len(docs):
+                continue
+            df = len(docs)
+            idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+            tf = tfs.astype(np.float32)
+            norm = k1 * (1.0 - b + b * self.lengths(docs) / avgdl)
+            all_docs.append(docs)
+            all_scores.append(idf * tf * (k1 + 1.0) / (tf + norm))
+        if not all_docs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        docs, inverse = np.unique(np.concatenate(all_docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores)).astype(np.float32)
+        if excluded is not None:
+            keep = ~excluded(docs)
+            docs, scores = docs[keep], scores[keep]
+        if len(docs) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            docs, scores = docs[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return docs[order].astype(np.int64), scores[order]
+
+    # ---- snapshots ----
+    def snapshot(self) -> "LexicalIndex":
+        """Frozen view of the current contents that later adds don't affect."""
+        view = LexicalIndex.__new__(LexicalIndex)
+        view.__dict__.update(self.__dict__)
+        view._term_list = list(self._term_list)
+        view._terms = dict(self._terms)
+        view._tail = {tid: (list(d), list(t)) for tid, (d, t) in self._tail.items()}
+        view._tail_lengths = list(self._tail_lengths)
+        return view
+
+    def rebase(self, directory: Path, n_written: int) -> "LexicalIndex":
+        """
+        Index backed by the snapshot just written to `directory` (holding our
+        first `n_written` chunks, compacted), plus the chunks added after that.
+        """
+        index = LexicalIndex(directory)
+        shift = len(index) - n_written
+        tail_terms = [(self._term_list[tid], d, t) for tid, (d, t) in self._tail.items()]
+        index._tail_lengths = self.lengths(np.arange(n_written, len(self))).astype(int).tolist()
+        index._total_tokens += int(sum(index._tail_lengths))
+        for term, docs, tfs in tail_terms:
+            for pos, tf in zip(docs, tfs):
+                if pos < n_written:
+                    continue
+                tid = index._terms.get(term)
+                if tid is None:
+                    tid = len(index._term_list)
+                    index._term_list.append(term)
+                    index._terms[term] = tid
+                d, t = index._tail.setdefault(tid, ([], []))
+                d.append(pos + shift)
+                t.append(tf)
+        return index
+
+    def write(self, directory: Path, keep: Optional[np.ndarray] = None):
+        """
+        Write the postings as a CSR snapshot in `directory` (fsynced; indptr
+        last). `keep` is an optional boolean mask over positions; chunks outside
+        it are left out and the rest renumbered, as in ChunkStore.write.
+        """
+        directory = Path(directory)
+        n_terms = len(self._term_list)
+        counts = np.diff(np.asarray(self._indptr, dtype=np.int64))
+        term_col = [np.repeat(np.arange(self._base_terms, dtype=np.int64), counts)]
+        doc_col = [np.asarray(self._docs, dtype=np.int64)]
+        tf_col = [np.asarray(self._tfs, dtype=np.uint16)]
+        for tid, (docs, tfs) in self._tail.items():
+            term_col.append(np.full(len(docs), tid, dtype=np.int64))
+            doc_col.append(np.asarray(docs, dtype=np.int64))
+            tf_col.append(np.asarray(tfs, dtype=np.uint16))
+        terms, docs, tfs = np.concatenate(term_col), np.concatenate(doc_col), np.concatenate(tf_col)
+        lengths = np.concatenate([np.asarray(self._lengths, dtype=np.int32),
+                                  np.asarray(self._tail_lengths, dtype=np.int32)])
+        if keep is not None:
+            keep = np.asarray(keep, dtype=bool)
+            renumber = np.cumsum(keep) - 1
+            live = keep[docs]
+            terms, docs, tfs = terms[live], renumber[docs[live]], tfs[live]
+            lengths = lengths[keep]
+        order = np.lexsort((docs, terms))
+        terms, docs, tfs = terms[order], docs[order], tfs[order]
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(terms, minlength=n_terms))]).astype(np.int64)
+
+        with open(directory / TERMS_FILE, "w", encoding="utf-8") as f:
+            json.dump(self._term_list, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        for name, arr in ((DOCS_FILE, docs.astype(np.int32)), (TFS_FILE, tfs),
+                          (LENGTHS_FILE, lengths), (INDPTR_FILE, indptr)):
+            with open(directory / name, "wb") as f:
+                np.save(f, arr)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def nbytes(self) -> int:
+        """Resident size; the mapped base is page cache, so only the tail and vocabulary count."""
+        size = sum(len(t) + 60 for t in self._term_list)
+        size += sum(8 * len(d) for d, _ in self._tail.values()) + 8 * len(self._tail_lengths)
+        return size
+
+
+def rrf_fuse(rankings: List[np.ndarray], k: int, rrf_k: int = config.KB_RRF_K) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reciprocal-rank fusion of best-first position lists: each position scores
+    sum(1 / (rrf_k + rank)) over the lists it appears in (rank from 1).
+    Returns the top `k` (positions, fused scores), best first.
+    """
+    rankings = [np.asarray(r, dtype=np.int64) for r in rankings if len(r)]
+    if not rankings:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    positions = np.concatenate(rankings)
+    weights = np.concatenate([1.0 / (rrf_k + np.arange(1, len(r) + 1)) for r in rankings])
+    unique, inverse = np.unique(positions, return_inverse=True)
+    scores = np.bincount(inverse, weights=weights)
+    # ties (e.g. rank 1 in one list only vs rank 1 in the other) keep the first list's order
+    first_seen = np.full(len(unique), len(positions), dtype=np.int64)
+    np.minimum.at(first_seen, inverse, np.arange(len(positions)))
+    order = np.lexsort((first_seen, -scores))[:k]
+    return unique[order], scores[order].astype(np.float32)
@@ -0,0 +1,204 @@
+# services/live.py
+"""
+Incremental transcription and indexing of a recording in progress.
+
+A LiveSession takes audio as it arrives (feed), cuts it into windows of about
+LIVE_WINDOW_SECONDS at pauses, and transcribes each window on a worker thread
+while recording continues. Transcript text streams through the chunker into
+the KB as document `title`; text not yet covered by a full chunk is kept
+searchable as a provisional document ("<title> [live]"), rewritten whenever
+the indexer has caught up with the transcript and dropped in the same log
+record as each committed chunk. finish() flushes the last window and the
+chunker remainder and removes the provisional document.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+import config
+from services.audio import decode_audio, downmix, encode_audio, frame_rms, plan_segments, samples_of, speech_frames
+from services.chunker import iter_chunks
+from services.transcribe import drop_overlaps, transcribe_uploads
+from services.utils import get_openai_client
+
+
+class LiveSession:
+    def __init__(self, kb, title: str, client: Any = None,
+                 window_seconds: float = config.LIVE_WINDOW_SECONDS,
+                 search_seconds: float = config.LIVE_SILENCE_SEARCH):
+        self.kb = kb
+        self.title = title
+        self.live_title = f"{title} [live]"
+        # chunk attributes for query filters: every chunk dates from the session start
+        self.started = int(time.time())
+        self.client = client or get_openai_client()
+        if self.client is None:
+            raise ValueError("No OPENAI_API_KEY set — live transcription unavailable.")
+        self.window_seconds = window_seconds
+        self.search_seconds = search_seconds
+
+        self._buffer = None          # downmixed audio not yet sent for transcription
+        self._buffer_start = 0.0     # its offset in the recording (seconds)
+        self._overlapped = False     # whether the buffer repeats the end of the last window
+        self._last_text = ""
+        self._text = ""              # transcript so far, as fed to the chunker
+        self._chunk_from = 0         # where the last committed chunk starts in _text
+        self._covered = 0            # end of the last committed chunk in _text
+        self._provisional = ""       # text of the provisional document in the KB
+        self._lock = threading.Lock()
+        self._finished = False
+        self._pending = 0
+        self.stats = {"windows": 0, "silent_windows": 0, "audio_s": 0.0, "chunks": 0,
+                      "last_latency_s": None, "errors": []}
+
+        # windows are transcribed one at a time and in order; the indexer thread
+        # pulls their text through the chunker and commits chunks as they close
+        self._transcriber = ThreadPoolExecutor(max_workers=1, thread_name_prefix="live-transcribe")
+        self._texts: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._indexer = threading.Thread(target=self._index_loop, name=f"live-index-{title}", daemon=True)
+        self._indexer.start()
+
+    # ---- audio side ----
+    def feed(self, audio):
+        """
+        Add recorded audio (encoded bytes such as a WAV clip, or a pydub
+        AudioSegment). Every full window is queued for transcription.
+        """
+        if self._finished:
+            raise RuntimeError("Live session already finished.")
+        if isinstance(audio, (bytes, bytearray)):
+            audio = decode_audio(bytes(audio))
+        audio = downmix(audio)
+        received = time.perf_counter()
+        with self._lock:
+            self._buffer = audio if self._buffer is None else self._buffer + audio
+            self.stats["audio_s"] += len(audio) / 1000.0
+            self._cut(received, final=False)
+
+    def _cut(self, received: float, final: bool):
+        buf = self._buffer
+        if buf is None or len(buf) == 0:
+            return
+        rate = buf.frame_rate
+        # wait for a little more than a window so the cut can land in a pause
+        if not final and len(buf) / 1000.0 < self.window_seconds + self.search_seconds:
+            return
+        pieces = plan_segments(samples_of(buf), rate, max_seconds=self.window_seconds,
+                               search_seconds=self.search_seconds)
+        ready = pieces if final else pieces[:-1]
+        for i, (start, end, overlapped) in enumerate(ready):
+            window = buf.get_sample_slice(start, end)
+            offset = self._buffer_start + start / rate
+            self._pending += 1
+            self._transcriber.submit(self._transcribe_window, window, offset,
+                                     self._overlapped if i == 0 else overlapped, received)
+        if final:
+            self._buffer = None
+        else:
+            start, _, overlapped = pieces[-1]
+            self._buffer = buf.get_sample_slice(start, None)
+            self._buffer_start += start / rate
+            self._overlapped = overlapped
+
+    def _transcribe_window(self, window, offset: float, overlapped: bool, received: float):
+        try:
+            silent = not speech_frames(frame_rms(samples_of(window), window.frame_rate)).any()
+            with self._lock:
+                self.stats["windows"] += 1
+                self.stats["silent_windows"] += silent
+            if silent:
+                # silence makes the model invent text; nothing to index anyway
+                self._last_text = ""
+                return
+            fmt, data = encode_audio(window)
+            text = transcribe_uploads(self.client, [lambda: (f"audio.{fmt}", data)], max_workers=1)[0]
+            text = drop_overlaps([self._last_text, text], [False, overlapped])[1]
+            self._last_text = text
+            if text:
+                self._texts.put(text + " ")
+            with self._lock:
+                self.stats["last_latency_s"] = round(time.perf_counter() - received, 3)
+        except Exception as e:
+            print(f"[live] window at {offset:.1f}s of '{self.title}' failed: {e}")
+            with self._lock:
+                self.stats["errors"].append(f"{offset:.1f}s: {e}")
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    # ---- text side ----
+    def _pieces(self):
+        while True:
+            if self._texts.empty():
+                # caught up: one provisional rewrite covers every piece that arrived meanwhile
+                self._refresh_provisional()
+            text = self._texts.get()
+            if text is None:
+                return
+            self._text += text
+            yield text
+
+    def _refresh_provisional(self):
+        tail = self._text[self._covered:].strip()
+        if tail == self._provisional:
+            return
+        try:
+            if tail:
+                self.kb.replace_document(self.live_title, tail, source="live", date=self.started)
+            else:
+                self.kb.remove_document(self.live_title)
+            self._provisional = tail
+        except Exception as e:
+            print(f"[live] provisional update for '{self.title}' failed: {e}")
+
+    def _index_loop(self):
+        for chunk in iter_chunks(self._pieces()):
+            at = self._text.find(chunk, self._chunk_from)
+            if at != -1:
+                self._chunk_from = at
+                self._covered = max(self._covered, at + len(chunk))
+            try:
+                # the provisional copy goes in the same log record, so it is
+                # never left behind alongside this chunk
+                self.kb.add_chunks(self.title, [chunk], source="live", date=self.started,
+                                   replace=self.live_title)
+                self._provisional = ""
+                with self._lock:
+                    self.stats["chunks"] += 1
+            except Exception as e:
+                print(f"[live] indexing a chunk of '{self.title}' failed: {e}")
+                with self._lock:
+                    self.stats["errors"].append(str(e))
+
+    # ---- lifecycle ----
+    @property
+    def transcript(self) -> str:
+        return self._text.strip()
+
+    def finish(self, timeout: Optional[float] = None) -> dict:
+        """
+        Transcribe what is left of the recording, commit the remaining text and
+        drop the provisional document. Returns the session stats.
+        """
+        if not self._finished:
+            self._finished = True
+            with self._lock:
+                self._cut(time.perf_counter(), final=True)
+            self._transcriber.shutdown(wait=True)
+            self._texts.put(None)
+        self._indexer.join(timeout)
+        try:
+            self.kb.remove_document(self.live_title)
+        except Exception as e:
+            print(f"[live] removing provisional text of '{self.title}' failed: {e}")
+        return self.status()
+
+    def status(self) -> dict:
+        with self._lock:
+            out = dict(self.stats, errors=list(self.stats["errors"]))
+        out["audio_s"] = round(out["audio_s"], 2)
+        out["pending_windows"] = self._pending
+        out["finished"] = self._finished and not self._indexer.is_alive()
+        return out
@@ -1,31 +1,139 @@
 # services/rag.py
-from typing import Optional, List, Any, Tuple
+import json
+import threading
+import time
+from typing import Optional, List, Any, Tuple, Iterator
 from services.utils import get_openai_client
+from services.answer_cache import get_answer_cache
+from services.context import candidate_vectors, pack_context
 import config
 
-def answer_query(query: str, kb: Any, top_k: int = config.DEFAULT_RAG_TOP_K) -> Tuple[str, List[Any]]:
+_stats_lock = threading.Lock()
+_totals = {"answers": 0, "streamed": 0, "cached": 0, "ttft_s": 0.0, "total_s": 0.0,
+           "context_tokens": 0, "saved_tokens": 0}
+
+
+def _build_prompt(query: str, context: str) -> str:
+    return (
+        "You are a helpful assistant. Use the context below to answer the question. "
+        "If the answer is not in the context, say you don't know.\n\n"
+        f"CONTEXT:\n{context}\n\n"
+        f"QUESTION:\n{query}\n\n"
+        "Answer:"
+    )
+
+
+def _fallback_answer(docs: List[dict]) -> str:
+    # fallback extractive answer when no API key
+    if docs:
+        return "\n\n".join([d['text'] for d in docs[:2]])
+    return "I don't know. No documents in the selected KB."
+
+
+def _record(metrics: dict, streamed: bool):
+    with _stats_lock:
+        _totals["answers"] += 1
+        _totals["streamed"] += int(streamed)
+        _totals["cached"] += int(bool(metrics.get("cached")))
+        _totals["ttft_s"] += metrics.get("ttft_s") or 0.0
+        _totals["total_s"] += metrics.get("total_s") or 0.0
+        packed = metrics.get("context") or {}
+        _totals["context_tokens"] += packed.get("context_tokens", 0)
+        _totals["saved_tokens"] += packed.get("saved_tokens", 0)
+
+
+def answer_stats() -> dict:
+    """Answer counts and mean latencies over this process."""
+    with _stats_lock:
+        t = dict(_totals)
+    n = t["answers"]
+    return {
+        "answers": n,
+        "streamed": t["streamed"],
+        "cached": t["cached"],
+        "mean_ttft_s": round(t["ttft_s"] / n, 3) if n else None,
+        "mean_total_s": round(t["total_s"] / n, 3) if n else None,
+        "context_tokens": t["context_tokens"],
+        "saved_prompt_tokens": t["saved_tokens"],
+    }
+
+
+class _CacheLookup:
+    """Answer cache lookup for one question: exact match, then by query embedding."""
+
+    def __init__(self, query: str, kb: Any, top_k: int, client: Any, use_cache: bool,
+                 filters: Optional[dict] = None):
+        self.query, self.kb, self.top_k = query, kb, top_k
+        self.filters = filters or None
+        # answers to the same question under different filters are different answers
+        self.scope = json.dumps(self.filters, sort_keys=True, default=str) if self.filters else ""
+        self.model = config.DEFAULT_CHAT_MODEL
+        self.query_vector = None
+        self.hit = None
+        # only model answers are worth caching; KBs without a version can't be
+        self.cache = get_answer_cache() if use_cache and client and hasattr(kb, 'version') else None
+        if self.cache is None:
+            return
+        self.key, self.version = str(getattr(kb, 'path', kb.name)), kb.version
+        self.hit = self.cache.get_exact(self.key, self.version, query, top_k, self.model, self.scope)
+        if self.hit is None and self._embeds():
+            self.query_vector = kb.embed_query(query)
+            self.hit = self.cache.get_similar(self.key, self.version, self.query_vector, top_k, self.model,
+                                              self.scope)
+
+    def _embeds(self) -> bool:
+        # keyword queries answered from the lexical index need no embedding
+        if not hasattr(self.kb, 'embed_query'):
+            return False
+        if not hasattr(self.kb, 'retrieval_mode'):
+            return True
+        return self.kb.retrieval_mode(self.query, filters=self.filters) != 'lexical'
+
+    def retrieve(self) -> Tuple[str, List[dict], dict]:
+        """Over-fetch candidates and pack them into the prompt context (see services.context)."""
+        fetch = self.top_k * config.CONTEXT_OVERFETCH
+        if self.query_vector is None and self._embeds():
+            self.query_vector = self.kb.embed_query(self.query)
+        kwargs = {'filters': self.filters} if self.filters else {}
+        if self.query_vector is not None:
+            kwargs['query_vector'] = self.query_vector
+        candidates = self.kb.query(self.query, top_k=fetch, **kwargs)
+        return pack_context(candidates, self.top_k, self.query_vector,
+                            candidate_vectors(self.kb, candidates))
+
+    def store(self, answer: str, docs: List[dict]):
+        if self.cache is not None:
+            self.cache.put(self.key, self.version, self.query, self.top_k, self.model,
+                           self.query_vector, answer, docs, self.scope)
+
+
+def answer_query(query: str, kb: Any, top_k: int = config.DEFAULT_RAG_TOP_K,
+                 use_cache: bool = True, filters: Optional[dict] = None) -> Tuple[str, List[Any]]:
     """
     Answer a query using RAG over the provided Knowledge Base (kb).
-    
+
     Args:
         query: User question.
         kb: Knowledge Base object (must have .query method).
         top_k: Number of chunks to retrieve.
-        
+        use_cache: Reuse the answer to the same (or a near-identical) question
+                   asked of this KB version, skipping retrieval and the LLM.
+        filters: Only retrieve chunks with these attributes, e.g.
+                 {'title': [...], 'source': 'live', 'since': '2026-01-01'}
+                 (see KB.query).
+
     Returns:
         Tuple[str, List[dict]]: (Answer text, List of source documents)
     """
-    docs = kb.query(query, top_k=top_k)
-    context = "\n\n".join([d['text'] for d in docs])
-    prompt = (
-        "You are a helpful assistant. Use the context below to answer the question. "
-        "If the answer is not in the context, say you don't know.\n\n"
-        f"CONTEXT:\n{context}\n\n"
-        f"QUESTION:\n{query}\n\n"
-        "Answer:"
-    )
-
+    t0 = time.perf_counter()
     client = get_openai_client()
+    lookup = _CacheLookup(query, kb, top_k, client, use_cache, filters)
+    if lookup.hit is not None:
+        elapsed = time.perf_counter() - t0
+        _record({"ttft_s": elapsed, "total_s": elapsed, "cached": True}, streamed=False)
+        return lookup.hit['answer'], [dict(s) for s in lookup.hit['sources']]
+    context, docs, packed = lookup.retrieve()
+    prompt = _build_prompt(query, context)
 
     if client:
         try:
@@ -44,12 +152,105 @@ def answer_query(query: str, kb: Any, top_k: int = config.DEFAULT_RAG_TOP_K) ->
             else:
                  # Fallback for dict access if object access fails
                  answer = resp.choices[0].message.content
+            lookup.store(answer, docs)
         except Exception as e:
             answer = f"[LLM call failed: {e}]"
     else:
-        # fallback extractive answer when no API key
-        if docs:
-            answer = "\n\n".join([d['text'] for d in docs[:2]])
-        else:
-            answer = "I don't know. No documents in the selected KB."
+        answer = _fallback_answer(docs)
+    elapsed = time.perf_counter() - t0
+    # nothing is shown before the whole answer is back
+    _record({"ttft_s": elapsed, "total_s": elapsed, "context": packed}, streamed=False)
     return answer, docs
+
+
+class AnswerStream:
+    """
+    An answer being generated: iterate it for text pieces as the model produces
+    them. `sources` (the retrieved chunks) is available before the first piece;
+    `text` holds what has been generated so far and `metrics` the timings:
+    retrieval_s, ttft_s (request start to first piece, retrieval included),
+    generation_s (LLM request to last piece), total_s and pieces; `cached`
+    is True when the answer came from the answer cache, and `context` holds
+    the prompt packing stats (see services.context.pack_context).
+    """
+
+    def __init__(self, pieces: Iterator[str], sources: List[dict], metrics: dict):
+        self._pieces = pieces
+        self.sources = sources
+        self.metrics = metrics
+        self.text = ""
+
+    def __iter__(self) -> Iterator[str]:
+        for piece in self._pieces:
+            self.text += piece
+            yield piece
+
+
+def answer_query_stream(query: str, kb: Any, top_k: int = config.DEFAULT_RAG_TOP_K,
+                        client: Any = None, use_cache: bool = True,
+                        filters: Optional[dict] = None) -> AnswerStream:
+    """
+    Like answer_query, but the answer is streamed: returns an AnswerStream
+    yielding text as the chat model generates it (see AnswerStream for the
+    sources and timings). Cached answers and, without an API key, the
+    extractive fallback are yielded in one piece.
+    """
+    t0 = time.perf_counter()
+    client = client or get_openai_client()
+    lookup = _CacheLookup(query, kb, top_k, client, use_cache, filters)
+    if lookup.hit is not None:
+        elapsed = round(time.perf_counter() - t0, 3)
+        metrics = {"retrieval_s": elapsed, "ttft_s": elapsed, "generation_s": 0.0,
+                   "total_s": elapsed, "pieces": 1, "cached": True}
+        _record(metrics, streamed=True)
+        return AnswerStream(iter([lookup.hit['answer']]), [dict(s) for s in lookup.hit['sources']], metrics)
+    context, docs, packed = lookup.retrieve()
+    metrics = {"retrieval_s": round(time.perf_counter() - t0, 3), "ttft_s": None,
+               "generation_s": None, "total_s": None, "pieces": 0, "cached": False, "context": packed}
+
+    def _generate() -> Iterator[str]:
+        answer, failed = [], False
+        t_llm = time.perf_counter()
+        try:
+            if client:
+                stream = client.chat.completions.create(
+                    model=config.DEFAULT_CHAT_MODEL,
+                    messages=[{"role": "user", "content": _build_prompt(query, context)}],
+                    temperature=config.DEFAULT_RAG_TEMPERATURE,
+                    max_tokens=config.DEFAULT_RAG_MAX_TOKENS,
+                    stream=True,
+                )
+                pieces = (_delta_text(event) for event in stream)
+            else:
+                pieces = iter([_fallback_answer(docs)])
+            for piece in pieces:
+                if not piece:
+                    continue
+                if metrics["ttft_s"] is None:
+                    metrics["ttft_s"] = round(time.perf_counter() - t0, 3)
+                metrics["pieces"] += 1
+                answer.append(piece)
+                yield piece
+        except Exception as e:
+            failed = True
+            if metrics["ttft_s"] is None:
+                metrics["ttft_s"] = round(time.perf_counter() - t0, 3)
+            yield f"[LLM call failed: {e}]"
+        finally:
+            now = time.perf_counter()
+            metrics["generation_s"] = round(now - t_llm, 3)
+            metrics["total_s"] = round(now - t0, 3)
+            _record(metrics, streamed=True)
+        if client and not failed:
+            lookup.store("".join(answer), docs)
+
+    return AnswerStream(_generate(), docs, metrics)
+
+
+def _delta_text(event) -> str:
+    # chat.completion.chunk: choices[0].delta.content (None on role / finish events)
+    choices = getattr(event, "choices", None)
+    if not choices:
+        return ""
+    delta = getattr(choices[0], "delta", None)
+    return getattr(delta, "content", None) or ""
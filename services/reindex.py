@@ -0,0 +1,167 @@
+# services/reindex.py
+"""
+Background re-embedding of a KB after its embedding model changes.
+
+The job streams the KB's chunks through the new model in batches, appending
+the vectors to `reindex/vectors.f32` and checkpointing progress in
+`reindex/state.json` after every batch, so an interrupted job resumes where
+it stopped. The old index keeps serving queries the whole time; once every
+chunk (including ones added while the job ran) has a new vector, a new index
+is built next to the old one and swapped in under the KB lock.
+"""
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+import config
+from services import indexes, segments
+from services.chunkstore import VectorColumn
+from services.embeddings import get_embeddings
+
+REINDEX_DIR = "reindex"
+STATE_FILE = "state.json"
+VECTORS_FILE = "vectors.f32"
+
+
+def read_state(kb_dir: Path) -> Optional[dict]:
+    try:
+        with open(Path(kb_dir) / REINDEX_DIR / STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class ReindexJob:
+    """Re-embeds every chunk of `kb` with `target_model` and swaps in a new index."""
+
+    def __init__(self, kb, target_model: str, batch_size: int = config.REINDEX_BATCH_SIZE):
+        self.kb = kb
+        self.target_model = target_model
+        self.batch_size = batch_size
+        self.dir = kb.path / REINDEX_DIR
+        self.state_path = self.dir / STATE_FILE
+        self.vectors_path = self.dir / VECTORS_FILE
+        self.dim: Optional[int] = None
+        self.done = 0
+        self.error: Optional[str] = None
+        self._thread: Optional[threading.Thread] = None
+
+    # ---- checkpointing ----
+    def _load_checkpoint(self):
+        state = read_state(self.kb.path)
+        if not state or state.get("target_model") != self.target_model or not state.get("dim"):
+            # nothing to resume (or a job for another model): start over
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir.mkdir(exist_ok=True)  # not parents: the KB may have been deleted
+            self.dim, self.done = None, 0
+            return
+        self.dim = int(state["dim"])
+        row_bytes = self.dim * 4
+        on_disk = self.vectors_path.stat().st_size // row_bytes if self.vectors_path.exists() else 0
+        # trust only rows that are both checkpointed and fully written
+        self.done = min(int(state.get("done", 0)), on_disk)
+        with open(self.vectors_path, "r+b" if self.vectors_path.exists() else "wb") as f:
+            f.truncate(self.done * row_bytes)
+
+    def _checkpoint(self):
+        segments.atomic_write_bytes(self.state_path, json.dumps({
+            "target_model": self.target_model, "dim": self.dim, "done": self.done,
+        }).encode("utf-8"))
+
+    # ---- work ----
+    def _embed_next(self, chunks, end: int):
+        """Embed chunks [done, end) in batches, appending + checkpointing each batch."""
+        while self.done < end:
+            if self.kb.closed:
+                raise RuntimeError("KB closed")
+            stop = min(self.done + self.batch_size, end)
+            texts = [chunks.text(i) for i in range(self.done, stop)]
+            vecs = np.asarray(get_embeddings(texts, model=self.target_model), dtype='float32')
+            if vecs.ndim != 2 or len(vecs) != len(texts):
+                raise RuntimeError(f"Embedding '{self.target_model}' returned no vectors.")
+            if self.dim is None:
+                self.dim = vecs.shape[1]
+            with open(self.vectors_path, "ab") as f:
+                f.write(vecs.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self.done = stop
+            self._checkpoint()
+
+    def _vectors(self) -> np.ndarray:
+        return np.memmap(self.vectors_path, dtype='float32', mode='r', shape=(self.done, self.dim))
+
+    def _build_index(self):
+        vecs = self._vectors()
+        kind = indexes.target_kind(self.kb.index_kind_setting, len(vecs))
+        index = indexes.build_index(kind, self.dim, vecs, self.kb.vector_storage)
+        ids = self.kb.chunks.ids()
+        for start in range(0, len(vecs), 10000):
+            index.add_with_ids(np.ascontiguousarray(vecs[start:start + 10000]), ids[start:start + 10000])
+        return index
+
+    def run(self):
+        kb = self.kb
+        try:
+            with kb._lock:
+                compaction = kb._compaction
+            if compaction is not None and compaction.is_alive():
+                # it may be dropping deleted chunks, which shifts positions
+                compaction.join()
+            with kb._lock:
+                if (kb.metadata.get('embedding_model') == self.target_model and kb.index is not None
+                        and kb.index.ntotal == len(kb.chunks)):
+                    # already swapped (e.g. crashed after the swap but before cleanup)
+                    shutil.rmtree(self.dir, ignore_errors=True)
+                    return
+            self._load_checkpoint()
+            # catch up outside the lock; the old index keeps serving meanwhile
+            while self.done < len(kb.chunks):
+                self._embed_next(kb.chunks, len(kb.chunks))
+            index = self._build_index()
+            with kb._lock:
+                if kb.closed:
+                    return
+                # chunks added since the build: embed the (few) stragglers, then swap
+                start = index.ntotal
+                self._embed_next(kb.chunks, len(kb.chunks))
+                if self.done > start:
+                    index.add_with_ids(np.ascontiguousarray(self._vectors()[start:self.done]),
+                                       kb.chunks.ids()[start:self.done])
+                kb.index = index
+                # exact vectors for re-ranking: the checkpoint file, until save() copies it
+                kb.raw = VectorColumn.from_array(self._vectors()) if indexes.is_lossy(kb.vector_storage) else None
+                kb.metadata['embedding_model'] = self.target_model
+                kb.save()
+            shutil.rmtree(self.dir, ignore_errors=True)
+            print(f"[reindex] KB '{kb.name}' re-embedded with {self.target_model} ({self.done} chunks)")
+        except Exception as e:
+            # progress is checkpointed; the job resumes next time the KB is opened
+            self.error = str(e)
+            print(f"[reindex] KB '{kb.name}' re-index to {self.target_model} stopped: {e}")
+
+    def start(self) -> threading.Thread:
+        self._thread = threading.Thread(target=self.run, name=f"kb-reindex-{self.kb.name}", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def join(self, timeout: Optional[float] = None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def status(self) -> dict:
+        return {
+            "target_model": self.target_model,
+            "done": self.done,
+            "total": len(self.kb.chunks),
+            "running": self.is_alive(),
+            "error": self.error,
+        }
@@ -0,0 +1,190 @@
+# services/segments.py
+"""
+Crash-safe persistence helpers for KBs.
+
+A KB on disk is a base snapshot plus append-only write-ahead logs:
+
+    CURRENT               json pointer {"base": "base-000003", "log_gen": 3}
+    base-000003/          snapshot, written by KB._write_snapshot:
+        chunks.*, titles.json, sources.json
+                          columnar chunk store (see services/chunkstore.py)
+        chunks.vectors.npy
+                          exact vectors, only while the index stores lossy codes
+        lexical.*         BM25 postings (see services/lexical.py)
+        index.faiss       vector index, labelled by chunk id
+        kb.json           KB settings, next chunk id, deletion count and the
+                          owners of chunks shared between documents
+        tombstones.npy    ids of deleted chunks still in the snapshot (if any)
+    wal-000003.log        chunks/vectors added (and chunks deleted) since that
+                          snapshot; older generations go once it is committed
+
+KBs from before the log keep a single index.faiss + metadata.pkl at the top
+level; they are read as the base and rewritten as a snapshot on open.
+
+Each log record is length-prefixed and checksummed, so a torn write at the
+tail (crash mid-append) is detected on open and truncated away. Snapshots
+are written to a temp dir, fsynced and renamed, and only become live once
+CURRENT is atomically replaced.
+"""
+import json
+import os
+import re
+import struct
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+CURRENT_FILE = "CURRENT"
+_MAGIC = b"RTSG"
+_HEADER = struct.Struct("<4sIIII")  # magic, meta_len, n_vectors, dim, crc32
+_LOG_RE = re.compile(r"^wal-(\d{6})\.log$")
+
+
+def fsync_dir(path: Path):
+    """fsync a directory so renames inside it are durable (no-op where unsupported)."""
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write_bytes(path: Path, data: bytes):
+    """Write `data` to `path` via temp file + fsync + rename."""
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fsync_dir(path.parent)
+
+
+def fsync_file(path: Path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def read_current(kb_dir: Path) -> Optional[dict]:
+    """The committed {"base", "log_gen"} pointer, or None for a legacy (pre-log) KB."""
+    try:
+        with open(Path(kb_dir) / CURRENT_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_current(kb_dir: Path, base: str, log_gen: int):
+    atomic_write_bytes(Path(kb_dir) / CURRENT_FILE,
+                       json.dumps({"base": base, "log_gen": log_gen}).encode("utf-8"))
+
+
+def base_name(gen: int) -> str:
+    return f"base-{gen:06d}"
+
+
+def log_path(kb_dir: Path, gen: int) -> Path:
+    return Path(kb_dir) / f"wal-{gen:06d}.log"
+
+
+def list_log_gens(kb_dir: Path) -> List[int]:
+    gens = []
+    try:
+        for name in os.listdir(kb_dir):
+            m = _LOG_RE.match(name)
+            if m:
+                gens.append(int(m.group(1)))
+    except OSError:
+        pass
+    return sorted(gens)
+
+
+def encode_record(docs: List[dict], vecs: np.ndarray, model: Optional[str] = None,
+                  deleted: Optional[List[int]] = None, owners: Optional[Dict[int, List[str]]] = None) -> bytes:
+    meta = {"docs": docs, "model": model}
+    if deleted:
+        meta["deleted"] = [int(i) for i in deleted]
+    if owners:
+        meta["owners"] = {str(int(cid)): list(titles) for cid, titles in owners.items()}
+    meta = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+    vecs = np.ascontiguousarray(vecs, dtype=np.float32)
+    n, dim = (vecs.shape if vecs.ndim == 2 else (0, 0))
+    payload = meta + vecs.tobytes()
+    return _HEADER.pack(_MAGIC, len(meta), n, dim, zlib.crc32(payload)) + payload
+
+
+def read_log(path: Path) -> Tuple[List[Tuple[dict, np.ndarray]], int]:
+    """
+    Read every intact record from a log. Returns (records, valid_end) where each
+    record is (meta, vectors) -- meta holding "docs", the embedding "model",
+    any "deleted" chunk ids and any new "owners" (titles) of shared chunks -- and valid_end is the byte offset just past the
+    last intact record.
+    """
+    records = []
+    valid_end = 0
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return records, 0
+    with f:
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            magic, meta_len, n, dim, crc = _HEADER.unpack(header)
+            if magic != _MAGIC:
+                break
+            payload = f.read(meta_len + n * dim * 4)
+            if len(payload) < meta_len + n * dim * 4 or zlib.crc32(payload) != crc:
+                break
+            try:
+                meta = json.loads(payload[:meta_len].decode("utf-8"))
+            except ValueError:
+                break
+            if isinstance(meta, list):
+                # records written before the embedding model was logged
+                meta = {"docs": meta, "model": None}
+            vecs = np.frombuffer(payload[meta_len:], dtype=np.float32).reshape(n, dim)
+            records.append((meta, vecs))
+            valid_end = f.tell()
+    return records, valid_end
+
+
+class SegmentLog:
+    """Append-only, fsynced record log. A torn tail beyond `valid_end` is cut off on open."""
+
+    def __init__(self, path: Path, valid_end: Optional[int] = None):
+        self.path = Path(path)
+        if valid_end is not None:
+            try:
+                if self.path.stat().st_size > valid_end:
+                    with open(self.path, "r+b") as f:
+                        f.truncate(valid_end)
+                        os.fsync(f.fileno())
+            except FileNotFoundError:
+                pass
+
+    def append(self, docs: List[dict], vecs: np.ndarray, model: Optional[str] = None,
+               deleted: Optional[List[int]] = None, owners: Optional[Dict[int, List[str]]] = None):
+        record = encode_record(docs, vecs, model, deleted, owners)
+        created = not self.path.exists()
+        with open(self.path, "ab") as f:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        if created:
+            fsync_dir(self.path.parent)
+
+    def size(self) -> int:
+        try:
+            return self.path.stat().st_size
+        except OSError:
+            return 0
@@ -1,93 +1,201 @@
 # services/transcribe.py
-import os
-import io
-from tempfile import NamedTemporaryFile
-from typing import Optional, Tuple, Any
+import difflib
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Sequence, Tuple
 
+import numpy as np
+
+import config
+from services.audio import (TimeMap, decode_audio, downmix, encode_audio, plan_segments,
+                            preprocess_audio, record_trim, record_upload, samples_of, trim_silence)
+from services.batching import call_with_backoff
 from services.utils import get_openai_client
+from services.transcript_cache import audio_key, get_transcript_cache
 
-def transcribe_audio(fileobj: Any, filename_hint: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+def transcribe_audio(fileobj: Any, filename_hint: Optional[str] = None,
+                     use_cache: bool = True, client: Any = None,
+                     max_workers: int = config.TRANSCRIBE_WORKERS,
+                     timings: Optional[list] = None) -> Tuple[Optional[str], Optional[str]]:
     """
     Transcribe audio BytesIO-like object -> text.
     
     Args:
         fileobj: A file-like object containing audio data.
         filename_hint: Optional filename to help with format detection.
+        use_cache: Return a cached transcript of the same bytes (and model) if
+                   there is one, and cache new transcripts.
+        client: Transcription client to use instead of the OpenAI one (e.g. a
+                local fake); see transcribe_uploads.
+        max_workers: Segments of a long recording transcribed at once.
+        timings: If a list is given, one {"start", "end", "text"} dict per
+                 transcribed segment is appended, with times in seconds of the
+                 original recording (silence trimming undone). Left untouched
+                 on a transcript cache hit.
         
     Returns:
         Tuple[str, str]: (transcript_text, error_message).
                          One of them will be None.
     """
 
-    client = get_openai_client()
-    if client is None:
-        return None, "[No OPENAI_API_KEY set — transcription unavailable. Provide OPENAI_API_KEY for real transcription.]"
-
     # Ensure we can read from the file-like
     try:
         fileobj.seek(0)
     except Exception:
         pass
+    raw = fileobj.read()
+
+    # Same bytes transcribed before: no decoding, no upload
+    model = config.TRANSCRIPTION_MODEL
+    key = audio_key(model, raw) if use_cache else None
+    if key is not None:
+        cached = get_transcript_cache().get(key)
+        if cached is not None:
+            return cached, None
 
-    # Try to import pydub for robust format handling
+    client = client or get_openai_client()
+    if client is None:
+        return None, "[No OPENAI_API_KEY set — transcription unavailable. Provide OPENAI_API_KEY for real transcription.]"
+
+    # Decode with pydub (format hint first, then autodetect)
     try:
-        from pydub import AudioSegment
+        audio_segment = decode_audio(raw, filename_hint)
     except ImportError as e:
         return None, f"[Transcription failed: missing pydub or ffmpeg. Install pydub and ffmpeg. Error: {e}]"
     except Exception as e:
-        return None, f"[Transcription failed: pydub error: {e}]"
+        return None, f"[Whisper transcription failed: could not parse uploaded audio ({e})]"
 
-    # Load with pydub (auto-detect format if possible)
-    audio_segment = None
-    raw = fileobj.read()
-    bio = io.BytesIO(raw)
-
-    # Try format hint first (if available)
-    if filename_hint and "." in filename_hint:
-        fmt = filename_hint.split(".")[-1].lower()
-        try:
-            audio_segment = AudioSegment.from_file(bio, format=fmt)
-        except Exception:
-            bio.seek(0)
-            audio_segment = None
-
-    # If no audio_segment yet, try autodetect
-    if audio_segment is None:
-        try:
-            bio.seek(0)
-            audio_segment = AudioSegment.from_file(bio)
-        except Exception as e:
-            return None, f"[Whisper transcription failed: could not parse uploaded audio ({e})]"
-
-    # Export to a proper WAV temp file (with headers)
-    tmp = NamedTemporaryFile(delete=False, suffix=".wav")
+    # 16 kHz mono, long pauses shortened, compact codec, in memory (no temp
+    # WAV export); long recordings are split so the pieces can be transcribed
+    # in parallel
     try:
-        audio_segment.export(tmp.name, format="wav")
+        t0 = time.perf_counter()
+        compact = downmix(audio_segment)
+        if config.TRANSCRIBE_VAD:
+            compact, tmap = trim_silence(compact)
+            record_trim(tmap.original_length / tmap.sample_rate, tmap.removed_seconds)
+            if tmap.removed_seconds:
+                print(f"[transcribe] trimmed {tmap.removed_seconds:.1f}s of silence "
+                      f"from {tmap.original_length / tmap.sample_rate:.1f}s")
+        else:
+            tmap = TimeMap.identity(int(compact.frame_count()), compact.frame_rate)
+        pieces = plan_segments(samples_of(compact), compact.frame_rate)
+        if len(pieces) == 1:
+            # the original upload still has the pauses the VAD trimmed
+            upload_name, upload_bytes, prep = preprocess_audio(compact, raw, filename_hint,
+                                                               send_original=not tmap.removed_seconds)
+            uploads = [lambda: (upload_name, upload_bytes)]
+            print(f"[transcribe] uploading {prep['output_bytes']} bytes as {prep['format']} "
+                  f"(was {prep['input_bytes']}, saved {prep['saved_bytes']}) after {prep['seconds']}s preprocessing")
+        else:
+            uploads = [_piece_encoder(compact, a, b) for a, b, _ in pieces]
     except Exception as e:
-        try:
-            tmp.close()
-        except Exception:
-            pass
-        return None, f"[Whisper transcription failed: could not export audio to WAV ({e})]"
+        return None, f"[Whisper transcription failed: could not preprocess audio ({e})]"
 
     # Call OpenAI Whisper via new client API
     try:
-        with open(tmp.name, "rb") as fh:
-            resp = client.audio.transcriptions.create(model="whisper-1", file=fh)
-        
-        # Extract text (handle both object-like and dict-like)
-        text = getattr(resp, "text", None)
-        if text is None:
-            # Fallback for dict-like response
-             if hasattr(resp, "get"):
-                text = resp.get("text", "")
-             else:
-                text = ""
-        return text, None
+        texts = transcribe_uploads(client, uploads, model=model, max_workers=max_workers)
     except Exception as e:
         return None, f"Whisper transcription failed: {e}"
-    finally:
-        try:
-            os.unlink(tmp.name)
-        except Exception:
-            pass
+    if len(pieces) > 1:
+        sizes = [getattr(u, "size", 0) for u in uploads]
+        record_upload(len(raw), sum(sizes), time.perf_counter() - t0)
+        print(f"[transcribe] {len(pieces)} segments, {sum(sizes)} bytes uploaded (was {len(raw)}) "
+              f"in {time.perf_counter() - t0:.1f}s")
+    parts = drop_overlaps(texts, [overlapped for _, _, overlapped in pieces])
+    text = " ".join(p for p in parts if p)
+    if timings is not None:
+        bounds = tmap.to_original(np.array([[a, b] for a, b, _ in pieces]) / compact.frame_rate)
+        if len(pieces) == 1:
+            bounds[0, 1] = tmap.original_length / tmap.sample_rate
+        timings.extend({"start": round(float(a), 3), "end": round(float(b), 3), "text": part}
+                       for (a, b), part in zip(bounds, parts))
+    if key is not None and text:
+        get_transcript_cache().put(key, model, text, len(raw))
+    return text, None
+
+
+def _piece_encoder(compact, start: int, end: int) -> Callable[[], Tuple[str, bytes]]:
+    """Deferred encoding of samples [start, end) so it runs on the worker that uploads it."""
+    def encode():
+        fmt, data = encode_audio(compact.get_sample_slice(start, end))
+        encode.size = len(data)
+        return f"audio.{fmt}", data
+    encode.size = 0
+    return encode
+
+
+def _response_text(resp) -> str:
+    # Extract text (handle both object-like and dict-like)
+    text = getattr(resp, "text", None)
+    if text is None:
+        # Fallback for dict-like response
+        if hasattr(resp, "get"):
+            text = resp.get("text", "")
+        else:
+            text = ""
+    return text
+
+
+def transcribe_uploads(client: Any, uploads: Sequence[Callable[[], Tuple[str, bytes]]],
+                       model: str = config.TRANSCRIPTION_MODEL,
+                       max_workers: int = config.TRANSCRIBE_WORKERS) -> List[str]:
+    """
+    Transcribe each upload (a callable returning (filename, bytes)) through a
+    bounded thread pool, with 429 backoff per request. Returns the texts in
+    input order. `client` only needs `audio.transcriptions.create(model=, file=)`,
+    so a local fake can stand in for OpenAI.
+    """
+    def _run(upload):
+        name, data = upload()
+        return _response_text(call_with_backoff(
+            lambda: client.audio.transcriptions.create(model=model, file=(name, data))))
+
+    if len(uploads) == 1 or max_workers <= 1:
+        return [_run(u) for u in uploads]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(uploads))) as pool:
+        return list(pool.map(_run, uploads))
+
+
+def _norm_words(words: List[str]) -> List[str]:
+    return [re.sub(r"\W+", "", w.lower()) for w in words]
+
+
+_WORD_RE = re.compile(r"\S+")
+
+
+def drop_overlaps(texts: Sequence[str], overlapped: Sequence[bool],
+                  max_words: int = config.TRANSCRIBE_OVERLAP_MAX_WORDS) -> List[str]:
+    """
+    Segment transcripts, in order, with repeated words removed: where a
+    segment overlaps the previous one, the words it repeats (the longest run
+    at the start of its text that matches the end of the previous text,
+    ignoring case and punctuation) are cut from its start. The rest of each
+    text, line breaks included, is kept as the model returned it.
+    """
+    merged: List[str] = []
+    parts: List[str] = []
+    for text, overlaps in zip(texts, overlapped):
+        text = text or ""
+        spans = [m.span() for m in _WORD_RE.finditer(text)]
+        words = [text[a:b] for a, b in spans]
+        if overlaps and merged and words:
+            tail = _norm_words(merged[-max_words:])
+            head = _norm_words(words[:max_words])
+            m = difflib.SequenceMatcher(None, tail, head, autojunk=False).find_longest_match(
+                0, len(tail), 0, len(head))
+            # the repeated run must sit at (or within a word or two of) the seam
+            if m.size >= 2 and len(tail) - (m.a + m.size) <= 2 and m.b <= 2:
+                cut = m.b + m.size
+                text = text[spans[cut - 1][1]:].lstrip()
+                words = words[cut:]
+        merged.extend(words)
+        parts.append(text)
+    return parts
+
+
+def merge_transcripts(texts: Sequence[str], overlapped: Sequence[bool],
+                      max_words: int = config.TRANSCRIBE_OVERLAP_MAX_WORDS) -> str:
+    """Join segment transcripts in order, without the words repeated across overlaps."""
+    return " ".join(p for p in drop_overlaps(texts, overlapped, max_words) if p)
@@ -0,0 +1,124 @@
+# services/transcript_cache.py
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import config
+
+
+def audio_key(model: str, audio: bytes) -> bytes:
+    """Content address for a transcript: sha256 over (model name, raw audio bytes)."""
+    h = hashlib.sha256()
+    h.update(model.encode("utf-8"))
+    h.update(b"\0")
+    h.update(audio)
+    return h.digest()
+
+
+class TranscriptCache:
+    """
+    Persistent transcript cache keyed by (model name, hash of the uploaded bytes).
+
+    Lookups happen before any decoding, so a repeat submission (rerun, retry,
+    the same recording added to another KB) costs one hash and one sqlite read.
+    Bounded by row count, evicting least recently used; 0 disables the cache.
+    """
+
+    def __init__(self, path: Optional[Path] = config.TRANSCRIPT_CACHE_PATH,
+                 max_items: int = config.TRANSCRIPT_CACHE_MAX_ITEMS):
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._db = None
+        self._rows = 0
+        if path is not None and max_items > 0:
+            try:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(str(path), check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS transcripts ("
+                    " key BLOB PRIMARY KEY, model TEXT, text TEXT, audio_bytes INTEGER, last_used REAL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS transcripts_lru ON transcripts(last_used)")
+                self._db.commit()
+                self._rows = self._db.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+            except Exception as e:
+                print(f"[transcript_cache] disabled: {e}")
+                self._db = None
+
+    def get(self, key: bytes) -> Optional[str]:
+        if self._db is None:
+            return None
+        with self._lock:
+            try:
+                row = self._db.execute("SELECT text FROM transcripts WHERE key=?", (key,)).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE transcripts SET last_used=? WHERE key=?", (time.time(), key))
+                    self._db.commit()
+            except Exception as e:
+                print(f"[transcript_cache] read failed: {e}")
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: bytes, model: str, text: str, audio_bytes: int = 0):
+        if self._db is None:
+            return
+        with self._lock:
+            try:
+                cur = self._db.execute(
+                    "INSERT OR IGNORE INTO transcripts(key, model, text, audio_bytes, last_used) "
+                    "VALUES (?,?,?,?,?)", (key, model, text, audio_bytes, time.time()))
+                self._rows += max(cur.rowcount, 0)
+                overflow = self._rows - self.max_items
+                if overflow > 0:
+                    self._db.execute(
+                        "DELETE FROM transcripts WHERE key IN "
+                        "(SELECT key FROM transcripts ORDER BY last_used LIMIT ?)", (overflow,))
+                    self._rows -= overflow
+                    self.evictions += overflow
+                self._db.commit()
+            except Exception as e:
+                print(f"[transcript_cache] write failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.execute("DELETE FROM transcripts")
+                self._db.commit()
+                self._rows = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "items": self._rows,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+            }
+
+
+_cache: Optional[TranscriptCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_transcript_cache() -> TranscriptCache:
+    """Return the process-wide transcript cache."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = TranscriptCache()
+    return _cache
@@ -1,16 +1,67 @@
 import os
+import threading
 from openai import OpenAI
 from typing import Optional
 
+import config
+
+# Client registry: one OpenAI client (and one httpx connection pool) per API key.
+_client: Optional[OpenAI] = None
+_client_key: Optional[str] = None
+_http_client = None
+_client_lock = threading.Lock()
+
+
+def _build_http_client():
+    """Shared httpx client with pooled keep-alive connections."""
+    import httpx
+    return httpx.Client(
+        limits=httpx.Limits(
+            max_connections=config.OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=config.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=config.OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(config.OPENAI_TIMEOUT, connect=config.OPENAI_CONNECT_TIMEOUT),
+        follow_redirects=True,
+    )
+
+
 def get_openai_client() -> Optional[OpenAI]:
     """
     Lazily create and return an OpenAI client if OPENAI_API_KEY is set.
     Returns None if key not present.
+
+    The client is cached and reused (sharing one httpx connection pool) until
+    OPENAI_API_KEY changes, so keys set at runtime via os.environ still apply.
     """
+    global _client, _client_key, _http_client
     key = os.environ.get("OPENAI_API_KEY")
     if not key:
         return None
-    try:
-        return OpenAI(api_key=key)
-    except Exception:
-        return None
+    if _client is not None and key == _client_key:
+        return _client
+    with _client_lock:
+        if _client is not None and key == _client_key:
+            return _client
+        try:
+            if _http_client is None:
+                _http_client = _build_http_client()
+            client = OpenAI(api_key=key, http_client=_http_client,
+                            max_retries=config.OPENAI_MAX_RETRIES)
+        except Exception:
+            return None
+        # The pool is shared across keys; only the (cheap) client wrapper is rebuilt.
+        _client, _client_key = client, key
+        return _client
+
+
+def reset_openai_client():
+    """Drop the cached client and close its connection pool."""
+    global _client, _client_key, _http_client
+    with _client_lock:
+        if _http_client is not None:
+            try:
+                _http_client.close()
+            except Exception:
+                pass
+        _client, _client_key, _http_client = None, None, None
@@ -1,7 +1,14 @@
 # services/vectorstore.py
+import json
 import os
 import pickle
 import shutil
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 from typing import List, Dict, Any, Optional
 
@@ -9,26 +16,158 @@ import numpy as np
 import faiss
 
 import config
-from services.embeddings import get_embeddings
-from services.chunker import split_text_into_chunks
+from services.embeddings import get_embeddings, active_embedding_model
+from services.chunker import iter_chunks, split_text_into_chunks
+from services import segments
+from services import indexes
+from services import dedup
+from services.answer_cache import get_answer_cache
+from services.chunkstore import ChunkStore, VectorColumn, has_chunk_store, has_vector_column, to_timestamp
+from services.lexical import LexicalIndex, has_lexical_index, rrf_fuse, tokenize
+from services.reindex import ReindexJob, REINDEX_DIR, read_state as read_reindex_state
+
+class KBCache:
+    """
+    Process-wide LRU of open KB objects, bounded by an estimate of their memory use.
+
+    Entries are revalidated against the files on disk (mtime + size) at most once
+    per `check_interval` seconds, so warm queries do no disk I/O. Writes made
+    through a cached KB refresh its own signature and never invalidate it.
+
+    There is only ever one KB object per folder, since two would hand out the
+    same chunk ids: a KB changed by another process is reloaded in place, and
+    an evicted KB that is still in use (a live session, a background job) is
+    handed out again rather than opened a second time.
+    """
+
+    def __init__(self, max_bytes: int = config.KB_CACHE_MAX_BYTES,
+                 check_interval: float = config.KB_CACHE_CHECK_INTERVAL):
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self._entries: "OrderedDict[str, KB]" = OrderedDict()
+        # every KB object still referenced anywhere, cached or not
+        self._open: "weakref.WeakValueDictionary[str, KB]" = weakref.WeakValueDictionary()
+        self._opening: Dict[str, threading.Lock] = {}
+        self._checked_at = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, name, path: Path) -> "KB":
+        key = os.path.abspath(path)
+        now = time.monotonic()
+        with self._lock:
+            kb = self._entries.get(key) or self._open.get(key)
+            if kb is not None:
+                self._entries[key] = kb
+                self._entries.move_to_end(key)
+                check = now - self._checked_at.get(key, 0.0) >= self.check_interval
+                if check:
+                    self._checked_at[key] = now
+                else:
+                    self.hits += 1
+                    return kb
+            opening = self._opening.setdefault(key, threading.Lock())
+
+        if kb is not None:
+            # compared under the KB's own lock, so outside ours
+            if kb.changed_on_disk():
+                kb.reload()
+                with self._lock:
+                    self.invalidations += 1
+            else:
+                with self._lock:
+                    self.hits += 1
+            return kb
+
+        # load outside the lock so other KBs stay servable meanwhile, but only
+        # once per folder
+        with opening:
+            with self._lock:
+                kb = self._open.get(key)
+                if kb is not None:
+                    self._entries[key] = kb
+                    self.hits += 1
+                    return kb
+                self.misses += 1
+            kb = KB(name, path)
+            with self._lock:
+                self._entries[key] = kb
+                self._open[key] = kb
+                self._checked_at[key] = now
+                self._evict()
+            return kb
+
+    def pop(self, path: Path) -> Optional["KB"]:
+        with self._lock:
+            key = os.path.abspath(path)
+            kb = self._drop(key)
+            held = self._open.pop(key, None)
+            return kb if kb is not None else held
+
+    def _drop(self, key) -> Optional["KB"]:
+        self._checked_at.pop(key, None)
+        return self._entries.pop(key, None)
+
+    def _evict(self):
+        # always keep the most recently used KB, even if it alone exceeds the budget
+        while len(self._entries) > 1 and self.total_bytes() > self.max_bytes:
+            key, _ = self._entries.popitem(last=False)
+            self._checked_at.pop(key, None)
+            self.evictions += 1
+
+    def total_bytes(self) -> int:
+        return sum(kb.nbytes() for kb in self._entries.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "cached_kbs": len(self._entries),
+                "open_kbs": len(self._open),
+                "bytes": self.total_bytes(),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
+
+
+_kb_cache = KBCache()
+
 
 class KBManager:
-    def __init__(self, root_dir: str = str(config.DATA_DIR)):
+    def __init__(self, root_dir: str = str(config.DATA_DIR), cache: Optional[KBCache] = None):
         self.root = Path(root_dir)
         self.root.mkdir(parents=True, exist_ok=True)
-        # optional in-memory cache for loaded KB objects to help release indexes on delete
-        self._loaded_kbs = {}
+        # open KB objects are shared process-wide so Streamlit reruns reuse them
+        self._loaded_kbs = cache if cache is not None else _kb_cache
 
     def list_kbs(self):
         return [p.name for p in self.root.iterdir() if p.is_dir()]
 
-    def create_kb(self, name):
+    def create_kb(self, name, index_kind: str = config.DEFAULT_KB_INDEX_KIND,
+                  vector_storage: str = config.DEFAULT_KB_VECTOR_STORAGE):
+        """
+        Create an empty KB. `index_kind` is one of indexes.INDEX_KINDS ("auto" by
+        default) and `vector_storage` one of indexes.STORAGE_KINDS.
+        """
+        indexes.target_kind(index_kind, 0)  # validate
+        indexes.resolve("flat", vector_storage)
         kb_dir = self.root / name
         kb_dir.mkdir(parents=True, exist_ok=True)
-        meta_path = kb_dir / 'metadata.pkl'
-        if not meta_path.exists():
-            with open(meta_path, 'wb') as f:
-                pickle.dump({'docs': []}, f)
+        if not (kb_dir / 'metadata.pkl').exists() and not (kb_dir / segments.CURRENT_FILE).exists():
+            kb = KB(name, kb_dir)
+            kb.metadata['index_kind'] = index_kind
+            kb.metadata['vector_storage'] = vector_storage
+            kb.save()
+
+    def migrate_all(self):
+        """Open every KB once so legacy metadata.pkl snapshots are converted to the chunk store."""
+        for name in self.list_kbs():
+            self.get_kb(name)
 
     def delete_kb(self, name):
         """
@@ -41,22 +180,20 @@ class KBManager:
 
         # Attempt to clear any in-memory cache & release references to FAISS indexes
         try:
-            if name in self._loaded_kbs:
-                kb_obj = self._loaded_kbs[name]
-                try:
-                    # try to release index reference
-                    if hasattr(kb_obj, 'index'):
-                        kb_obj.index = None
-                except Exception:
-                    pass
-                try:
-                    del self._loaded_kbs[name]
-                except Exception:
-                    pass
+            kb_obj = self._loaded_kbs.pop(kb_dir)
+            if kb_obj is not None:
+                # a running compaction or re-index would write the folder back
+                kb_obj.close()
+            if kb_obj is not None and hasattr(kb_obj, 'index'):
+                # try to release index reference
+                kb_obj.index = None
         except Exception:
             # non-fatal, proceed to disk removal
             pass
 
+        # a KB re-created under this name must not see the old one's answers
+        get_answer_cache().invalidate(str(kb_dir))
+
         # Now remove directory from disk
         try:
             shutil.rmtree(kb_dir)
@@ -66,14 +203,110 @@ class KBManager:
         return True
 
     def get_kb(self, name):
-        kb = KB(name, self.root / name)
-        # cache loaded instance to help manage memory / closures
-        self._loaded_kbs[name] = kb
-        return kb
+        return self._loaded_kbs.get(name, self.root / name)
 
-    def add_transcript(self, kb_name, title, transcript):
+    def cache_stats(self) -> dict:
+        return self._loaded_kbs.stats()
+
+    def add_transcript(self, kb_name, title, transcript, source=None, date=None) -> dict:
         kb = self.get_kb(kb_name)
-        kb.add_document(title, transcript)
+        return kb.add_document(title, transcript, source=source, date=date)
+
+    def remove_transcript(self, kb_name, title) -> int:
+        return self.get_kb(kb_name).remove_document(title)
+
+    def replace_transcript(self, kb_name, title, transcript, source=None, date=None) -> dict:
+        return self.get_kb(kb_name).replace_document(title, transcript, source=source, date=date)
+
+    def start_live_session(self, kb_name, title, client=None):
+        """Transcribe and index a recording into `kb_name` while it is being made; see LiveSession."""
+        from services.live import LiveSession
+        return LiveSession(self.get_kb(kb_name), title, client=client)
+
+    def query_kbs(self, kb_names, query_text, top_k=4, mode=None, filters=None,
+                  max_workers: int = config.KB_QUERY_WORKERS) -> List[dict]:
+        """
+        Search several KBs at once and return the global `top_k` hits, each
+        tagged with its 'kb'.
+
+        The query is embedded once per embedding model, then every KB's vector
+        and BM25 searches run concurrently (FAISS and NumPy release the GIL).
+        Hits are merged as KB.query would within one KB: dense hits by L2
+        distance, lexical hits by BM25 score, and both fused by reciprocal rank
+        when `mode` (default: each KB's own, see KB.retrieval_mode) uses both.
+        BM25 scores depend on each KB's own term statistics, so lexical hits
+        from several KBs are interleaved by their rank within their KB instead
+        (likewise dense hits from different embedding models).
+        `filters` applies to every KB (see KB.query). Names that aren't
+        existing KBs raise ValueError (get_kb would create them).
+        """
+        kb_names = list(dict.fromkeys(kb_names))
+        existing = self.list_kbs()
+        unknown = set(kb_names) - set(existing)
+        if unknown:
+            raise ValueError(f"Unknown KB {', '.join(sorted(unknown))}. Use one of {', '.join(sorted(existing))}.")
+        if not kb_names or top_k <= 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(kb_names))) as pool:
+            kbs = list(pool.map(self.get_kb, kb_names))
+            modes = [kb.retrieval_mode(query_text, mode, filters) for kb in kbs]
+            if any(m != 'lexical' for m in modes):
+                # the query gets embedded anyway, so auto KBs needn't skip vector search
+                modes = ['hybrid' if m == 'lexical' and (mode or kb.retrieval_setting) == 'auto' else m
+                         for kb, m in zip(kbs, modes)]
+            for m in modes:
+                if m not in RETRIEVAL_MODES or m == 'auto':
+                    raise ValueError(f"Unknown retrieval mode '{m}'. Use one of {', '.join(RETRIEVAL_MODES)}.")
+            hybrid = any(m == 'hybrid' for m in modes) or len(set(modes)) > 1
+            fetch = top_k * config.KB_HYBRID_CANDIDATES if hybrid else top_k
+
+            # one embedding per model; KBs on the same model share it
+            vectors = {}
+            for kb, m in zip(kbs, modes):
+                model = kb.metadata.get('embedding_model')
+                if m != 'lexical' and model not in vectors:
+                    vectors[model] = kb.embed_query(query_text)
+
+            searches = []
+            for name, kb, m in zip(kb_names, kbs, modes):
+                if m != 'lexical':
+                    q_vec = vectors[kb.metadata.get('embedding_model')]
+                    searches.append((name, 'vector', pool.submit(kb.query, query_text, top_k=fetch,
+                                                                 query_vector=q_vec, mode='vector',
+                                                                 filters=filters)))
+                if m != 'vector':
+                    searches.append((name, 'lexical', pool.submit(kb.query, query_text, top_k=fetch,
+                                                                  mode='lexical', filters=filters)))
+            hits = {'vector': [], 'lexical': []}
+            for name, kind, future in searches:
+                for rank, hit in enumerate(future.result()):
+                    hits[kind].append((rank, dict(hit, kb=name)))
+
+        # distances from different models aren't comparable; rank those by position instead
+        by_distance = len(vectors) <= 1
+        dense = sorted(hits['vector'], key=lambda h: (h[1]['score'],) if by_distance else (h[0], h[1]['score']))
+        # nor are BM25 scores across KBs (document frequencies and lengths differ)
+        by_score = len({h['kb'] for _, h in hits['lexical']}) <= 1
+        sparse = sorted(hits['lexical'], key=lambda h: (-h[1]['score'],) if by_score else (h[0], -h[1]['score']))
+        rankings = [[h for _, h in dense], [h for _, h in sparse]]
+        if not hybrid:
+            return [h for ranking in rankings for h in ranking][:top_k]
+        keys, table = {}, []
+        for ranking in rankings:
+            for h in ranking:
+                if (h['kb'], h['id']) not in keys:
+                    keys[(h['kb'], h['id'])] = len(table)
+                    table.append(h)
+        fused, scores = rrf_fuse([np.array([keys[(h['kb'], h['id'])] for h in r], dtype='int64')
+                                  for r in rankings], top_k)
+        return [dict(table[int(i)], score=float(s)) for i, s in zip(fused, scores)]
+
+
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid", "auto")
+# chunk attributes query(filters=...) can restrict a search by (see ChunkStore.mask)
+FILTER_KEYS = ("title", "source", "since", "until")
+_QUESTION_WORDS = {"what", "who", "whom", "whose", "which", "when", "where", "why", "how",
+                   "is", "are", "do", "does", "did", "can", "could", "should", "would"}
 
 
 class KB:
@@ -81,120 +314,1045 @@ class KB:
         self.name = name
         self.path = Path(path)
         self.path.mkdir(parents=True, exist_ok=True)
+        # legacy single-snapshot layout; newer KBs keep snapshots under base-NNNNNN/
         self.index_path = self.path / 'index.faiss'
         self.meta_path = self.path / 'metadata.pkl'
+        self.current_path = self.path / segments.CURRENT_FILE
+        # guards the index + chunks against concurrent sessions sharing this KB
+        self._lock = threading.RLock()
+        # serialises snapshot writes (foreground save vs background compaction)
+        self._commit_lock = threading.Lock()
+        self._compaction: Optional[threading.Thread] = None
+        self._reindex: Optional[ReindexJob] = None
+        # set by close() when the KB is deleted: nothing may write its folder again
+        self.closed = False
+        self._nbytes = None
+        # search-time selector excluding self.tombstones (rebuilt when they change)
+        self._selector = None
+        # chunk signatures for duplicate detection, built on first ingest
+        self._dedup: Optional[dedup.Deduper] = None
+        self.dedup_stats = {'checked': 0, 'exact': 0, 'near': 0, 'semantic': 0}
+        self._load()
+        self.loaded_signature = self.disk_signature()
+        # pick up a re-embedding job that was interrupted (crash, restart)
+        state = read_reindex_state(self.path)
+        if state and state.get('target_model'):
+            self.reindex(state['target_model'])
 
-        if self.meta_path.exists():
-            with open(self.meta_path, 'rb') as f:
+    # ---- loading ----
+    def _load(self):
+        current = segments.read_current(self.path)
+        if current:
+            base_dir = self.path / current['base']
+            self.base_gen = int(current['log_gen'])
+        else:
+            base_dir = self.path
+            self.base_gen = 0
+
+        # KB-level settings (e.g. index_kind); chunks themselves live in self.chunks
+        self.metadata = {}
+        # ids of deleted chunks still present in the index/chunks until compaction
+        self.tombstones = set()
+        # exact vectors by chunk position, kept while the index stores lossy codes
+        self.raw: Optional[VectorColumn] = None
+        # BM25 postings by chunk position; built on first use for KBs saved without one
+        self.lexical: Optional[LexicalIndex] = None
+        # chunk ids ever deleted; unlike len(tombstones) never goes down (see version)
+        self.deletions = 0
+        # chunk id -> titles of the documents sharing it, for chunks that dedup kept
+        # once for several documents; every other chunk belongs to its title alone
+        self.owners: Dict[int, List[str]] = {}
+        # changes ever made to self.owners (see version)
+        self.owner_edits = 0
+        migrate = False
+        if has_chunk_store(base_dir):
+            try:
+                with open(base_dir / 'kb.json', 'r', encoding='utf-8') as f:
+                    self.metadata = json.load(f)
+            except (OSError, ValueError):
+                pass
+            self.chunks = ChunkStore(base_dir, next_id=self.metadata.pop('next_id', None))
+            self.deletions = int(self.metadata.pop('deletions', 0))
+            self.owners = {int(cid): titles for cid, titles in self.metadata.pop('owners', {}).items()}
+            self.owner_edits = int(self.metadata.pop('owner_edits', 0))
+            if has_vector_column(base_dir):
+                self.raw = VectorColumn(base_dir)
+            if has_lexical_index(base_dir):
+                self.lexical = LexicalIndex(base_dir)
+                if len(self.lexical) != len(self.chunks):
+                    self.lexical = None
+            try:
+                self.tombstones = set(np.load(base_dir / 'tombstones.npy').tolist())
+            except (OSError, ValueError):
+                pass
+        elif (base_dir / 'metadata.pkl').exists():
+            # legacy pickled {'docs': [...]} snapshot; rewritten as a chunk store below
+            with open(base_dir / 'metadata.pkl', 'rb') as f:
                 try:
-                    self.metadata = pickle.load(f)
+                    legacy = pickle.load(f)
                 except Exception:
-                    self.metadata = {'docs': []}
+                    legacy = {'docs': []}
+            self.chunks = ChunkStore.from_docs(legacy.get('docs', []))
+            self.metadata = {k: v for k, v in legacy.items() if k != 'docs'}
+            migrate = True
         else:
-            self.metadata = {'docs': []}
+            self.chunks = ChunkStore()
+            self.lexical = LexicalIndex()
 
-        if self.index_path.exists():
+        index_path = base_dir / 'index.faiss'
+        if index_path.exists():
             try:
-                self.index = faiss.read_index(str(self.index_path))
+                self.index = faiss.read_index(str(index_path))
             except Exception:
                 # if index corrupted, ignore and rebuild on next add
                 self.index = None
         else:
             self.index = None
+        if self.raw is not None and len(self.raw) != len(self.chunks):
+            self.raw = None
+        if self.index is not None and not indexes.has_ids(self.index):
+            # indexes from before chunk ids: labels were positions, which is what
+            # the migrated chunks got as ids
+            self.index = indexes.rebuild_index(self.index, indexes.index_kind(self.index))
+            migrate = True
 
-    def save(self):
-        with open(self.meta_path, 'wb') as f:
-            pickle.dump(self.metadata, f)
-        if self.index is not None:
+        # replay everything appended since the snapshot
+        gens = [g for g in segments.list_log_gens(self.path) if g >= self.base_gen]
+        valid_end = 0
+        for g in gens:
+            records, valid_end = segments.read_log(segments.log_path(self.path, g))
+            for meta, vecs in records:
+                self._apply(meta['docs'], vecs, meta.get('model'), meta.get('deleted'), meta.get('owners'))
+        self.log_gen = gens[-1] if gens else self.base_gen
+        self.log = segments.SegmentLog(segments.log_path(self.path, self.log_gen),
+                                       valid_end=valid_end if gens else None)
+
+        if migrate:
             try:
-                faiss.write_index(self.index, str(self.index_path))
-            except Exception:
-                # ignore write errors for now
+                self.save()
+            except Exception as e:
+                print(f"[vectorstore] could not migrate KB '{self.name}' to the chunk store: {e}")
+
+    def _apply(self, docs, vecs, model=None, deleted=None, owners=None):
+        """
+        Apply one batch of chunks + vectors (deleted chunk ids, new owners of
+        shared chunks) to the in-memory state. Vectors from a different embedding
+        model than the index's are not indexed; those chunks wait for the
+        re-index job (see services/reindex.py).
+        """
+        if deleted:
+            self.tombstones.update(int(i) for i in deleted)
+            self.deletions += len(deleted)
+            for cid in deleted:
+                self.owners.pop(int(cid), None)
+            self._selector = None
+        if owners:
+            self.owners.update((int(cid), list(titles)) for cid, titles in owners.items())
+            self.owner_edits += len(owners)
+        indexable = False
+        if len(vecs):
+            if self.index is None and len(self.chunks) == 0:
+                kind = indexes.target_kind(self.index_kind_setting, len(vecs))
+                self.index = indexes.build_index(kind, vecs.shape[1], vecs, self.vector_storage)
+                if model:
+                    self.metadata['embedding_model'] = model
+                if indexes.is_lossy(self.vector_storage):
+                    self.raw = VectorColumn()
+            indexable = self._indexable(vecs, model)
+        ids = self.chunks.extend(docs)
+        if self.raw is not None and docs:
+            self.raw.append(vecs)
+        if self.lexical is not None:
+            self.lexical.extend(doc.get('text') or '' for doc in docs)
+        if self._dedup is not None:
+            for doc, cid in zip(docs, ids):
+                self._dedup.add(dedup.signature(doc.get('text')), cid)
+        if indexable:
+            self.index.add_with_ids(vecs, np.asarray(ids, dtype='int64'))
+
+    def _indexable(self, vecs, model) -> bool:
+        """True if `vecs` (from `model`) can go straight into the current index."""
+        if self.index is None or self.index.d != vecs.shape[1]:
+            return False
+        # ids must stay aligned with chunk positions: once a chunk is waiting
+        # for a re-index, nothing more goes into the old index
+        if self.index.ntotal != len(self.chunks):
+            return False
+        current = self.metadata.get('embedding_model')
+        return model is None or current is None or model == current
+
+    @property
+    def index_kind_setting(self) -> str:
+        return self.metadata.get('index_kind', config.DEFAULT_KB_INDEX_KIND)
+
+    @property
+    def index_kind(self) -> Optional[str]:
+        return indexes.index_kind(self.index)
+
+    @property
+    def vector_storage(self) -> str:
+        return self.metadata.get('vector_storage', config.DEFAULT_KB_VECTOR_STORAGE)
+
+    def _wanted_index_kind(self) -> Optional[str]:
+        """
+        Kind the index should be rebuilt as (for its size and vector storage
+        setting), or None if the current one is right.
+        """
+        if self.index is None:
+            return None
+        n = self.index.ntotal
+        kind = indexes.target_kind(self.index_kind_setting, n)
+        wanted = indexes.buildable(kind, self.vector_storage, n)
+        if wanted == (self.index_kind, indexes.index_storage(self.index)):
+            return None
+        return kind
+
+    def _reclaim_wanted(self) -> bool:
+        """True once enough chunks are deleted that compaction should drop them."""
+        return (len(self.tombstones) > 0 and
+                len(self.tombstones) >= config.KB_TOMBSTONE_COMPACT_RATIO * len(self.chunks))
+
+    def _can_reclaim(self) -> bool:
+        # dropping rows shifts chunk positions, which a running re-index relies on
+        running = self._reindex is not None and self._reindex.is_alive()
+        return (bool(self.tombstones) and not running and self.index is not None
+                and self.index.ntotal == len(self.chunks))
+
+    def _exclude_selector(self):
+        if self._selector is None and self.tombstones:
+            self._selector = indexes.exclude_selector(np.fromiter(self.tombstones, dtype='int64'))
+        return self._selector
+
+    def set_index_kind(self, kind: str):
+        """Change this KB's index kind ("auto" or explicit) and rebuild the index to match."""
+        indexes.target_kind(kind, 0)  # validate
+        with self._lock:
+            self.metadata['index_kind'] = kind
+            running = self._compaction
+        if running is not None and running.is_alive():
+            running.join()
+        self.compact(background=False)
+
+    def set_vector_storage(self, storage: str):
+        """
+        Change how this KB's index stores vectors (one of indexes.STORAGE_KINDS)
+        and rebuild the index to match.
+        """
+        indexes.resolve("flat", storage)  # validate
+        with self._lock:
+            self.metadata['vector_storage'] = storage
+            if (indexes.is_lossy(storage) and self.raw is None and self.index is not None
+                    and self.index.ntotal == len(self.chunks)):
+                # keep exact vectors for re-ranking (and for this rebuild)
+                self.raw = VectorColumn.from_array(indexes.all_vectors(self.index))
+            running = self._compaction
+        if running is not None and running.is_alive():
+            running.join()
+        self.compact(background=False)
+
+    def _watched_files(self):
+        return [self.current_path, self.meta_path, self.log.path]
+
+    def disk_signature(self):
+        """(mtime, size) of the files backing this KB; changes whenever they are rewritten."""
+        sig = []
+        for p in self._watched_files():
+            try:
+                st = p.stat()
+                sig.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                sig.append(None)
+        return tuple(sig)
+
+    @property
+    def busy(self) -> bool:
+        """True while a background compaction or re-index job is writing this KB."""
+        return ((self._compaction is not None and self._compaction.is_alive())
+                or (self._reindex is not None and self._reindex.is_alive()))
+
+    def close(self, timeout: Optional[float] = None):
+        """
+        Stop writing this KB (its folder is about to be deleted): later writes
+        raise, and running compaction / re-index jobs are waited for. Neither
+        commits anything once the KB is closed.
+        """
+        with self._lock:
+            self.closed = True
+            jobs = [self._compaction, self._reindex]
+        for job in jobs:
+            if job is not None:
+                job.join(timeout)
+
+    def reload(self):
+        """Re-read the KB from disk in place (another process changed it); not while a job is writing."""
+        with self._lock:
+            if self.busy or self.closed:
+                return
+            self._selector = None
+            self._dedup = None
+            self._nbytes = None
+            self._load()
+            self.loaded_signature = self.disk_signature()
+
+    def changed_on_disk(self) -> bool:
+        """
+        True if the files were rewritten by someone else since this KB loaded or
+        wrote them. Checked under the KB lock, so a write of our own that is half
+        done doesn't count; never True while a background job is writing, since
+        the job would carry on through this instance.
+        """
+        with self._lock:
+            return not self.busy and self.disk_signature() != self.loaded_signature
+
+    def nbytes(self) -> int:
+        """Approximate resident size of the index and chunks."""
+        if self._nbytes is None:
+            size = 0
+            if self.index is not None:
+                base = indexes.inner(self.index)
+                try:
+                    size += base.ntotal * base.sa_code_size()
+                except Exception:
+                    size += base.ntotal * base.d * 4
+                if self.index_kind == 'hnsw':
+                    # neighbour lists: ~2*M int32 links per vector on the base layer
+                    size += base.ntotal * base.hnsw.nb_neighbors(0) * 4
+                if indexes.has_ids(self.index):
+                    size += self.index.ntotal * 8
+            size += self.chunks.nbytes()
+            if self.raw is not None:
+                size += self.raw.nbytes()
+            if self.lexical is not None:
+                size += self.lexical.nbytes()
+            self._nbytes = size
+        return self._nbytes
+
+    # ---- persistence ----
+    def _append(self, docs, vecs, model=None, deleted=None, owners=None):
+        """Durably log a batch, then apply it. Cost is proportional to the batch only."""
+        if self.closed:
+            raise RuntimeError(f"KB '{self.name}' is closed (deleted).")
+        # ids are assigned before logging so replay reproduces them exactly
+        first = self.chunks.next_id
+        docs = [dict(doc, id=first + i) for i, doc in enumerate(docs)]
+        self.log.append(docs, vecs, model, deleted, owners)
+        self._apply(docs, vecs, model, deleted, owners)
+        self._nbytes = None
+        self.loaded_signature = self.disk_signature()
+        if (self.log.size() >= config.KB_COMPACT_LOG_BYTES or self._wanted_index_kind()
+                or (self._reclaim_wanted() and self._can_reclaim())):
+            self.compact(background=config.KB_COMPACT_IN_BACKGROUND)
+
+    def _rotate(self):
+        """
+        Start a new log generation and return (gen, index, chunks, exact vectors,
+        lexical index, settings, tombstones) copies for a snapshot.
+        """
+        self.log_gen += 1
+        self.log = segments.SegmentLog(segments.log_path(self.path, self.log_gen))
+        index_copy = faiss.clone_index(self.index) if self.index is not None else None
+        raw = self.raw.snapshot() if self.raw is not None else None
+        lexical = self.lexical.snapshot() if self.lexical is not None else None
+        metadata = dict(self.metadata, next_id=self.chunks.next_id, deletions=self.deletions,
+                        owners={str(cid): titles for cid, titles in self.owners.items()},
+                        owner_edits=self.owner_edits)
+        tombstones = np.array(sorted(self.tombstones), dtype='int64')
+        return self.log_gen, index_copy, self.chunks.snapshot(), raw, lexical, metadata, tombstones
+
+    def _write_snapshot(self, gen, index, chunks, raw, lexical, metadata, tombstones, drop=None):
+        """
+        Write base-<gen>/ atomically, point CURRENT at it and drop what it supersedes.
+        Chunks whose ids are in `drop` are left out of the snapshot. Returns the new
+        snapshot dir, or None if a newer snapshot was committed meanwhile.
+
+        The files are written holding only the commit lock, so appends carry on;
+        the commit itself holds the KB lock, so CURRENT, base_gen and
+        loaded_signature change together.
+        """
+        name = segments.base_name(gen)
+        final_dir = self.path / name
+        tmp_dir = self.path / (name + '.tmp')
+        with self._commit_lock:
+            # a deleted KB's folder must not be re-created
+            if gen <= self.base_gen or self.closed or not self.path.is_dir():
+                return None
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            tmp_dir.mkdir()
+            keep = None
+            if drop is not None and len(drop):
+                keep = ~np.isin(chunks.ids(), drop)
+                tombstones = np.setdiff1d(tombstones, drop)
+            chunks.write(tmp_dir, keep=keep)
+            if raw is not None and indexes.is_lossy(metadata.get('vector_storage')):
+                raw.write(tmp_dir, keep=keep)
+            if lexical is not None and len(lexical) == len(chunks):
+                lexical.write(tmp_dir, keep=keep)
+            if len(tombstones):
+                with open(tmp_dir / 'tombstones.npy', 'wb') as f:
+                    np.save(f, tombstones)
+                    f.flush()
+                    os.fsync(f.fileno())
+            segments.atomic_write_bytes(tmp_dir / 'kb.json', json.dumps(metadata).encode('utf-8'))
+            if index is not None:
+                faiss.write_index(index, str(tmp_dir / 'index.faiss'))
+                segments.fsync_file(tmp_dir / 'index.faiss')
+            segments.fsync_dir(tmp_dir)
+        with self._lock:
+            if gen <= self.base_gen or self.closed:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return None
+            shutil.rmtree(final_dir, ignore_errors=True)
+            os.replace(tmp_dir, final_dir)
+            segments.fsync_dir(self.path)
+            # commit point
+            segments.write_current(self.path, name, gen)
+            self.base_gen = gen
+            self._remove_superseded(gen)
+            # CURRENT just changed; without this KBCache would take the KB for
+            # one changed by another process and load a second copy of it
+            self.loaded_signature = self.disk_signature()
+            return final_dir
+
+    def _remove_superseded(self, gen):
+        for g in segments.list_log_gens(self.path):
+            if g < gen:
+                try:
+                    os.unlink(segments.log_path(self.path, g))
+                except OSError:
+                    pass
+        for p in self.path.glob('base-*'):
+            if p.name != segments.base_name(gen):
+                shutil.rmtree(p, ignore_errors=True)
+        for p in (self.index_path, self.meta_path):
+            try:
+                os.unlink(p)
+            except OSError:
                 pass
 
-    def add_document(self, title, text):
+    def _rebase(self, snap_dir, n_written):
+        """Serve chunks (exact vectors, postings) from the snapshot just written from now on."""
+        self.chunks = self.chunks.rebase(snap_dir, n_written)
+        if self.raw is not None and has_vector_column(snap_dir):
+            self.raw = self.raw.rebase(snap_dir, n_written)
+        if self.lexical is not None:
+            # positions may have been compacted; without postings on disk, rebuild on next use
+            self.lexical = self.lexical.rebase(snap_dir, n_written) if has_lexical_index(snap_dir) else None
+
+    def save(self):
+        """Write a full snapshot of the current state (used after an index rebuild)."""
+        with self._lock:
+            gen, index, chunks, raw, lexical, metadata, tombstones = self._rotate()
+            try:
+                snap_dir = self._write_snapshot(gen, index, chunks, raw, lexical, metadata, tombstones)
+                if snap_dir is not None:
+                    self._rebase(snap_dir, len(chunks))
+            finally:
+                self._nbytes = None
+                self.loaded_signature = self.disk_signature()
+
+    def compact(self, background=False):
+        """
+        Fold the write-ahead log into a fresh snapshot. Appends keep going to a new
+        log generation while the snapshot is written. If the KB has outgrown its
+        index kind (see indexes.choose_index_kind) or has deleted chunks to
+        reclaim, the index is rebuilt as part of the snapshot and swapped in once
+        caught up with concurrent appends.
+        """
+        with self._lock:
+            if self.closed:
+                return None
+            if self._compaction is not None and self._compaction.is_alive():
+                return self._compaction
+            new_kind = self._wanted_index_kind()
+            live_index = self.index
+            gen, index, chunks, raw, lexical, metadata, tombstones = self._rotate()
+            drop = tombstones if self._can_reclaim() else None
+            if drop is not None:
+                # a failed re-index's checkpoint is by position, which dropping invalidates
+                shutil.rmtree(self.path / REINDEX_DIR, ignore_errors=True)
+            self.loaded_signature = self.disk_signature()
+
+        def _run():
+            try:
+                new_index = None
+                if new_kind is not None or drop is not None:
+                    # rebuild from the exact vectors when the index only holds codes
+                    exact = raw.array() if raw is not None and index.ntotal == len(raw) else None
+                    new_index = indexes.rebuild_index(index, new_kind or indexes.index_kind(index),
+                                                      drop_ids=drop, storage=metadata.get('vector_storage'),
+                                                      vecs=exact)
+                snap_dir = self._write_snapshot(gen, new_index if new_index is not None else index,
+                                                chunks, raw, lexical, metadata, tombstones, drop=drop)
+                with self._lock:
+                    # a re-index may have swapped in a different index meanwhile; an index
+                    # without the dropped chunks only fits the chunks of our own snapshot
+                    swap = (new_index is not None and self.index is live_index
+                            and (drop is None or snap_dir is not None))
+                    if swap:
+                        # add whatever was appended to the live index since the rotation
+                        start = index.ntotal
+                        exact = None
+                        if (self.raw is not None and start == len(chunks)
+                                and self.index.ntotal == len(self.chunks)):
+                            exact = self.raw.rows(np.arange(start, self.index.ntotal))
+                        indexes.copy_vectors(self.index, new_index, start=start, vecs=exact)
+                        self.index = new_index
+                        if drop is not None:
+                            self.tombstones.difference_update(drop.tolist())
+                            self._selector = None
+                            self._dedup = None  # signatures of dropped chunks
+                    if snap_dir is not None and (drop is None or swap):
+                        self._rebase(snap_dir, len(chunks))
+                        if drop is not None and self.raw is not None and not has_vector_column(snap_dir):
+                            self.raw = None
+                    if swap and not indexes.is_lossy(self.vector_storage):
+                        self.raw = None
+                    self._nbytes = None
+            except Exception as e:
+                print(f"[vectorstore] compaction of KB '{self.name}' failed: {e}")
+            with self._lock:
+                self.loaded_signature = self.disk_signature()
+
+        if not background:
+            _run()
+            return None
+        self._compaction = threading.Thread(target=_run, name=f"kb-compact-{self.name}", daemon=True)
+        self._compaction.start()
+        return self._compaction
+
+    # ---- writes ----
+    def add_document(self, title, text, source=None, date=None) -> dict:
+        """
+        Add a document (a string, or an iterable of text pieces streamed through
+        the chunker) to the KB. Its chunks record `source` (e.g. "upload") and
+        `date` (when it was recorded; default now) for query filters. If the
+        active embedding model differs from the one this KB was indexed with,
+        the chunks are stored right away and a background job re-embeds the
+        whole KB with the new model (the old index keeps answering queries
+        until it is swapped out).
+
+        Chunks are embedded and logged CHUNK_INGEST_BATCH at a time as the
+        chunker produces them, so a long document is never held as one list
+        of chunks and its first batch is searchable before the rest is split.
+
+        Chunks duplicating live ones (or each other) are skipped; one held by
+        another document is shared with it instead (see self.owners). Returns
+        the dedup counts for this document (see _dedup_texts).
+        """
+        result = self._dedup_result(0)
+        if not text:
+            return result
+        chunks = iter_chunks([text] if isinstance(text, str) else text)
+        while True:
+            batch = list(islice(chunks, config.CHUNK_INGEST_BATCH))
+            if not batch:
+                return result
+            for key, n in self._ingest(title, batch, source=source, date=date).items():
+                result[key] += n
+
+    def add_chunks(self, title, chunks, source=None, date=None, replace=None) -> dict:
+        """
+        Add already-split `chunks` to document `title` (see add_document). The
+        live chunks of document `replace`, if given, are deleted in the same log
+        record, so no reader sees both (e.g. a provisional copy of the text).
+        """
+        chunks = [c for c in chunks if c]
+        if not chunks and replace is None:
+            return self._dedup_result(0)
+        return self._ingest(title, chunks, source=source, date=date, replace=replace)
+
+    def _ingest(self, title, chunks, source=None, date=None, replace=None) -> dict:
+        """
+        Dedup, embed and append `chunks` as document `title`, removing whatever
+        document `replace` holds when the record is written in the same record.
+        Chunks duplicating a live chunk of another document make `title` an
+        owner of that chunk instead.
+        """
+        attrs = {'source': source, 'date': to_timestamp(date) or int(time.time())}
+        excluded = set()
+        if replace is not None:
+            with self._lock:
+                excluded.update(self._release(replace)[0])
+        if self.dedup_enabled:
+            self._deduper()  # first ingest: build the signatures before taking the lock
+        with self._lock:
+            chunks, result, shared = self._dedup_texts(chunks, excluded)
+
+        # get embeddings for the chunks that survived text dedup
+        model = active_embedding_model()
+        vecs_new = np.zeros((0, 0), dtype='float32')
+        if chunks:
+            vecs_new = np.array(get_embeddings(chunks, model=model)).astype('float32')
+
+        with self._lock:
+            if chunks:
+                keep, matched = self._dedup_vectors(vecs_new, model, excluded)
+                result['semantic'] = int((~keep).sum())
+                shared.extend(matched)
+                chunks = [c for c, k in zip(chunks, keep) if k]
+                vecs_new = vecs_new[keep]
+            result['added'] = len(chunks)
+            self.dedup_stats['semantic'] += result['semantic']
+            deleted, owners = self._release(replace) if replace is not None else ([], {})
+            for cid in shared:
+                if cid in self.tombstones or cid in deleted:
+                    continue  # removed since it was matched
+                titles = owners.get(cid) or self._titles(cid)
+                if title not in titles:
+                    owners[cid] = titles + [title]
+            if chunks:
+                self._add_vectors(title, chunks, vecs_new, model, deleted=deleted, attrs=attrs, owners=owners)
+            elif deleted or owners:
+                self._append([], np.zeros((0, 0), dtype='float32'), deleted=deleted, owners=owners)
+        skipped = result['exact'] + result['near'] + result['semantic']
+        if skipped:
+            print(f"[vectorstore] KB '{self.name}': skipped {skipped} of {result['chunks']} chunks "
+                  f"of '{title}' as duplicates")
+        return result
+
+    @staticmethod
+    def _dedup_result(n) -> dict:
+        return {'chunks': n, 'added': n, 'exact': 0, 'near': 0, 'semantic': 0}
+
+    @property
+    def dedup_enabled(self) -> bool:
+        return self.metadata.get('dedup', config.DEDUP_ENABLED)
+
+    def _deduper(self) -> dedup.Deduper:
+        """Signatures of every chunk, built once from a snapshot so appends aren't blocked meanwhile."""
+        with self._lock:
+            if self._dedup is not None:
+                return self._dedup
+            view = self.chunks.snapshot()
+        d = dedup.Deduper()
+        for i in range(len(view)):
+            d.add(dedup.signature(view.text(i)), view.id(i))
+        with self._lock:
+            if self._dedup is None:
+                # chunks appended while the signatures were built
+                ids = self.chunks.ids()
+                for pos in np.flatnonzero(ids >= view.next_id).tolist():
+                    d.add(dedup.signature(self.chunks.text(pos)), int(ids[pos]))
+                self._dedup = d
+            return self._dedup
+
+    def _dedup_texts(self, chunks, excluded):
+        """
+        Drop chunks whose text (exactly or by SimHash) repeats a live chunk
+        (other than those in `excluded`, about to be deleted) or an earlier one
+        of `chunks`. Returns the chunks kept, the dedup counts and the ids of
+        the live chunks matched, which the document then shares.
+        """
+        result = self._dedup_result(len(chunks))
+        if not self.dedup_enabled:
+            return chunks, result, []
+        live = lambda cid: cid not in self.tombstones and cid not in excluded
+        found = self._deduper().find_duplicates([dedup.signature(c) for c in chunks], live)
+        shared = []
+        for dup in found:
+            if dup:
+                reason, cid = dup
+                result[reason] += 1
+                self.dedup_stats[reason] += 1
+                if cid is not None:
+                    shared.append(cid)
+        self.dedup_stats['checked'] += len(chunks)
+        return [c for c, dup in zip(chunks, found) if dup is None], result, shared
+
+    def _dedup_vectors(self, vecs, model, excluded):
+        """
+        (mask of vectors to keep, ids of the chunks matched): False where a live
+        chunk not in `excluded` is a near-identical embedding.
+        """
+        keep = np.ones(len(vecs), dtype=bool)
+        threshold = config.DEDUP_EMBEDDING_THRESHOLD
+        if (not self.dedup_enabled or threshold is None or self.index is None
+                or self.index.ntotal == 0 or not self._indexable(vecs, model)):
+            return keep, []
+        allowed = self._live_mask()
+        if excluded:
+            allowed &= ~np.isin(self.chunks.ids(), np.fromiter(excluded, dtype='int64'))
+        positions, D = self._vector_search(vecs, 1, rerank=False, allowed=allowed)
+        # cosine similarity from the L2 distance, taking the neighbour's norm to be the
+        # query's (true for normalized embeddings and for near-duplicates generally)
+        sq_norms = (vecs ** 2).sum(axis=1)
+        sims = 1.0 - D[:, 0] / np.maximum(2.0 * sq_norms, 1e-12)
+        dup = (positions[:, 0] >= 0) & (sims >= threshold)
+        keep[dup] = False
+        return keep, [self.chunks.id(int(pos)) for pos in positions[dup, 0]]
+
+    def remove_document(self, title) -> int:
         """
-        Add a document to the KB. Handles embedding-dimension mismatches by rebuilding
-        the FAISS index using the current embedding model if needed.
+        Delete every chunk of document `title`; chunks it shares with other
+        documents stay, owned by those. The chunks stop matching queries at
+        once; their space is reclaimed by the next compaction. Returns the
+        number of chunks removed from the document.
         """
+        with self._lock:
+            deleted, owners = self._release(title)
+            if deleted or owners:
+                self._append([], np.zeros((0, 0), dtype='float32'), deleted=deleted, owners=owners)
+            return len(deleted) + len(owners)
+
+    def replace_document(self, title, text, source=None, date=None) -> dict:
+        """Replace document `title` with `text` (old chunks removed in the same log record)."""
         chunks = split_text_into_chunks(text)
         if not chunks:
-            return
+            self.remove_document(title)
+            return self._dedup_result(0)
+        return self._ingest(title, chunks, source=source, date=date, replace=title)
 
-        # get embeddings for new chunks
-        embs_new = get_embeddings(chunks)
-        import numpy as _np
-        vecs_new = _np.array(embs_new).astype('float32')
-        new_dim = vecs_new.shape[1]
+    def _titles(self, cid) -> List[str]:
+        """Titles of the documents owning live chunk `cid`."""
+        if cid in self.owners:
+            return list(self.owners[cid])
+        return [self.chunks.title(int(self.chunks.positions(np.array([cid]))[0]))]
 
-        # If no index, create new index and add
-        if self.index is None:
-            self.index = faiss.IndexFlatL2(new_dim)
-            self.index.add(vecs_new)
-            for c in chunks:
-                self.metadata['docs'].append({'title': title, 'text': c})
-            self.save()
-            return
-
-        # If index exists, check dimension compatibility
+    def _live_ids(self, title) -> List[int]:
+        """Ids of the live chunks owned by document `title` (its own and the ones it shares)."""
+        ids = {int(i) for i in self.chunks.ids_for_title(title)} - self.owners.keys()
+        ids.update(cid for cid, titles in self.owners.items() if title in titles)
+        return sorted(i for i in ids if i not in self.tombstones)
+
+    def _release(self, title):
+        """
+        (ids to delete, new owners of shared chunks) for removing document
+        `title`: its chunks go unless another document owns them too.
+        """
+        deleted, owners = [], {}
+        for cid in self._live_ids(title):
+            rest = [t for t in self._titles(cid) if t != title]
+            if rest:
+                owners[cid] = rest
+            else:
+                deleted.append(cid)
+        return deleted, owners
+
+    def _add_vectors(self, title, chunks, vecs_new, model=None, deleted=None, attrs=None, owners=None):
+        new_docs = [dict(attrs or {}, title=title, text=c) for c in chunks]
+        if (self.metadata.get('embedding_model') is None and self.index is not None
+                and self.index.d == vecs_new.shape[1]):
+            # KBs from before the model was recorded: same dimension, assume same model
+            self.metadata['embedding_model'] = model
+
+        self._append(new_docs, vecs_new, model, deleted, owners)
+        if self.metadata.get('embedding_model') != model or self.index.ntotal != len(self.chunks):
+            # EMBEDDING MODEL CHANGED -> re-embed everything in the background
+            self.reindex(model)
+
+    def reindex(self, model: str) -> ReindexJob:
+        """
+        Start (or resume) re-embedding every chunk with `model`. If a job is already
+        running it is returned instead; a later add re-triggers for a newer model.
+        """
+        with self._lock:
+            if self._reindex is not None and self._reindex.is_alive():
+                return self._reindex
+            self._reindex = ReindexJob(self, model)
+            self._reindex.start()
+            return self._reindex
+
+    def reindex_status(self) -> Optional[dict]:
+        return self._reindex.status() if self._reindex is not None else None
+
+
+    @property
+    def version(self):
+        """
+        Changes whenever the searchable content does: any added chunk bumps
+        next_id, any removal bumps deletions, a document taking or giving up a
+        shared chunk bumps owner_edits, and re-indexing changes the model. The
+        counters only grow (compaction reclaiming tombstones leaves them alone),
+        so a version is never seen again once the KB has changed.
+        """
+        with self._lock:
+            return (self.metadata.get('embedding_model'), self.chunks.next_id, self.deletions,
+                    self.owner_edits)
+
+    def embed_query(self, query_text) -> np.ndarray:
+        """(1, d) float32 embedding of `query_text`, as query() computes it."""
+        return self.embed_queries([query_text])
+
+    def embed_queries(self, query_texts) -> np.ndarray:
+        """(n, d) float32 embeddings of `query_texts`, in one embedding batch."""
+        # embed with the model the serving index was built with (matters mid re-index)
+        q_embs = get_embeddings(list(query_texts), model=self.metadata.get('embedding_model'))
+        return np.array(q_embs, dtype='float32').reshape(len(q_embs), -1)
+
+    def chunk_vectors(self, ids) -> np.ndarray:
+        """Stored vectors of chunks `ids`: exact if the KB keeps them, else as the index holds them."""
+        ids = np.asarray(ids, dtype='int64')
+        with self._lock:
+            if self.raw is not None and len(self.raw) == len(self.chunks):
+                positions = self.chunks.positions(ids)
+                if (positions >= 0).all():
+                    return self.raw.rows(positions)
+            return indexes.vectors_for_ids(self.index, ids)
+
+    def documents(self, source=None) -> List[str]:
+        """Titles of the documents with live chunks (from `source`, if given), sorted."""
+        with self._lock:
+            mask = self._live_mask() & self.chunks.mask(source=source)
+            shared = self._shared_mask()
+            titles = set(self.chunks.distinct('title', mask & ~shared))
+            for pos in np.flatnonzero(mask & shared).tolist():
+                titles.update(self.owners[self.chunks.id(pos)])
+            return sorted(t for t in titles if t is not None)
+
+    def sources(self) -> List[str]:
+        """Distinct sources of the live chunks, sorted."""
+        with self._lock:
+            return sorted(s for s in self.chunks.distinct('source', self._live_mask()) if s is not None)
+
+    # ---- retrieval ----
+    @property
+    def retrieval_setting(self) -> str:
+        return self.metadata.get('retrieval', config.KB_RETRIEVAL_MODE)
+
+    def set_retrieval_mode(self, mode: str):
+        """Default retrieval for this KB: one of RETRIEVAL_MODES."""
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode '{mode}'. Use one of {', '.join(RETRIEVAL_MODES)}.")
+        with self._lock:
+            self.metadata['retrieval'] = mode
+        self.save()
+
+    def retrieval_mode(self, query_text, mode=None, filters=None) -> str:
+        """
+        How query() will search for `query_text`: "vector", "lexical" or
+        "hybrid". In "auto" mode, keyword queries (see _is_keyword_query) go
+        lexical-only, which needs no embedding call; the rest are hybrid.
+        """
+        mode = mode or self.retrieval_setting
+        if mode == 'auto':
+            return 'lexical' if self._is_keyword_query(query_text, filters) else 'hybrid'
+        return mode
+
+    def _is_keyword_query(self, query_text, filters=None) -> bool:
+        text = (query_text or '').strip()
+        if len(text) > 2 and text[0] == text[-1] == '"':
+            return True
+        terms = tokenize(text)
+        if not terms or len(terms) > config.KB_KEYWORD_MAX_TERMS or text.endswith('?'):
+            return False
+        if terms[0] in _QUESTION_WORDS:
+            return False
+        # every term must occur in a live chunk (matching `filters`), or semantic
+        # search has more to offer; the vocabulary alone still has deleted chunks' terms
+        with self._lock:
+            lexical = self._lexical_index()
+            tids = [lexical.term_id(t) for t in terms]
+            if any(tid is None for tid in tids):
+                return False
+            allowed = self._allowed(filters)
+            if allowed is None and self.tombstones:
+                allowed = self._live_mask()
+            for tid in tids:
+                positions, _ = lexical.postings(tid)
+                if not len(positions) or (allowed is not None and not allowed[positions].any()):
+                    return False
+            return True
+
+    def _lexical_index(self) -> LexicalIndex:
+        with self._lock:
+            if self.lexical is None or len(self.lexical) != len(self.chunks):
+                self.lexical = LexicalIndex.from_texts(self.chunks.texts())
+                self._nbytes = None
+            return self.lexical
+
+    def _allowed(self, filters) -> Optional[np.ndarray]:
+        """Position mask of the live chunks matching `filters`, or None when unfiltered."""
+        if not filters:
+            return None
+        unknown = set(filters) - set(FILTER_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown filter {', '.join(sorted(unknown))}. Use {', '.join(FILTER_KEYS)}.")
+        allowed = self.chunks.mask(**filters) & self._live_mask()
+        title = filters.get('title')
+        if title is not None and self.owners:
+            # a shared chunk matches by any of its owners, not the title it was stored under
+            wanted = {title} if isinstance(title, str) else set(title)
+            rest = self.chunks.mask(**{k: v for k, v in filters.items() if k != 'title'}) & self._live_mask()
+            positions = self.chunks.positions(np.fromiter(self.owners, dtype='int64'))
+            owned = np.fromiter((not wanted.isdisjoint(t) for t in self.owners.values()), dtype=bool,
+                                count=len(self.owners))
+            positions, owned = positions[positions >= 0], owned[positions >= 0]
+            allowed[positions] = rest[positions] & owned
+        return allowed
+
+    def _shared_mask(self) -> np.ndarray:
+        """Position mask of the chunks with an owners list (see self.owners)."""
+        if not self.owners:
+            return np.zeros(len(self.chunks), dtype=bool)
+        return np.isin(self.chunks.ids(), np.fromiter(self.owners, dtype='int64'))
+
+    def _live_mask(self) -> np.ndarray:
+        if not self.tombstones:
+            return np.ones(len(self.chunks), dtype=bool)
+        return ~np.isin(self.chunks.ids(), np.fromiter(self.tombstones, dtype='int64'))
+
+    def _lexical_search(self, query_text, k, allowed=None):
+        """(positions, BM25 scores) of the top `k` live chunks (within the `allowed` mask)."""
+        excluded = None
+        if allowed is not None:
+            excluded = lambda positions: ~allowed[positions]
+        elif self.tombstones:
+            gone = np.fromiter(self.tombstones, dtype='int64')
+            ids = self.chunks.ids()
+            excluded = lambda positions: np.isin(ids[positions], gone)
+        return self._lexical_index().search(query_text, k, excluded=excluded)
+
+    def _vector_search(self, q_vecs, k, nprobe=None, ef_search=None, rerank=None, allowed=None):
+        """
+        (positions, L2 distances) of the `k` nearest live chunks for each row of
+        `q_vecs`, as (n, k) arrays padded with -1 / inf, from one index.search.
+
+        With an `allowed` position mask the index only visits the matching
+        chunk ids (a bitmap ID selector); subsets of at most KB_FILTER_EXACT_MAX
+        chunks are instead scanned exactly from their stored vectors.
+        """
+        nq = len(q_vecs)
+        none = np.full((nq, k), -1, dtype='int64'), np.full((nq, k), np.inf, dtype='float32')
+        if self.index is None or self.index.ntotal == 0:
+            return none
+        if allowed is not None:
+            subset = np.flatnonzero(allowed)
+            if not len(subset):
+                return none
+            if len(subset) <= config.KB_FILTER_EXACT_MAX:
+                found = self._exact_search(q_vecs, k, subset)
+                if found is not None:
+                    return found
+            sel = indexes.include_selector(self.chunks.ids()[subset], self.chunks.next_id)
+        else:
+            sel = self._exclude_selector()
+        if rerank is None:
+            rerank = self.metadata.get('rerank', config.KB_RERANK)
+        rerank = (rerank and self.raw is not None and self.raw.dim == q_vecs.shape[1]
+                  and len(self.raw) == len(self.chunks))
+        fetch = k * config.KB_RERANK_FACTOR if rerank else k
+        params = indexes.search_params(self.index, nprobe=nprobe, ef_search=ef_search, sel=sel)
+        D, I = self.index.search(q_vecs, fetch, params=params)
+        # labels are chunk ids; map them back to chunk positions
+        positions = self.chunks.positions(I)
+        # approximate indexes may return fewer than k hits
+        found = positions >= 0
+        dists = np.where(found, D, np.inf).astype('float32')
+        if rerank:
+            rows, cols = np.nonzero(found)
+            exact = self.raw.rows(positions[rows, cols]) - q_vecs[rows]
+            dists[rows, cols] = (exact ** 2).sum(axis=1)
+        # misses (inf) sort last; stable keeps the index's order among equals
+        order = np.argsort(dists, axis=1, kind='stable')[:, :k]
+        positions = np.take_along_axis(positions, order, axis=1)
+        dists = np.take_along_axis(dists, order, axis=1)
+        positions[~np.isfinite(dists)] = -1
+        return positions, dists
+
+    def _exact_search(self, q_vecs, k, subset):
+        """Brute-force _vector_search over the chunks at positions `subset`; None if their vectors can't be read."""
         try:
-            existing_dim = self.index.d
+            vecs = self.chunk_vectors(self.chunks.ids()[subset])
         except Exception:
-            # if index object doesn't expose .d, fallback to rebuilding
-            existing_dim = None
-
-        if existing_dim == new_dim:
-            # append new vectors
-            self.index.add(vecs_new)
-            for c in chunks:
-                self.metadata['docs'].append({'title': title, 'text': c})
-            self.save()
-            return
-
-        # DIMENSION MISMATCH -> rebuild index by re-embedding all docs with current model
-        try:
-            existing_texts = [doc['text'] for doc in self.metadata.get('docs', [])]
-            all_texts = existing_texts + chunks
-            all_embs = get_embeddings(all_texts)
-            all_vecs = _np.array(all_embs).astype('float32')
-            dim = all_vecs.shape[1]
-
-            # build new index
-            new_index = faiss.IndexFlatL2(dim)
-            new_index.add(all_vecs)
-
-            # reconstruct metadata
-            new_metadata = []
-            for doc in self.metadata.get('docs', []):
-                new_metadata.append({'title': doc.get('title'), 'text': doc.get('text')})
-            for c in chunks:
-                new_metadata.append({'title': title, 'text': c})
-
-            # replace index + metadata
-            self.index = new_index
-            self.metadata['docs'] = new_metadata
-            self.save()
-            return
+            return None
+        if vecs.shape[1] != q_vecs.shape[1]:
+            return None
+        dists = ((q_vecs ** 2).sum(axis=1)[:, None] - 2.0 * (q_vecs @ vecs.T)
+                 + (vecs ** 2).sum(axis=1)[None, :])
+        order = np.argsort(dists, axis=1, kind='stable')[:, :k]
+        positions = np.full((len(q_vecs), k), -1, dtype='int64')
+        out = np.full((len(q_vecs), k), np.inf, dtype='float32')
+        positions[:, :order.shape[1]] = subset[order]
+        out[:, :order.shape[1]] = np.maximum(np.take_along_axis(dists, order, axis=1), 0.0)
+        return positions, out
 
-        except Exception as e:
-            raise RuntimeError(
-                "Failed to rebuild FAISS index after detecting embedding-dimension mismatch. "
-                "Details: " + str(e) + ".\n"
-                "As a fallback you can delete the KB folder and re-add documents: "
-                f"rm -rf {self.path}"
-            )
-
-    def query(self, query_text, top_k=4):
-        q_emb = get_embeddings([query_text])[0]
-        q_vec = np.array(q_emb).astype('float32').reshape(1, -1)
-        if self.index is None or (hasattr(self.index, 'ntotal') and self.index.ntotal == 0):
-            return []
-        D, I = self.index.search(q_vec, top_k)
-        results = []
-        for dist, idx in zip(D[0], I[0]):
+    def _hits(self, positions, scores) -> List[List[dict]]:
+        """Result dicts for (n, k) `positions` (-1 = no hit) and their `scores`, per row."""
+        found = positions >= 0
+        unique, inverse = np.unique(positions[found], return_inverse=True)
+        docs = []
+        for pos in unique.tolist():
             try:
-                doc = self.metadata['docs'][idx]
+                doc = self.chunks[pos]
+                if doc.get('id') in self.owners:
+                    # the first document still holding it
+                    doc['title'] = self.owners[doc['id']][0]
+                docs.append(doc)
             except Exception:
-                doc = {'title': None, 'text': '[missing]'}
-            results.append({'score': float(dist), 'text': doc.get('text'), 'title': doc.get('title')})
-        return results
+                docs.append({'title': None, 'text': '[missing]'})
+        # one split of the flat hit list per query row
+        bounds = np.cumsum(found.sum(axis=1))[:-1]
+        flat = [{'score': score, 'text': docs[j].get('text'), 'title': docs[j].get('title'),
+                 'id': docs[j].get('id'), 'source': docs[j].get('source'), 'date': docs[j].get('date')}
+                for j, score in zip(inverse.tolist(), scores[found].astype('float64').tolist())]
+        return [flat[a:b] for a, b in zip(np.concatenate([[0], bounds]).tolist(),
+                                           np.concatenate([bounds, [len(flat)]]).tolist())]
+
+    def query(self, query_text, top_k=4, nprobe=None, ef_search=None, rerank=None, query_vector=None,
+              mode=None, filters=None):
+        """
+        Return the `top_k` best chunks for `query_text`.
+
+        `mode` (default: the KB's 'retrieval' setting, see retrieval_mode)
+        picks vector search, BM25 over the KB's inverted index, or both fused
+        by reciprocal rank (KB_HYBRID_CANDIDATES x top_k from each). A hit's
+        'score' is its L2 distance, BM25 score or fused RRF score accordingly.
+
+        `nprobe` (IVF) and `ef_search` (HNSW) override the index's search-time
+        defaults for this query only. When the index stores lossy codes,
+        `rerank` (default: the KB's 'rerank' setting) fetches KB_RERANK_FACTOR x
+        more candidates and orders them by exact distance. Pass `query_vector`
+        (from embed_query) to skip embedding.
+
+        `filters` restricts the search to chunks whose attributes match, e.g.
+        {'title': [...], 'source': 'live', 'since': '2026-01-01'} (keys in
+        FILTER_KEYS, see ChunkStore.mask); only matching chunks are searched,
+        so all `top_k` slots go to them.
+        """
+        return self.query_batch([query_text], top_k, nprobe=nprobe, ef_search=ef_search, rerank=rerank,
+                                query_vectors=query_vector, mode=mode, filters=filters)[0]
+
+    def query_batch(self, query_texts, top_k=4, nprobe=None, ef_search=None, rerank=None,
+                    query_vectors=None, mode=None, filters=None) -> List[List[dict]]:
+        """
+        query() for many queries at once: one list of hits per query. The
+        queries that need vectors are embedded in one batch (or taken from the
+        (n, d) `query_vectors`) and searched with a single index.search.
+        """
+        query_texts = list(query_texts)
+        if not query_texts:
+            return []
+        modes = [self.retrieval_mode(q, mode, filters) for q in query_texts]
+        for m in set(modes):
+            if m not in RETRIEVAL_MODES or m == 'auto':
+                raise ValueError(f"Unknown retrieval mode '{m}'. Use one of {', '.join(RETRIEVAL_MODES)}.")
+        dense_rows = [i for i, m in enumerate(modes) if m != 'lexical']
+        fetch = top_k * config.KB_HYBRID_CANDIDATES if 'hybrid' in modes else top_k
+        q_vecs = None
+        if dense_rows:
+            if query_vectors is None:
+                q_vecs = self.embed_queries([query_texts[i] for i in dense_rows])
+            else:
+                q_vecs = np.asarray(query_vectors, dtype='float32').reshape(len(query_texts), -1)[dense_rows]
+        positions = np.full((len(query_texts), top_k), -1, dtype='int64')
+        scores = np.full((len(query_texts), top_k), np.inf, dtype='float32')
+        with self._lock:
+            allowed = self._allowed(filters)
+            if dense_rows:
+                dense, dists = self._vector_search(q_vecs, fetch, nprobe, ef_search, rerank, allowed)
+                vector_rows = [j for j, i in enumerate(dense_rows) if modes[i] == 'vector']
+                positions[[dense_rows[j] for j in vector_rows]] = dense[vector_rows, :top_k]
+                scores[[dense_rows[j] for j in vector_rows]] = dists[vector_rows, :top_k]
+            dense_of = {i: j for j, i in enumerate(dense_rows)}
+            for i, m in enumerate(modes):
+                if m == 'vector':
+                    continue
+                # BM25 has no matrix form; lexical and hybrid rows are scored one by one
+                if m == 'lexical':
+                    pos, sc = self._lexical_search(query_texts[i], top_k, allowed)
+                else:
+                    sparse, _ = self._lexical_search(query_texts[i], fetch, allowed)
+                    row = dense[dense_of[i]]
+                    pos, sc = rrf_fuse([row[row >= 0], sparse], top_k)
+                positions[i, :len(pos)], scores[i, :len(pos)] = pos, sc
+            return self._hits(positions, scores)
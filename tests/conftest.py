@@ -0,0 +1,42 @@
+import hashlib
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import config  # noqa: E402
+import services.reindex as reindex  # noqa: E402
+import services.vectorstore as vectorstore  # noqa: E402
+from services.lexical import tokenize  # noqa: E402
+
+DIM = 16
+
+
+def fake_embeddings(texts, model=None):
+    """Normalized bag-of-words vectors (words hashed into DIM buckets), so similar texts are near."""
+    out = []
+    for text in texts:
+        vec = np.full(DIM, 1e-3, dtype="float32")
+        for word in tokenize(text):
+            vec[int.from_bytes(hashlib.md5(word.encode()).digest()[:4], "little") % DIM] += 1.0
+        out.append((vec / np.linalg.norm(vec)).tolist())
+    return out
+
+
+@pytest.fixture
+def kb(tmp_path, monkeypatch):
+    """Empty KB embedding locally, compacting in the foreground so tests are deterministic."""
+    monkeypatch.setattr(vectorstore, "get_embeddings", fake_embeddings)
+    monkeypatch.setattr(reindex, "get_embeddings", fake_embeddings)
+    monkeypatch.setattr(vectorstore, "active_embedding_model", lambda: "fake")
+    monkeypatch.setattr(config, "KB_COMPACT_IN_BACKGROUND", False)
+    return vectorstore.KB("test", tmp_path / "kb")
+
+
+@pytest.fixture
+def manager(tmp_path, kb):
+    """KBManager over a private cache that revalidates on every get."""
+    return vectorstore.KBManager(str(tmp_path / "kbs"), cache=vectorstore.KBCache(check_interval=0.0))
@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+from services import batching
+from services.batching import pack_batches, run_batched
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+
+class FakeClient:
+    """Embeds a batch as each text's length; fails the first call of `fail_first` batches with a 429."""
+
+    def __init__(self, fail_first=0):
+        self.fail_first = fail_first
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def embed(self, batch):
+        with self._lock:
+            self.batches.append(list(batch))
+            if self.fail_first:
+                self.fail_first -= 1
+                raise RateLimited("slow down")
+        return [len(text) for text in batch]
+
+
+TEXTS = [f"text number {i} " + "x" * (i % 7) for i in range(25)]
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_results_are_in_input_order_across_batches(max_workers):
+    client = FakeClient()
+    out = run_batched(client.embed, TEXTS, max_items=4, max_workers=max_workers)
+    assert out == [len(t) for t in TEXTS]
+    assert len(client.batches) == len(pack_batches(TEXTS, max_items=4)) == 7
+    assert sorted(t for batch in client.batches for t in batch) == sorted(TEXTS)
+
+
+def test_token_limit_splits_batches(monkeypatch):
+    monkeypatch.setattr(batching, "estimate_tokens", len)  # same counts with or without tiktoken
+    assert pack_batches(["a" * 10] * 5, max_tokens=25) == [[0, 1], [2, 3], [4]]
+    assert pack_batches(["a" * 40, "b"], max_tokens=25) == [[0], [1]]  # oversized text alone
+
+
+def test_rate_limited_batch_backs_off_and_retries():
+    client = FakeClient(fail_first=1)
+    sleeps = []
+    out = run_batched(client.embed, TEXTS[:3], max_workers=1, sleep=sleeps.append)
+    assert out == [len(t) for t in TEXTS[:3]]
+    assert len(client.batches) == 2 and client.batches[0] == client.batches[1]
+    assert len(sleeps) == 1 and sleeps[0] > 0
+
+
+def test_rate_limit_gives_up_after_max_retries():
+    client = FakeClient(fail_first=10)
+    with pytest.raises(RateLimited):
+        run_batched(client.embed, TEXTS[:3], max_retries=2, sleep=lambda _: None)
+    assert len(client.batches) == 3
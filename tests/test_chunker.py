@@ -0,0 +1,49 @@
+import random
+
+import pytest
+
+from services.chunker import iter_chunks, split_text_into_chunks
+
+WORDS = "the budget meeting moved to friday because two bugs blocked the upload flow".split()
+TEXT = "\n".join(
+    ". ".join(" ".join(random.Random(p * 10 + s).choices(WORDS, k=9)) for s in range(4)) + "."
+    for p in range(30))
+
+
+def _pieces(text, seed):
+    """`text` cut at random places into pieces of 1-40 characters."""
+    rng = random.Random(seed)
+    pieces, i = [], 0
+    while i < len(text):
+        n = rng.randint(1, 40)
+        pieces.append(text[i:i + n])
+        i += n
+    return pieces
+
+
+@pytest.mark.parametrize("unit", ["chars", "tokens"])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_streamed_pieces_chunk_like_the_whole_text(unit, seed):
+    whole = list(iter_chunks([TEXT], max_len=120, overlap=20, unit=unit))
+    assert len(whole) > 10
+    assert list(iter_chunks(_pieces(TEXT, seed), max_len=120, overlap=20, unit=unit)) == whole
+    assert list(iter_chunks(iter(TEXT), max_len=120, overlap=20, unit=unit)) == whole  # one char at a time
+
+
+def test_chunks_fit_and_overlap():
+    chunks = split_text_into_chunks(TEXT, max_len=120, overlap=20, unit="chars")
+    assert all(len(c) <= 120 for c in chunks)
+    # each chunk starts inside the end of the one before
+    assert all(b[:10] in a[-30:] for a, b in zip(chunks, chunks[1:]))
+
+
+@pytest.mark.parametrize("overlap", [120, 500])
+def test_overlap_of_a_window_or_more_is_dropped(overlap):
+    chunks = split_text_into_chunks(TEXT, max_len=120, overlap=overlap, unit="chars")
+    assert chunks == split_text_into_chunks(TEXT, max_len=120, overlap=0, unit="chars")
+    assert " ".join(chunks).split() == TEXT.split()
+
+
+def test_unknown_unit_is_rejected():
+    with pytest.raises(ValueError):
+        split_text_into_chunks(TEXT, unit="words")
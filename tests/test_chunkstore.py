@@ -0,0 +1,99 @@
+from datetime import date, datetime, timezone
+
+import numpy as np
+
+from services.chunkstore import ChunkStore, VectorColumn, to_timestamp
+
+
+def _store(n, start=0):
+    return ChunkStore.from_docs({"title": f"doc{i % 3}", "text": f"chunk {i}"} for i in range(start, start + n))
+
+
+def test_snapshot_ignores_later_appends():
+    store = _store(3)
+    view = store.snapshot()
+    store.append({"title": "doc9", "text": "late"})
+    assert len(view) == 3 and len(store) == 4
+    assert view.next_id == 3 and store.next_id == 4
+
+
+def test_reopened_store_matches_written_one(tmp_path):
+    store = _store(4)
+    store.append({"title": "x", "text": "ünïcode text"})
+    store.write(tmp_path)
+    reopened = ChunkStore(tmp_path)
+    assert [reopened[i] for i in range(len(reopened))] == [store[i] for i in range(len(store))]
+    assert reopened.next_id == store.next_id
+
+
+def test_rebase_serves_snapshot_plus_later_appends(tmp_path):
+    store = _store(3)
+    view = store.snapshot()
+    store.append({"title": "doc9", "text": "after snapshot"})  # appended while the snapshot is written
+    view.write(tmp_path)
+    rebased = store.rebase(tmp_path, len(view))
+    assert [rebased.text(i) for i in range(len(rebased))] == ["chunk 0", "chunk 1", "chunk 2", "after snapshot"]
+    assert rebased.ids_for_title("doc9").tolist() == [3]
+
+
+def test_rebase_keeps_ids_and_renumbers_positions(tmp_path):
+    store = _store(6)
+    view = store.snapshot()
+    store.extend([{"title": "doc9", "text": "after snapshot"}])  # appended while the snapshot is written
+    keep = ~np.isin(view.ids(), [1, 4])
+    view.write(tmp_path, keep=keep)
+
+    rebased = store.rebase(tmp_path, len(view))
+    assert rebased.ids().tolist() == [0, 2, 3, 5, 6]
+    assert [rebased.text(i) for i in range(len(rebased))] == ["chunk 0", "chunk 2", "chunk 3", "chunk 5",
+                                                               "after snapshot"]
+    assert rebased.positions([0, 1, 5, 6]).tolist() == [0, -1, 3, 4]
+    assert rebased.ids_for_title("doc1").tolist() == []  # both of its chunks were dropped
+    # ids are never reused after a compaction
+    assert rebased.append({"title": "doc9", "text": "new"}) == 7
+
+
+def test_vector_column_rebase_drops_rows(tmp_path):
+    col = VectorColumn.from_array(np.arange(12, dtype="float32").reshape(4, 3))
+    view = col.snapshot()
+    col.append(np.full((1, 3), 99, dtype="float32"))
+    view.write(tmp_path, keep=np.array([True, False, True, True]))
+    rebased = col.rebase(tmp_path, len(view))
+    np.testing.assert_array_equal(rebased.array()[:, 0], [0, 6, 9, 99])
+
+
+def test_mask_filters_by_attributes(tmp_path):
+    store = ChunkStore.from_docs([
+        {"title": "a", "text": "1", "source": "upload", "date": "2026-01-01"},
+        {"title": "b", "text": "2", "source": "live", "date": "2026-02-01"},
+        {"title": "a", "text": "3", "source": "live", "date": "2026-03-01"},
+        {"title": "c", "text": "4"},  # no source, no date
+    ])
+    assert store.mask().tolist() == [True] * 4
+    assert store.mask(title="a").tolist() == [True, False, True, False]
+    assert store.mask(title=["b", "c"]).tolist() == [False, True, False, True]
+    assert store.mask(title="missing").tolist() == [False] * 4
+    assert store.mask(source="live", title="a").tolist() == [False, False, True, False]
+    assert store.mask(since="2026-02-01").tolist() == [False, True, True, False]
+    assert store.mask(until="2026-02-01").tolist() == [True, True, False, False]
+    assert store.mask(since=to_timestamp("2026-01-15"), until="2026-02-15").tolist() == [False, True, False, False]
+
+    # the same answers from a snapshot on disk plus an in-memory tail
+    store.write(tmp_path)
+    reopened = ChunkStore(tmp_path)
+    reopened.append({"title": "a", "text": "5", "source": "upload", "date": "2026-04-01"})
+    assert reopened.mask(title="a", source="upload").tolist() == [True, False, False, False, True]
+    assert reopened.distinct("source") == [None, "upload", "live"]
+
+
+def test_until_a_day_includes_all_of_it():
+    store = ChunkStore.from_docs([
+        {"title": "a", "text": "1", "date": "2026-01-31T00:00:00"},
+        {"title": "a", "text": "2", "date": "2026-01-31T15:00:00"},
+        {"title": "a", "text": "3", "date": "2026-02-01T00:00:00"},
+    ])
+    assert store.mask(until="2026-01-31").tolist() == [True, True, False]
+    assert store.mask(until=date(2026, 1, 31)).tolist() == [True, True, False]
+    # with a time of day, `until` is that instant
+    assert store.mask(until="2026-01-31T12:00:00").tolist() == [True, False, False]
+    assert store.mask(until=datetime(2026, 1, 31, 15, tzinfo=timezone.utc)).tolist() == [True, True, False]
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from services import context
+from services.context import pack_context
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    """Count a word as a token, with or without tiktoken."""
+    monkeypatch.setattr(context, "estimate_tokens", lambda text: len(text.split()))
+
+
+def _doc(cid, text, title="talk"):
+    return {"id": cid, "title": title, "text": text}
+
+
+QUERY = np.array([1.0, 0.0, 0.0], dtype="float32")
+
+
+def test_mmr_skips_a_near_identical_passage():
+    candidates = [_doc(1, "the budget grows next quarter"),
+                  _doc(5, "the budget grows next quarter again"),
+                  _doc(9, "hiring stays frozen until spring")]
+    vectors = np.array([[0.8, 0.6, 0.0], [0.8, 0.6, 0.01], [0.7, -0.714, 0.0]], dtype="float32")
+    _, chosen, _ = pack_context(candidates, 2, QUERY, vectors)
+    assert [d["id"] for d in chosen] == [1, 9]
+    # without vectors the retrieval order stands
+    _, chosen, _ = pack_context(candidates, 2)
+    assert [d["id"] for d in chosen] == [1, 5]
+
+
+def test_token_budget_skips_passages_that_do_not_fit():
+    candidates = [_doc(1, "word " * 40), _doc(5, "word " * 100), _doc(9, "word " * 30)]
+    text, chosen, stats = pack_context(candidates, 3, token_budget=80)
+    assert [d["id"] for d in chosen] == [1, 9]
+    assert stats["context_tokens"] == len(text.split()) == 70 <= 80
+    assert stats["naive_tokens"] == 170 and stats["saved_tokens"] == 100
+
+
+def test_adjacent_chunks_merge_without_the_repeated_text():
+    first = "The meeting opened with the budget review for the next quarter"
+    second = "the budget review for the next quarter and then moved on to hiring"
+    text, chosen, stats = pack_context([_doc(2, second), _doc(1, first)], 2)
+    assert text == "The meeting opened with the budget review for the next quarter and then moved on to hiring"
+    assert stats["chosen"] == 2 and stats["passages"] == 1
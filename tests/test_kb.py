@@ -0,0 +1,161 @@
+import pytest
+
+import config
+from services import segments
+from services.vectorstore import KB
+
+DOCS = {
+    "alpha": "alpha3 opens the meeting. The budget for the next quarter is discussed at length.",
+    "beta": "The beta release ships on friday. Testing found two bugs in the upload flow.",
+    "gamma": "Gamma ray bursts are the brightest events. Astronomers track them with satellites.",
+    "delta": "Delta airlines changed the schedule. Flights to the coast leave earlier now.",
+}
+QUERIES = ["budget meeting", "release bugs", "satellites", "flights schedule", "alpha3", "the"]
+
+
+def _fill(kb, sources=("upload", "live")):
+    for i, (title, text) in enumerate(DOCS.items()):
+        kb.add_document(title, text, source=sources[i % len(sources)], date=f"2026-0{i + 1}-01")
+
+
+def _ids(hits):
+    return [h["id"] for h in hits]
+
+
+def test_remove_and_replace_document(kb):
+    _fill(kb)
+    assert kb.remove_document("beta") == 1
+    assert "beta" not in {h["title"] for h in kb.query("release bugs", top_k=4, mode="vector")}
+    kb.replace_document("gamma", "Gamma now covers the quarterly budget.")
+    hits = kb.query("budget", top_k=4, mode="vector")
+    assert [h["text"] for h in hits if h["title"] == "gamma"] == ["Gamma now covers the quarterly budget."]
+    assert KB("test", kb.path).documents() == ["alpha", "delta", "gamma"]
+
+
+def test_compaction_renumbers_without_changing_results(kb, monkeypatch):
+    monkeypatch.setattr(config, "KB_TOMBSTONE_COMPACT_RATIO", 1.0)  # reclaim only when asked
+    _fill(kb)
+    kb.remove_document("beta")
+    assert kb.tombstones
+    before = [_ids(kb.query(q, top_k=3, mode="vector")) for q in QUERIES]
+
+    kb.compact()
+    assert not kb.tombstones and len(kb.chunks) == kb.index.ntotal
+    assert "beta" not in kb.documents()
+    for store in (kb, KB("test", kb.path)):
+        assert [_ids(store.query(q, top_k=3, mode="vector")) for q in QUERIES] == before
+
+
+def test_lossy_storage_reranks_to_exact_results(kb):
+    kb.set_vector_storage("int8")
+    _fill(kb)
+    assert kb.vector_storage == "int8" and len(kb.raw) == len(kb.chunks)
+    exact = [_ids(kb.query(q, top_k=2, mode="vector", rerank=True)) for q in QUERIES]
+    flat = KB("flat", kb.path.parent / "flat")
+    _fill(flat)
+    assert exact == [_ids(flat.query(q, top_k=2, mode="vector")) for q in QUERIES]
+
+
+def test_add_chunks_replaces_in_one_record(kb, monkeypatch):
+    monkeypatch.setattr(config, "KB_TOMBSTONE_COMPACT_RATIO", 1.0)  # keep the record in the log
+    kb.add_document("talk [live]", "provisional words so far")
+    kb.add_chunks("talk", ["the first committed chunk"], replace="talk [live]")
+    assert kb.documents() == ["talk"]
+    meta, vecs = segments.read_log(kb.log.path)[0][-1]
+    assert [doc["title"] for doc in meta["docs"]] == ["talk"] and len(vecs) == 1
+    assert meta["deleted"] == kb.chunks.ids_for_title("talk [live]").tolist()
+
+
+def test_duplicate_recordings_share_chunks(kb, monkeypatch):
+    monkeypatch.setattr(config, "KB_TOMBSTONE_COMPACT_RATIO", 1.0)  # keep the tombstones until compact()
+    kb.add_document("recording-1", DOCS["beta"])
+    n, version = len(kb.chunks), kb.version
+    assert kb.add_document("recording-2", DOCS["beta"])["added"] == 0
+    assert len(kb.chunks) == n and kb.version != version
+    assert kb.documents() == ["recording-1", "recording-2"]
+    hits = kb.query("release bugs", top_k=2, filters={"title": "recording-2"})
+    assert [h["text"] for h in hits] == [DOCS["beta"]]
+
+    assert kb.remove_document("recording-1") == 1
+    for store in (kb, KB("test", kb.path)):  # replayed from the log
+        assert store.documents() == ["recording-2"]
+        assert [h["title"] for h in store.query("release bugs", top_k=2)] == ["recording-2"]
+    kb.compact()
+    assert KB("test", kb.path).documents() == ["recording-2"]  # from the snapshot
+    assert kb.remove_document("recording-2") == 1 and kb.documents() == []
+    assert kb.query("release bugs", top_k=2) == []
+
+
+def test_version_never_repeats_after_reclaim(kb):
+    _fill(kb)
+    seen = [kb.version]
+    for title in ("alpha", "beta"):
+        kb.remove_document(title)
+        kb.compact()  # drops the tombstones again
+        assert not kb.tombstones and kb.version not in seen
+        seen.append(kb.version)
+    assert KB("test", kb.path).version == kb.version
+
+
+def test_keyword_query_needs_a_live_match(kb):
+    _fill(kb)
+    assert kb.retrieval_mode("alpha3", "auto") == "lexical"
+    assert kb.retrieval_mode("alpha3", "auto", filters={"source": "live"}) == "hybrid"
+    kb.remove_document("alpha")
+    assert kb.retrieval_mode("alpha3", "auto") == "hybrid"
+    assert kb.query("alpha3", mode="auto")
+
+
+def test_lexical_index_follows_compaction(kb, monkeypatch):
+    monkeypatch.setattr(config, "KB_TOMBSTONE_COMPACT_RATIO", 1.0)  # reclaim only when asked
+    _fill(kb)
+    kb.remove_document("beta")
+    before = [_ids(kb.query(q, top_k=3, mode="lexical")) for q in QUERIES]
+    kb.compact()
+    for store in (kb, KB("test", kb.path)):
+        assert [_ids(store.query(q, top_k=3, mode="lexical")) for q in QUERIES] == before
+    # appends after the compaction land in the rebased postings tail
+    kb.add_document("epsilon", "Epsilon notes about satellites and budget.")
+    assert "epsilon" in {h["title"] for h in kb.query("satellites", top_k=4, mode="lexical")}
+
+
+@pytest.mark.parametrize("mode", ["vector", "lexical", "hybrid"])
+def test_query_batch_matches_query(kb, mode):
+    _fill(kb)
+    batch = kb.query_batch(QUERIES, top_k=3, mode=mode)
+    single = [kb.query(q, top_k=3, mode=mode) for q in QUERIES]
+    assert [_ids(h) for h in batch] == [_ids(h) for h in single]
+    assert [h["score"] for hits in batch for h in hits] == pytest.approx(
+        [h["score"] for hits in single for h in hits])
+
+
+def test_query_batch_with_precomputed_vectors(kb):
+    _fill(kb)
+    vecs = kb.embed_queries(QUERIES)
+    assert ([_ids(h) for h in kb.query_batch(QUERIES, top_k=2, query_vectors=vecs, mode="vector")]
+            == [_ids(h) for h in kb.query_batch(QUERIES, top_k=2, mode="vector")])
+
+
+@pytest.mark.parametrize("mode", ["vector", "lexical", "hybrid"])
+def test_filters_restrict_every_mode(kb, mode):
+    _fill(kb)
+    hits = kb.query("the", top_k=10, mode=mode, filters={"source": "live"})
+    assert hits and {h["title"] for h in hits} <= {"beta", "delta"}
+    hits = kb.query("the", top_k=10, mode=mode, filters={"title": ["alpha", "gamma"], "since": "2026-02-01"})
+    assert {h["title"] for h in hits} == {"gamma"}
+    assert kb.query("the", top_k=10, mode=mode, filters={"title": "missing"}) == []
+
+
+def test_filters_exact_scan_agrees_with_selector(kb, monkeypatch):
+    _fill(kb)
+    filters = {"source": "upload"}
+    exact = kb.query_batch(QUERIES, top_k=3, mode="vector", filters=filters)
+    monkeypatch.setattr(config, "KB_FILTER_EXACT_MAX", 0)
+    via_index = kb.query_batch(QUERIES, top_k=3, mode="vector", filters=filters)
+    assert [_ids(h) for h in exact] == [_ids(h) for h in via_index]
+
+
+def test_unknown_filter_is_rejected(kb):
+    _fill(kb)
+    with pytest.raises(ValueError):
+        kb.query("budget", filters={"speaker": "me"})
@@ -0,0 +1,50 @@
+import threading
+
+import config
+from services.vectorstore import KB, KBCache
+
+
+def test_own_writes_never_invalidate(manager, monkeypatch):
+    monkeypatch.setattr(config, "KB_COMPACT_LOG_BYTES", 1)  # compact after every append
+    monkeypatch.setattr(config, "KB_COMPACT_IN_BACKGROUND", True)
+    manager.create_kb("k")
+    kb = manager.get_kb("k")
+    for i in range(5):
+        manager.add_transcript("k", f"doc{i}", f"text of document {i}")
+        assert manager.get_kb("k") is kb
+    if kb._compaction is not None:
+        kb._compaction.join()
+    assert not kb.changed_on_disk()
+    assert manager.get_kb("k") is kb and manager.cache_stats()["invalidations"] == 0
+
+
+def test_kb_with_a_running_job_is_not_replaced(manager):
+    manager.create_kb("k")
+    kb = manager.get_kb("k")
+    release = threading.Event()
+    kb._compaction = threading.Thread(target=release.wait)
+    kb._compaction.start()
+    try:
+        KB("k", kb.path).add_document("other", "written by another process")
+        assert manager.get_kb("k") is kb
+    finally:
+        release.set()
+        kb._compaction.join()
+    assert kb.changed_on_disk()
+
+
+def test_evicted_kb_still_in_use_is_handed_out_again(kb):
+    cache = KBCache(max_bytes=1, check_interval=0.0)
+    held = cache.get("a", kb.path.parent / "a")
+    held.add_document("doc", "a live session keeps writing here")
+    cache.get("b", kb.path.parent / "b")  # evicts "a"
+    assert cache.stats()["evictions"] == 1
+    assert cache.get("a", kb.path.parent / "a") is held
+
+
+def test_external_change_reloads_in_place(kb):
+    cache = KBCache(check_interval=0.0)
+    cached = cache.get("test", kb.path)
+    KB("test", kb.path).add_document("other", "written by another process")
+    assert cache.get("test", kb.path) is cached
+    assert cached.documents() == ["other"] and cache.stats()["invalidations"] == 1
@@ -0,0 +1,49 @@
+import numpy as np
+
+from services.lexical import LexicalIndex, rrf_fuse
+
+TEXTS = ["the quick brown fox", "a lazy dog sleeps", "the fox and the dog",
+         "quick quick quick", "brown bread and butter", "dog days of summer"]
+
+
+def _search(index, query, k=10):
+    positions, scores = index.search(query, k)
+    return positions.tolist(), np.round(scores, 5).tolist()
+
+
+def test_search_ranks_by_bm25():
+    index = LexicalIndex.from_texts(TEXTS)
+    positions, _ = _search(index, "quick fox")
+    assert positions[0] in (0, 3) and set(positions) == {0, 2, 3}
+    assert _search(index, "nothing matches") == ([], [])
+    excluded, _ = index.search("dog", 10, excluded=lambda p: p == 2)
+    assert sorted(excluded.tolist()) == [1, 5]
+
+
+def test_written_index_matches_in_memory(tmp_path):
+    index = LexicalIndex.from_texts(TEXTS)
+    index.write(tmp_path)
+    reopened = LexicalIndex(tmp_path)
+    for query in ("quick fox", "dog", "brown and"):
+        assert _search(reopened, query) == _search(index, query)
+
+
+def test_rebase_matches_fresh_index(tmp_path):
+    index = LexicalIndex.from_texts(TEXTS)
+    view = index.snapshot()
+    index.extend(["a fox after the snapshot", "new words entirely"])  # added while it is written
+    keep = np.array([True, False, True, True, False, True])
+    view.write(tmp_path, keep=keep)
+    rebased = index.rebase(tmp_path, len(view))
+
+    kept = [t for t, k in zip(TEXTS, keep) if k] + ["a fox after the snapshot", "new words entirely"]
+    fresh = LexicalIndex.from_texts(kept)
+    assert len(rebased) == len(fresh)
+    for query in ("fox", "quick dog", "entirely new", "brown", "summer the"):
+        assert _search(rebased, query) == _search(fresh, query)
+
+
+def test_rrf_fuse_rewards_agreement():
+    positions, scores = rrf_fuse([np.array([1, 2, 3]), np.array([3, 1, 4])], k=3, rrf_k=60)
+    assert positions.tolist()[:2] == [1, 3]
+    assert scores[0] >= scores[1] >= scores[2]
@@ -0,0 +1,42 @@
+import threading
+
+import pytest
+
+import config
+from services import segments
+
+
+def test_delete_kb_waits_for_a_running_compaction(manager, monkeypatch):
+    manager.create_kb("k")
+    manager.add_transcript("k", "doc", "some text to compact")
+    kb = manager.get_kb("k")
+    # hold the compaction in its snapshot write until the KB is being deleted
+    started, release = threading.Event(), threading.Event()
+    write = segments.atomic_write_bytes
+
+    def slow_write(path, data):
+        started.set()
+        release.wait(5)
+        write(path, data)
+
+    monkeypatch.setattr(segments, "atomic_write_bytes", slow_write)
+    monkeypatch.setattr(config, "KB_COMPACT_IN_BACKGROUND", True)
+    kb.compact(background=True)
+    assert started.wait(5)
+    threading.Timer(0.2, release.set).start()
+    manager.delete_kb("k")
+
+    assert not kb._compaction.is_alive()
+    assert "k" not in manager.list_kbs()
+    with pytest.raises(RuntimeError):
+        kb.add_document("late", "written after the delete")
+    assert "k" not in manager.list_kbs()
+
+
+def test_query_kbs_rejects_unknown_names(manager):
+    manager.create_kb("k")
+    manager.add_transcript("k", "doc", "the budget meeting moved to friday")
+    with pytest.raises(ValueError, match="missing"):
+        manager.query_kbs(["k", "missing"], "budget")
+    assert manager.list_kbs() == ["k"]  # not created by the lookup
+    assert [h["kb"] for h in manager.query_kbs(["k"], "budget")] == ["k"]
@@ -0,0 +1,66 @@
+import numpy as np
+
+from services import segments
+from services.vectorstore import KB
+
+
+def _vecs(n, dim=4):
+    return np.arange(n * dim, dtype="float32").reshape(n, dim)
+
+
+def test_read_log_stops_at_torn_tail(tmp_path):
+    path = tmp_path / "log"
+    log = segments.SegmentLog(path)
+    log.append([{"id": 0, "title": "a", "text": "one"}], _vecs(1), "m")
+    log.append([], np.zeros((0, 0), dtype="float32"), deleted=[0])
+    intact = path.stat().st_size
+    record = segments.encode_record([{"id": 1, "title": "b", "text": "two"}], _vecs(1), "m")
+    with open(path, "ab") as f:
+        f.write(record[:len(record) // 2])
+
+    records, valid_end = segments.read_log(path)
+    assert valid_end == intact
+    assert [meta["docs"] for meta, _ in records] == [[{"id": 0, "title": "a", "text": "one"}], []]
+    assert records[1][0]["deleted"] == [0]
+    np.testing.assert_array_equal(records[0][1], _vecs(1))
+
+
+def test_corrupt_record_ends_the_log(tmp_path):
+    path = tmp_path / "log"
+    log = segments.SegmentLog(path)
+    log.append([{"id": 0, "text": "one"}], _vecs(1))
+    first = path.stat().st_size
+    log.append([{"id": 1, "text": "two"}], _vecs(1))
+    data = bytearray(path.read_bytes())
+    data[-1] ^= 0xFF  # checksum no longer matches
+    path.write_bytes(bytes(data))
+
+    records, valid_end = segments.read_log(path)
+    assert len(records) == 1 and valid_end == first
+
+
+def test_reopening_truncates_the_torn_tail(tmp_path):
+    path = tmp_path / "log"
+    segments.SegmentLog(path).append([{"id": 0, "text": "one"}], _vecs(1))
+    intact = path.stat().st_size
+    with open(path, "ab") as f:
+        f.write(b"\x00garbage")
+
+    log = segments.SegmentLog(path, valid_end=segments.read_log(path)[1])
+    assert path.stat().st_size == intact
+    log.append([{"id": 1, "text": "two"}], _vecs(1))
+    records, _ = segments.read_log(path)
+    assert [meta["docs"][0]["text"] for meta, _ in records] == ["one", "two"]
+
+
+def test_kb_replays_log_up_to_torn_tail(kb):
+    kb.add_document("a", "the first document")
+    kb.add_document("b", "the second document")
+    with open(kb.log.path, "ab") as f:
+        f.write(b"\x01" * 17)
+
+    reopened = KB("test", kb.path)
+    assert reopened.documents() == ["a", "b"]
+    assert len(reopened.chunks) == len(kb.chunks)
+    reopened.add_document("c", "a third document after recovery")
+    assert KB("test", kb.path).documents() == ["a", "b", "c"]
@@ -0,0 +1,88 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from services.audio import plan_segments
+from services.transcribe import drop_overlaps, merge_transcripts, transcribe_uploads
+
+
+class RateLimited(Exception):
+    status_code = 429
+    response = SimpleNamespace(status_code=429, headers={"retry-after": "0"})
+
+
+class FakeTranscriber:
+    """Stands in for the OpenAI client: the transcript of an upload is its bytes, decoded."""
+
+    def __init__(self, fail_first=0):
+        self.fail_first = fail_first
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.audio = SimpleNamespace(transcriptions=SimpleNamespace(create=self.create))
+
+    def create(self, model, file):
+        name, data = file
+        with self._lock:
+            self.calls += 1
+            if self.fail_first:
+                self.fail_first -= 1
+                raise RateLimited("slow down")
+        time.sleep(0.01 * (len(data) % 3))  # finish out of order
+        return SimpleNamespace(text=data.decode())
+
+
+def _uploads(texts):
+    return [lambda t=t: ("audio.mp3", t.encode()) for t in texts]
+
+
+def test_transcribe_uploads_keeps_input_order():
+    texts = [f"segment {i}" + "!" * i for i in range(7)]
+    client = FakeTranscriber()
+    assert transcribe_uploads(client, _uploads(texts), max_workers=4) == texts
+    assert client.calls == len(texts)
+
+
+def test_transcribe_uploads_retries_rate_limits():
+    client = FakeTranscriber(fail_first=2)
+    assert transcribe_uploads(client, _uploads(["one", "two"]), max_workers=1) == ["one", "two"]
+    assert client.calls == 4
+
+
+def test_drop_overlaps_cuts_the_repeated_words():
+    texts = ["We met on Monday to talk about the budget",
+             "about the budget. Then we moved on\nto hiring.",
+             "A new topic starts here."]
+    parts = drop_overlaps(texts, [False, True, True])
+    assert parts == [texts[0], "Then we moved on\nto hiring.", texts[2]]
+    # without the overlap flag nothing is cut
+    assert drop_overlaps(texts[:2], [False, False]) == texts[:2]
+    assert merge_transcripts(texts[:2], [False, True]) == texts[0] + " Then we moved on\nto hiring."
+
+
+SR = 1000  # samples per second; 30 ms frames of 30 samples
+
+
+def _speech(seconds, pauses=()):
+    """Steady "speech" (level 0.5) with silent (start, end) second ranges."""
+    samples = np.full(int(seconds * SR), 0.5, dtype=np.float32)
+    for a, b in pauses:
+        samples[int(a * SR):int(b * SR)] = 0.0
+    return samples
+
+
+def test_plan_segments_cuts_in_silence_and_overlaps_through_speech():
+    samples = _speech(25, pauses=[(8.0, 8.6)])
+    pieces = plan_segments(samples, SR, max_seconds=10, overlap_seconds=1, search_seconds=3)
+    assert [overlapped for _, _, overlapped in pieces] == [False, False, True]
+    (s0, e0, _), (s1, e1, _), (s2, e2, _) = pieces
+    # the first cut lands in the pause and the next piece starts right there
+    assert s0 == 0 and 8.0 * SR <= e0 < 8.6 * SR and samples[e0] == 0.0 and s1 == e0
+    # no pause in the next window: cut at its end, next piece repeats one second
+    assert e1 == s1 + 10 * SR and s2 == e1 - SR and e2 == len(samples)
+    assert all(b - a <= 10 * SR for a, b, _ in pieces)
+
+
+def test_plan_segments_keeps_a_short_recording_whole():
+    assert plan_segments(_speech(5), SR, max_seconds=10) == [(0, 5 * SR, False)]